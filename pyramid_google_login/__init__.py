@@ -3,6 +3,8 @@ import logging
 
 from pyramid.httpexceptions import HTTPFound
 
+from pyramid_google_login.tenants import get_tenant
+
 log = logging.getLogger(__name__)
 
 
@@ -13,7 +15,15 @@ def includeme(config):
     log.info("Add pyramid_google_login")
 
     config.include('pyramid_mako')
+    config.include('.metrics')
+    config.include('.templating')
     config.include('.utility')
+    config.include('.state')
+    config.include('.directory')
+    config.include('.tokens')
+    config.include('.reauth')
+    config.include('.dispatch')
+    config.include('.groups')
     config.include('.views')
 
 
@@ -30,12 +40,17 @@ def redirect_to_signin(request, message=None, url=None, headers=None):
 
 def find_landing_path(request):
     settings = request.registry.settings
+    tenant = get_tenant(request)
+    if tenant is not None:
+        landing_url = tenant.api_settings.landing_url
+        landing_route = tenant.api_settings.landing_route
+    else:
+        landing_url = settings.get(SETTINGS_PREFIX + 'landing_url')
+        landing_route = settings.get(SETTINGS_PREFIX + 'landing_route')
 
-    landing_url = settings.get(SETTINGS_PREFIX + 'landing_url')
     if landing_url is not None:
         return landing_url
 
-    landing_route = settings.get(SETTINGS_PREFIX + 'landing_route')
     if landing_route is not None:
         try:
             return request.route_path(landing_route)
@@ -0,0 +1,358 @@
+"""asyncio flavour of the Google API client (Python 3.6+, requires aiohttp)
+
+Include it after ``pyramid_google_login`` to get an
+:class:`AsyncApiClient` as ``request.googleapi_async``::
+
+    config.include('pyramid_google_login')
+    config.include('pyramid_google_login.aio')
+
+``request.googleapi`` stays the synchronous client, used by the bundled
+views and by the background services (tokens, directory, groups).
+
+Its network methods are coroutines: ``exchange_token_from_code``,
+``get_userinfo_from_token`` (with the userinfo cache),
+``refresh_access_token``, ``refresh_many``, ``get_domain_users`` and
+``iter_domain_users``. The
+identical calls are not coalesced (``http_single_flight`` is sync only). The
+batch and groups methods (``get_user_groups``, ``batch_get``, ``send_batch``,
+``get_users``, ``get_userinfos``) are sync only: they raise
+``NotImplementedError``.
+"""
+import asyncio
+import logging
+import time
+
+from pyramid.exceptions import ConfigurationError
+from zope.interface import Interface
+
+from pyramid_google_login import SETTINGS_PREFIX
+from pyramid_google_login.exceptions import (AuthFailed, ApiError,
+                                             TransportError)
+from pyramid_google_login.metrics import get_metrics_sink, record_http_call
+from pyramid_google_login.ratelimit import TokenBucket, parse_retry_after
+from pyramid_google_login.transport import CircuitOpenError, FAILURE_STATUSES
+from pyramid_google_login.utility import (GOOGLE_UNAVAILABLE, ApiClient,
+                                          RefreshResult)
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+log = logging.getLogger(__name__)
+
+SYNC_ONLY = '%s is sync only: use request.googleapi'
+
+
+class IAsyncHttpSessionPool(Interface):
+    pass
+
+
+class IAsyncApiClientFactory(Interface):
+    pass
+
+
+def aio_errors(*others):
+    """Exceptions of a failed call to Google with aiohttp, plus ``others``
+    (the counterpart of :func:`transport.request_errors`)
+    """
+    return others + (aiohttp.ClientError, asyncio.TimeoutError,
+                     TransportError)
+
+
+class AsyncHttpSessionPool(object):
+    """Keep-alive connections to Google, one aiohttp session per event loop
+    """
+
+    def __init__(self, limit=100, limit_per_host=0):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self._sessions = {}
+
+    @property
+    def session(self):
+        loop = asyncio.get_event_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            # Forget the sessions of the loops that are gone
+            for other_loop in list(self._sessions):
+                if other_loop.is_closed():
+                    del self._sessions[other_loop]
+            session = self._sessions[loop] = self.new_session()
+        return session
+
+    def new_session(self):
+        connector = aiohttp.TCPConnector(limit=self.limit,
+                                         limit_per_host=self.limit_per_host)
+        return aiohttp.ClientSession(connector=connector)
+
+    async def close(self):
+        session = self._sessions.pop(asyncio.get_event_loop(), None)
+        if session is not None:
+            await session.close()
+
+
+class AsyncApiClient(ApiClient):
+    """Same API as :class:`ApiClient` with the network calls as coroutines
+    """
+
+    def __init__(self, request):
+        super(AsyncApiClient, self).__init__(request)
+        self.aio_http = request.registry.getUtility(IAsyncHttpSessionPool)
+        self.metrics = get_metrics_sink(request.registry)
+
+    async def request_json(self, method, url, endpoint=None, **kwargs):
+        """Call Google with the timeouts and through the circuit breakers
+        of the :class:`HttpSessionPool` (no retries), after its rate limiter
+        """
+        breaker = self.http.breaker_for(url, endpoint)
+        if not breaker.allow():
+            self.metrics.incr('circuit_breaker.rejected', tags=breaker.tags)
+            raise CircuitOpenError('Circuit breaker open for %s'
+                                   % breaker.name)
+
+        rate_limiter = self.http.rate_limiter
+        kwargs.setdefault('timeout',
+                          client_timeout(self.http.timeout_for(endpoint)))
+        session = self.aio_http.session
+        start = time.time()
+        status = 'error'
+        try:
+            if rate_limiter is not None:
+                wait = rate_limiter.reserve(endpoint)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    start = time.time()
+            async with session.request(method, url, **kwargs) as response:
+                status = response.status
+                if status in FAILURE_STATUSES:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                retry_after = parse_retry_after(response.headers)
+                if retry_after is not None and rate_limiter is not None:
+                    rate_limiter.retry_after(endpoint, retry_after)
+                response.raise_for_status()
+                return await response.json(content_type=None)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            breaker.record_failure()
+            raise
+        except BaseException:
+            # E.g. cancelled: let another trial call through
+            breaker.release()
+            raise
+        finally:
+            record_http_call(self.metrics, method, url, status,
+                             time.time() - start)
+
+    async def exchange_token_from_code(self, redirect_uri):
+        code = self.get_authorization_code()
+        params = self.token_params(code, redirect_uri)
+
+        try:
+            oauth2_tokens = await self.request_json(
+                'POST', self.token_endpoint, endpoint='token', data=params)
+
+        except asyncio.CancelledError:
+            raise
+
+        except CircuitOpenError:
+            raise AuthFailed(GOOGLE_UNAVAILABLE)
+
+        except aio_errors() as err:
+            raise AuthFailed('Failed to get token from Google (%s)' % err)
+
+        except Exception:
+            log.warning('Unkown error while calling token endpoint',
+                        exc_info=True)
+            raise AuthFailed('Failed to get token from Google (unkown error)')
+
+        self.check_oauth2_tokens(oauth2_tokens)
+        return oauth2_tokens
+
+    async def get_userinfo_from_token(self, oauth2_tokens):
+        if self.userinfo_source == 'id_token':
+            # The signing keys may have to be fetched (synchronously)
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(
+                None, self.get_userinfo_from_id_token, oauth2_tokens)
+
+        cache, cache_key = self.userinfo_cache(oauth2_tokens)
+        if cache is not None:
+            userinfo = cache.get(cache_key)
+            if userinfo is not None:
+                return userinfo
+
+        try:
+            params = {'access_token': oauth2_tokens['access_token']}
+            userinfo = await self.request_json(
+                'GET', self.userinfo_endpoint, endpoint='userinfo',
+                params=params)
+        except asyncio.CancelledError:
+            raise
+        except CircuitOpenError:
+            raise AuthFailed(GOOGLE_UNAVAILABLE)
+        except Exception:
+            log.warning('Unkown error calling userinfo endpoint',
+                        exc_info=True)
+            raise AuthFailed('Failed to get userinfo from Google')
+
+        if cache is not None:
+            self.cache_userinfo(cache, cache_key, oauth2_tokens, userinfo)
+        return userinfo
+
+    async def refresh_access_token(self, refresh_token):
+        params = self.refresh_token_params(refresh_token)
+
+        try:
+            oauth2_tokens = await self.request_json(
+                'POST', self.token_endpoint, endpoint='token', params=params)
+        except asyncio.CancelledError:
+            raise
+        except CircuitOpenError as err:
+            raise AuthFailed(err, GOOGLE_UNAVAILABLE)
+        except aio_errors() as err:
+            raise AuthFailed(err, 'Failed to get token from Google (%s)' % err)
+        except Exception as err:
+            log.warning('Unkown error while calling token endpoint',
+                        exc_info=True)
+            raise AuthFailed(err,
+                             'Failed to get token from Google (unknown error)')
+
+        self.check_oauth2_tokens(oauth2_tokens)
+        return oauth2_tokens
+
+    async def refresh_many(self, refresh_tokens, concurrency=8, rate=None):
+        """Refresh many tokens concurrently, yield a ``RefreshResult`` for
+        each of them (in completion order)
+        """
+        limiter = TokenBucket(rate, burst=concurrency) if rate else None
+
+        async def refresh(refresh_token):
+            if limiter is not None:
+                await asyncio.sleep(limiter.reserve())
+            try:
+                oauth2_tokens = await self.refresh_access_token(refresh_token)
+            except Exception as err:
+                return RefreshResult(refresh_token, None, err)
+            return RefreshResult(refresh_token, oauth2_tokens, None)
+
+        refresh_tokens = iter(refresh_tokens)
+        pending = set()
+        try:
+            while True:
+                for refresh_token in refresh_tokens:
+                    pending.add(asyncio.ensure_future(refresh(refresh_token)))
+                    if len(pending) >= concurrency:
+                        break
+                if not pending:
+                    return
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def get_domain_users(self, access_token, limit=500):
+        params = self.domain_users_params(access_token, limit)
+        try:
+            return await self.request_json(
+                'GET', self.domain_users_endpoint, endpoint='directory',
+                params=params)
+        except aio_errors(ValueError) as err:
+            raise ApiError(err, 'Failed to get domain users (%s)' % err)
+
+    async def iter_domain_users(self, access_token, page_size=500,
+                                fields=None, prefetch=True):
+        params = self.domain_users_params(access_token, page_size, fields)
+
+        async def fetch_page(page_token):
+            page_params = dict(params)
+            if page_token:
+                page_params['pageToken'] = page_token
+            try:
+                return await self.request_json(
+                    'GET', self.domain_users_endpoint, endpoint='directory',
+                    params=page_params)
+            except aio_errors(ValueError) as err:
+                raise ApiError(err, 'Failed to get domain users (%s)' % err)
+
+        page = await fetch_page(None)
+        while True:
+            page_token = page.get('nextPageToken')
+            next_page = None
+            if page_token and prefetch:
+                next_page = asyncio.ensure_future(fetch_page(page_token))
+
+            try:
+                for user in page.get('users', ()):
+                    yield user
+            except BaseException:
+                if next_page is not None:
+                    next_page.cancel()
+                raise
+
+            if not page_token:
+                return
+            if next_page is not None:
+                page = await next_page
+            else:
+                page = await fetch_page(page_token)
+
+    def get_user_groups(self, *args, **kwargs):
+        raise NotImplementedError(SYNC_ONLY % 'get_user_groups')
+
+    def batch_get(self, *args, **kwargs):
+        raise NotImplementedError(SYNC_ONLY % 'batch_get')
+
+    def send_batch(self, *args, **kwargs):
+        raise NotImplementedError(SYNC_ONLY % 'send_batch')
+
+    def get_users(self, *args, **kwargs):
+        raise NotImplementedError(SYNC_ONLY % 'get_users')
+
+    def get_userinfos(self, *args, **kwargs):
+        raise NotImplementedError(SYNC_ONLY % 'get_userinfos')
+
+    def get_users_groups(self, *args, **kwargs):
+        raise NotImplementedError(SYNC_ONLY % 'get_users_groups')
+
+
+def client_timeout(timeout):
+    """aiohttp flavour of a requests timeout (seconds or (connect, read))
+    """
+    if isinstance(timeout, tuple):
+        connect, read = timeout
+        return aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+    return aiohttp.ClientTimeout(sock_connect=timeout, sock_read=timeout)
+
+
+def includeme(config):
+    if aiohttp is None:
+        raise ConfigurationError('pyramid_google_login.aio requires aiohttp')
+
+    settings = config.registry.settings
+    prefix = SETTINGS_PREFIX
+
+    try:
+        http_pool = AsyncHttpSessionPool(
+            limit=int(settings.get(prefix + 'async_http_limit', 100)),
+            limit_per_host=int(
+                settings.get(prefix + 'async_http_limit_per_host', 0)),
+            )
+    except ValueError as err:
+        log.error('Invalid async HTTP pool setting: %s', err)
+        raise
+
+    config.registry.registerUtility(http_pool,
+                                    provided=IAsyncHttpSessionPool)
+    config.registry.registerUtility(AsyncApiClient,
+                                    provided=IAsyncApiClientFactory)
+    config.add_request_method(new_async_api_client, 'googleapi_async',
+                              reify=True)
+
+
+def new_async_api_client(request):
+    return request.registry.getUtility(IAsyncApiClientFactory)(request)
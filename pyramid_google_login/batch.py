@@ -0,0 +1,139 @@
+"""Google batch requests: many GET calls in one multipart HTTP call
+
+-> https://developers.google.com/admin-sdk/directory/v1/guides/batch
+
+The request is a ``multipart/mixed`` body of ``application/http`` parts, one
+per call (``Content-ID: <item-N>``). The response is read as a stream and
+split into its parts as they arrive (``Content-ID: <response-item-N>``): the
+memory used is bounded by the largest part, not by the whole response.
+"""
+from collections import namedtuple
+import json
+import uuid
+
+from six.moves.urllib import parse
+
+from pyramid_google_login.exceptions import ApiError
+
+# Maximum number of calls in a batch request (limit of Google)
+MAX_BATCH_SIZE = 100
+
+# A call of a batch: url of the endpoint, query params and access token
+BatchCall = namedtuple('BatchCall', 'url params access_token')
+
+# Response of a call, as parsed from the batch response
+BatchPart = namedtuple('BatchPart', 'content_id status headers body')
+
+# Outcome of a call of a batch: result or error is None
+BatchResult = namedtuple('BatchResult', 'key result error')
+
+
+def new_boundary():
+    return 'batch_' + uuid.uuid4().hex
+
+
+def build_batch_body(calls, boundary):
+    """Encode the calls as a multipart body (bytes)"""
+    chunks = []
+    for index, call in enumerate(calls):
+        url = parse.urlsplit(call.url)
+        target = url.path
+        if call.params:
+            target += '?' + parse.urlencode(sorted(call.params.items()))
+        chunks.append(
+            '--%s\r\n'
+            'Content-Type: application/http\r\n'
+            'Content-ID: <item-%d>\r\n'
+            '\r\n'
+            'GET %s\r\n'
+            'Authorization: Bearer %s\r\n'
+            '\r\n' % (boundary, index, target, call.access_token))
+    chunks.append('--%s--\r\n' % boundary)
+    return ''.join(chunks).encode('utf-8')
+
+
+def boundary_from_content_type(content_type):
+    media_type, _, params = (content_type or '').partition(';')
+    if media_type.strip().lower() != 'multipart/mixed':
+        raise ApiError('Not a multipart response (%s)' % content_type)
+    for param in params.split(';'):
+        name, _, value = param.partition('=')
+        if name.strip().lower() == 'boundary':
+            return value.strip().strip('"')
+    raise ApiError('No boundary in %s' % content_type)
+
+
+def parse_headers(lines):
+    headers = {}
+    for line in lines:
+        name, _, value = line.partition(b':')
+        headers[name.strip().decode('latin-1').lower()] = (
+            value.strip().decode('latin-1'))
+    return headers
+
+
+def parse_part(part):
+    """Parse a part: MIME headers, then the HTTP response of the call"""
+    # The part starts after the CRLF of the boundary line
+    mime, _, http = part.partition(b'\r\n')[2].partition(b'\r\n\r\n')
+    content_id = parse_headers(mime.split(b'\r\n')).get('content-id', '')
+
+    head, _, body = http.partition(b'\r\n\r\n')
+    lines = head.split(b'\r\n')
+    try:
+        status = int(lines[0].split()[1])
+    except (IndexError, ValueError):
+        raise ApiError('Invalid batch response part (%r)' % lines[0])
+    return BatchPart(content_id.strip('<>'), status,
+                     parse_headers(lines[1:]), body)
+
+
+def iter_parts(chunks, boundary):
+    """Yield the :class:`BatchPart` of a multipart body read by chunks
+
+    Raise :class:`ApiError` if the body ends before the closing boundary.
+    """
+    delimiter = b'\r\n--' + boundary.encode('ascii')
+    # The first boundary line may be at the very start of the body
+    buffer = b'\r\n'
+    in_part = False
+    searched = 0
+
+    for chunk in chunks:
+        buffer += chunk
+        while True:
+            index = buffer.find(delimiter, searched)
+            if index < 0:
+                # Only the tail may hold the start of the next delimiter
+                searched = max(0, len(buffer) - len(delimiter) + 1)
+                break
+            end = index + len(delimiter)
+            if len(buffer) < end + 2:
+                # Closing delimiter or not: wait for the next chunk
+                searched = index
+                break
+            if in_part:
+                yield parse_part(buffer[:index])
+            if buffer[end:end + 2] == b'--':
+                return
+            in_part = True
+            buffer = buffer[end:]
+            searched = 0
+
+    raise ApiError('Truncated batch response')
+
+
+def result_from_part(part):
+    """Decoded JSON body of a part, or ApiError if the call failed"""
+    try:
+        payload = json.loads(part.body.decode('utf-8')) if part.body else {}
+    except ValueError as err:
+        return None, ApiError(err, 'Invalid JSON in batch response part')
+
+    if not 200 <= part.status < 300:
+        message = payload.get('error') if isinstance(payload, dict) else None
+        if isinstance(message, dict):
+            message = message.get('message')
+        return None, ApiError('Batch call failed with %s (%s)'
+                              % (part.status, message))
+    return payload, None
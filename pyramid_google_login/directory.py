@@ -0,0 +1,291 @@
+"""Local mirror of the hosted domain users (Admin Directory API)
+
+The users are synced periodically by a background thread and looked up in
+memory, without any network call on the request path::
+
+    user = request.google_directory.lookup('bob@example.net')
+
+Each sync lists all the users of the domain: the Directory API has no
+incremental listing, only the writes to the local store are limited to the
+users whose ``etag`` changed. Without ``directory_path`` (the default),
+there is no local store: every process starts empty and lists all the users
+at startup.
+
+With tenants, a tenant has its own mirror when it sets its own
+``tenant.<name>.directory_mirror`` and ``directory_refresh_token``.
+"""
+from bisect import bisect_left
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from pyramid.settings import asbool
+from zope.interface import Interface
+
+from pyramid_google_login import SETTINGS_PREFIX
+from pyramid_google_login.tenants import (get_tenant_name, tenant_names,
+                                          tenant_settings)
+from pyramid_google_login.utility import new_api_client_from_registry
+
+log = logging.getLogger(__name__)
+
+DEFAULT_FIELDS = 'id,etag,primaryEmail,aliases,name/fullName,thumbnailPhotoUrl'
+
+
+class IDirectoryMirror(Interface):
+    pass
+
+
+class DirectorySnapshot(object):
+    """Immutable in-memory indexes of the directory users"""
+
+    def __init__(self, users=()):
+        self.by_id = {}
+        self.by_email = {}
+        names = []
+
+        for user in users:
+            self.by_id[user['id']] = user
+            self.by_email[user['primaryEmail'].lower()] = user
+            for alias in user.get('aliases', ()):
+                self.by_email.setdefault(alias.lower(), user)
+
+            name = user.get('name', {}).get('fullName')
+            if name:
+                names.append((name.lower(), user['id']))
+
+        names.sort()
+        self._name_keys = [name for name, _ in names]
+        self._name_ids = [user_id for _, user_id in names]
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def search(self, prefix, limit=10):
+        prefix = prefix.lower()
+        index = bisect_left(self._name_keys, prefix)
+        found = []
+        while (len(found) < limit and index < len(self._name_keys) and
+               self._name_keys[index].startswith(prefix)):
+            found.append(self.by_id[self._name_ids[index]])
+            index += 1
+        return found
+
+
+class DirectoryStore(object):
+    """SQLite persistence of the mirror (file ``path``), to start warm after
+    a restart
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+
+    @property
+    def connection(self):
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript('''
+                CREATE TABLE IF NOT EXISTS users (
+                    id TEXT PRIMARY KEY,
+                    email TEXT NOT NULL,
+                    name TEXT,
+                    etag TEXT,
+                    data TEXT NOT NULL
+                );
+                CREATE UNIQUE INDEX IF NOT EXISTS users_email
+                    ON users (email);
+                DROP INDEX IF EXISTS users_name;
+            ''')
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    def load(self):
+        with self._lock:
+            rows = self.connection.execute('SELECT data FROM users')
+            return [json.loads(data) for data, in rows]
+
+    def apply(self, changed_users, removed_ids):
+        rows = [(user['id'],
+                 user['primaryEmail'].lower(),
+                 user.get('name', {}).get('fullName', '').lower() or None,
+                 user.get('etag'),
+                 json.dumps(user, separators=(',', ':')))
+                for user in changed_users]
+
+        with self._lock:
+            with self.connection as connection:
+                connection.executemany(
+                    'DELETE FROM users WHERE id = ?',
+                    [(user_id,) for user_id in removed_ids])
+                # Email of a renamed user may belong to another user now
+                connection.executemany(
+                    'DELETE FROM users WHERE email = ? AND id != ?',
+                    [(row[1], row[0]) for row in rows])
+                connection.executemany(
+                    'INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?)',
+                    rows)
+
+
+class DirectoryMirror(object):
+    """Directory users of the hosted domain, synced in background
+
+    ``store`` is a :class:`DirectoryStore`, or None not to persist them.
+    """
+
+    def __init__(self, registry, store, refresh_token,
+                 sync_interval=3600, fields=DEFAULT_FIELDS, page_size=500,
+                 tenant=None):
+        self.registry = registry
+        self.tenant = tenant
+        self.store = store
+        self.refresh_token = refresh_token
+        self.sync_interval = sync_interval
+        self.fields = fields
+        self.page_size = page_size
+
+        self.snapshot = DirectorySnapshot()
+        self.synced_at = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stop = threading.Event()
+
+    def lookup(self, email):
+        self.ensure_started()
+        return self.snapshot.by_email.get(email.lower())
+
+    def get(self, user_id):
+        self.ensure_started()
+        return self.snapshot.by_id.get(user_id)
+
+    def search(self, name_prefix, limit=10):
+        self.ensure_started()
+        return self.snapshot.search(name_prefix, limit)
+
+    def ensure_started(self):
+        """Load the local store and start the sync thread (once per process)
+        """
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            if self.store is not None:
+                self.snapshot = DirectorySnapshot(self.store.load())
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run,
+                                            name='google-directory-sync')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        delay = self.sync_interval if len(self.snapshot) else 0
+        while not self._stop.wait(delay):
+            try:
+                self.sync()
+            except Exception:
+                log.exception('Failed to sync the Google directory')
+            delay = self.sync_interval
+
+    def sync(self):
+        """Fetch all the users (not incremental), store only the ones that
+        changed
+        """
+        start = time.time()
+        api = new_api_client_from_registry(self.registry, self.tenant)
+        oauth2_tokens = api.refresh_access_token(self.refresh_token)
+
+        known_etags = dict((user_id, user.get('etag'))
+                           for user_id, user in self.snapshot.by_id.items())
+        users, changed_users = [], []
+        for user in api.iter_domain_users(oauth2_tokens['access_token'],
+                                          page_size=self.page_size,
+                                          fields=self.fields):
+            users.append(user)
+            if known_etags.get(user['id']) != user.get('etag'):
+                changed_users.append(user)
+
+        removed_ids = set(known_etags).difference(u['id'] for u in users)
+        if self.store is not None:
+            self.store.apply(changed_users, removed_ids)
+        self.snapshot = DirectorySnapshot(users)
+        self.synced_at = time.time()
+
+        log.info('Google directory synced in %.1fs: %d users '
+                 '(%d changed, %d removed)', self.synced_at - start,
+                 len(users), len(changed_users), len(removed_ids))
+        return len(changed_users), len(removed_ids)
+
+
+def includeme(config):
+    settings = config.registry.settings
+    prefix = SETTINGS_PREFIX
+
+    mirrors = [directory_mirror_from_settings(config.registry, settings,
+                                              prefix)]
+    for name in tenant_names(settings, prefix):
+        mirrors.append(directory_mirror_from_settings(
+            config.registry, tenant_settings(settings, prefix, name), prefix,
+            tenant=name))
+
+    mirrors = [mirror for mirror in mirrors if mirror is not None]
+    if not mirrors:
+        return
+
+    for mirror in mirrors:
+        config.registry.registerUtility(mirror, provided=IDirectoryMirror,
+                                        name=mirror.tenant or '')
+    config.add_request_method(get_directory_mirror, 'google_directory',
+                              reify=True)
+
+
+def directory_mirror_from_settings(registry, settings, prefix, tenant=None):
+    """Build the :class:`DirectoryMirror` of the settings (or None)"""
+    if not asbool(settings.get(prefix + 'directory_mirror', False)):
+        return None
+
+    path = settings.get(prefix + 'directory_path')
+    if path and path != ':memory:':
+        store = DirectoryStore(path)
+    else:
+        store = None
+        log.info('The Google directory mirror%s is not persisted (no '
+                 'directory_path): each process lists all the users at '
+                 'startup', ' of %s' % tenant if tenant else '')
+
+    try:
+        return DirectoryMirror(
+            registry,
+            store,
+            refresh_token=settings[prefix + 'directory_refresh_token'],
+            sync_interval=int(
+                settings.get(prefix + 'directory_sync_interval', 3600)),
+            fields=settings.get(prefix + 'directory_fields', DEFAULT_FIELDS),
+            tenant=tenant,
+            )
+    except (KeyError, ValueError) as err:
+        log.error('Invalid directory mirror setting: %s', err)
+        raise
+
+
+def get_directory_mirror(request):
+    """Mirror of the tenant of the request, or None when the tenant has no
+    mirror
+    """
+    return request.registry.queryUtility(IDirectoryMirror,
+                                         name=get_tenant_name(request) or '')
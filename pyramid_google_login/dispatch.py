@@ -0,0 +1,165 @@
+"""Deferred subscribers of the ``UserLoggedIn`` and ``UserLoggedOut`` events
+
+The subscribers registered with ``config.add_deferred_subscriber`` run on a
+pool of worker threads once the response is ready, out of the login
+latency. The regular subscribers still run inline (e.g. to set
+``event.headers``)::
+
+    config.add_deferred_subscriber(send_welcome_email, UserLoggedIn)
+
+The request of the event is finished when a deferred subscriber runs: the
+resources bound to it (e.g. a transaction) are not usable anymore.
+"""
+import logging
+import os
+import threading
+import time
+
+from six.moves import queue
+from zope.interface import Interface
+
+from pyramid_google_login import SETTINGS_PREFIX
+from pyramid_google_login.metrics import NULL_SINK, get_metrics_sink
+
+log = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ('inline', 'drop')
+
+
+class IDeferredDispatcher(Interface):
+    pass
+
+
+class DeferredDispatcher(object):
+    """Bounded queue of events, processed by ``workers`` threads
+
+    When the queue is full (backpressure), the event is processed in the
+    calling thread (``overflow = inline``) or dropped (``overflow = drop``).
+    """
+
+    def __init__(self, workers=2, queue_size=1000, overflow='inline',
+                 metrics=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Invalid overflow policy: %s' % overflow)
+        self.workers = workers
+        self.overflow = overflow
+        self.metrics = metrics or NULL_SINK
+        self.subscribers = []
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._workers_pid = None
+
+    def add_subscriber(self, subscriber, event_type):
+        self.subscribers.append((subscriber, event_type))
+
+    def subscribers_for(self, event):
+        subscribers = []
+        for subscriber, event_type in self.subscribers:
+            if isinstance(event_type, type):
+                matches = isinstance(event, event_type)
+            else:
+                matches = event_type.providedBy(event)
+            if matches:
+                subscribers.append(subscriber)
+        return subscribers
+
+    def defer(self, request, event):
+        """Dispatch the event once the request is finished"""
+        if self.subscribers_for(event):
+            request.add_finished_callback(lambda request: self.submit(event))
+
+    def submit(self, event):
+        subscribers = self.subscribers_for(event)
+        if not subscribers:
+            return
+
+        self._ensure_workers()
+        tags = {'event': type(event).__name__}
+        try:
+            self.queue.put_nowait((event, subscribers, time.time()))
+        except queue.Full:
+            if self.overflow == 'drop':
+                log.error('Deferred events queue full: %s dropped', event)
+                self.metrics.incr('events.dropped', tags=tags)
+                return
+            self.metrics.incr('events.inline', tags=tags)
+            self.run(event, subscribers)
+            return
+
+        self.metrics.incr('events.deferred', tags=tags)
+        self.metrics.gauge('events.queue_depth', self.queue.qsize())
+
+    def run(self, event, subscribers):
+        tags = {'event': type(event).__name__}
+        for subscriber in subscribers:
+            try:
+                with self.metrics.timer('events.duration', tags):
+                    subscriber(event)
+            except Exception:
+                log.exception('Deferred subscriber %r crashed processing %s',
+                              subscriber, event)
+                self.metrics.incr('events.failed', tags=tags)
+
+    def join(self):
+        """Wait for the processing of the queued events"""
+        self.queue.join()
+
+    def _ensure_workers(self):
+        if self._workers_pid == os.getpid():
+            return
+        with self._lock:
+            if self._workers_pid == os.getpid():
+                return
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self._work,
+                                          name='google-deferred-events')
+                thread.daemon = True
+                thread.start()
+            self._workers_pid = os.getpid()
+
+    def _work(self):
+        while True:
+            event, subscribers, queued_at = self.queue.get()
+            try:
+                self.metrics.timing('events.queue_latency',
+                                    time.time() - queued_at,
+                                    {'event': type(event).__name__})
+                self.run(event, subscribers)
+            finally:
+                self.queue.task_done()
+                self.metrics.gauge('events.queue_depth', self.queue.qsize())
+
+
+def add_deferred_subscriber(config, subscriber, iface):
+    """Directive: run the subscriber of the events of ``iface`` (a class or
+    an interface) after the response, on the worker threads
+    """
+    subscriber = config.maybe_dotted(subscriber)
+    iface = config.maybe_dotted(iface)
+
+    def register():
+        dispatcher = config.registry.getUtility(IDeferredDispatcher)
+        dispatcher.add_subscriber(subscriber, iface)
+
+    config.action(None, register)
+
+
+def includeme(config):
+    settings = config.registry.settings
+    prefix = SETTINGS_PREFIX
+
+    try:
+        dispatcher = DeferredDispatcher(
+            workers=int(settings.get(prefix + 'deferred_events_workers', 2)),
+            queue_size=int(
+                settings.get(prefix + 'deferred_events_queue_size', 1000)),
+            overflow=settings.get(prefix + 'deferred_events_overflow',
+                                  'inline'),
+            metrics=get_metrics_sink(config.registry),
+            )
+    except ValueError as err:
+        log.error('Invalid deferred events setting: %s', err)
+        raise
+
+    config.registry.registerUtility(dispatcher, provided=IDeferredDispatcher)
+    config.add_directive('add_deferred_subscriber', add_deferred_subscriber)
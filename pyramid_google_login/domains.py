@@ -0,0 +1,159 @@
+"""Allowlist of the hosted domains (Google Workspace) of the users
+
+The rules are exact domains (``example.com``) or wildcards matching all the
+subdomains of a domain (``*.example.com``, not ``example.com`` itself)::
+
+    security.google_login.hosted_domain =
+        example.com
+        acquired.example.net
+        *.partners.example.org
+    security.google_login.hosted_domain_file = /etc/myapp/domains.txt
+
+The exact domains are kept in a set, the wildcards in a trie of the labels
+in reverse order: a check costs the same with thousands of rules. The file
+(one rule per line, ``#`` comments) is reloaded when it changes.
+"""
+import logging
+import os
+import threading
+import time
+
+from pyramid.settings import aslist
+
+log = logging.getLogger(__name__)
+
+# Key of the trie nodes ending a wildcard rule (labels are never empty)
+WILDCARD_END = ''
+
+
+class DomainMatcher(object):
+    """Exact domains in a set, wildcard rules in a suffix trie"""
+
+    def __init__(self, rules=()):
+        self.domains = set()
+        self.trie = {}
+        self.wildcards = 0
+        for rule in rules:
+            self.add(rule)
+
+    def __len__(self):
+        return len(self.domains) + self.wildcards
+
+    def add(self, rule):
+        rule = rule.strip().lower().rstrip('.')
+        if rule.startswith('*.'):
+            node = self.trie
+            for label in reversed(rule[2:].split('.')):
+                if not label:
+                    raise ValueError('Invalid domain rule: %s' % rule)
+                node = node.setdefault(label, {})
+            if WILDCARD_END not in node:
+                node[WILDCARD_END] = True
+                self.wildcards += 1
+        elif rule and '*' not in rule:
+            self.domains.add(rule)
+        else:
+            raise ValueError('Invalid domain rule: %s' % rule)
+
+    def __contains__(self, domain):
+        domain = domain.lower()
+        if domain in self.domains:
+            return True
+
+        node = self.trie
+        labels = domain.split('.')
+        # A wildcard matches one label at least
+        for label in reversed(labels[1:]):
+            node = node.get(label)
+            if node is None:
+                return False
+            if WILDCARD_END in node:
+                return True
+        return False
+
+
+def rules_from_lines(lines):
+    for line in lines:
+        rule = line.split('#', 1)[0].strip()
+        if rule:
+            yield rule
+
+
+class FileDomainMatcher(object):
+    """Rules of the settings plus the rules of a file, reloaded (at most
+    every ``reload_interval`` seconds) when the file changes
+
+    The previous rules are kept while the file is unreadable or invalid.
+    """
+
+    def __init__(self, path, rules=(), reload_interval=10):
+        self.path = path
+        self.rules = list(rules)
+        self.reload_interval = reload_interval
+        self.matcher = DomainMatcher(self.rules)
+        self.mtime = None
+        self.checked_at = 0
+        self._lock = threading.Lock()
+        self.reload()
+
+    def __len__(self):
+        return len(self.matcher)
+
+    def __contains__(self, domain):
+        if time.time() - self.checked_at >= self.reload_interval:
+            self.maybe_reload()
+        return domain in self.matcher
+
+    def maybe_reload(self):
+        # A single thread checks, the others use the current rules
+        if not self._lock.acquire(False):
+            return
+        try:
+            self.checked_at = time.time()
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError as err:
+                log.error('Failed to check the hosted domains file: %s', err)
+                return
+            if mtime != self.mtime:
+                self.reload()
+        finally:
+            self._lock.release()
+
+    def reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+            with open(self.path) as fd:
+                rules = self.rules + list(rules_from_lines(fd))
+            matcher = DomainMatcher(rules)
+        except (OSError, IOError, ValueError) as err:
+            log.error('Failed to load the hosted domains file: %s', err)
+            if self.mtime is None:
+                raise
+            return
+        # Replaced at once: the concurrent checks see the old or new rules
+        self.matcher = matcher
+        self.mtime = mtime
+        self.checked_at = time.time()
+        log.info('Loaded %d hosted domain rules from %s', len(matcher),
+                 self.path)
+
+
+def hosted_domains_from_settings(settings, prefix):
+    """Return the single hosted domain (or None) and the matcher of the
+    allowlist (None when the allowlist is a single exact domain or empty)
+    """
+    rules = aslist(settings.get(prefix + 'hosted_domain', ''))
+    path = settings.get(prefix + 'hosted_domain_file')
+
+    if not path:
+        if not rules:
+            return None, None
+        if len(rules) == 1 and '*' not in rules[0]:
+            return rules[0], None
+        return None, DomainMatcher(rules)
+
+    return None, FileDomainMatcher(
+        path, rules,
+        reload_interval=float(
+            settings.get(prefix + 'hosted_domain_reload_interval', 10)))
@@ -13,5 +13,6 @@ class UserLoggedIn(Event):
 
 
 class UserLoggedOut(Event):
-    def __init__(self, userid):
+    def __init__(self, userid, request=None):
+        self.request = request
         self.userid = userid
@@ -9,3 +9,7 @@ class AuthFailed(Base):
 
 class ApiError(Base):
     pass
+
+
+class TransportError(Base):
+    """The call to Google was not made (e.g. circuit breaker, rate limit)"""
@@ -0,0 +1,306 @@
+"""Google Groups of the users as Pyramid principals
+
+The groups of a user are fetched at login (Admin Directory API) and cached
+per user, the principals are then resolved by a dict lookup::
+
+    from pyramid_google_login.groups import groups_finder
+
+    authn_policy = AuthTktAuthenticationPolicy(secret, callback=groups_finder)
+
+The entries older than ``groups_ttl`` are still used while they are
+refreshed in background, by Google batch requests of ``groups_batch_size``
+users. Google is never called on the request path: on a cache miss, the
+request has no group principals and the groups are loaded in background. A
+failed lookup is cached for ``groups_negative_ttl`` seconds (no principals,
+or the previous ones), not to call Google on every request.
+
+With tenants, a tenant has its own resolver when it sets its own
+``tenant.<name>.groups`` and ``groups_refresh_token``. The users of a tenant
+without resolver have no group principals.
+"""
+from collections import namedtuple
+import logging
+import os
+import threading
+import time
+
+from pyramid.settings import asbool
+from zope.interface import Interface
+
+from pyramid_google_login import SETTINGS_PREFIX
+from pyramid_google_login.cache import LRUCache
+from pyramid_google_login.events import UserLoggedIn
+from pyramid_google_login.metrics import NULL_SINK, get_metrics_sink
+from pyramid_google_login.tenants import (get_tenant_name, tenant_names,
+                                          tenant_settings)
+from pyramid_google_login.transport import SingleFlight, imap_bounded
+from pyramid_google_login.utility import new_api_client_from_registry
+
+log = logging.getLogger(__name__)
+
+GroupsEntry = namedtuple('GroupsEntry', 'principals refresh_at expires_at')
+
+
+class IGroupsResolver(Interface):
+    pass
+
+
+class GroupsResolver(object):
+    """Principals of the users, from their Google Groups
+
+    An entry is refreshed in background after ``ttl`` seconds, and dropped
+    ``max_stale`` seconds later (when it could not be refreshed). The
+    background lookups are made by batches of ``batch_size`` users, with
+    ``concurrency`` batches in flight.
+    """
+
+    def __init__(self, registry, refresh_token, ttl=600, negative_ttl=60,
+                 max_stale=86400, maxsize=10000, batch_size=50,
+                 concurrency=4, principal_prefix='group:', metrics=None,
+                 tenant=None):
+        self.registry = registry
+        self.tenant = tenant
+        self.refresh_token = refresh_token
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_stale = max_stale
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.principal_prefix = principal_prefix
+        self.metrics = metrics or NULL_SINK
+
+        self.cache = LRUCache(maxsize=maxsize)
+        self.flights = SingleFlight()
+        self.pending = set()
+        self._access_token = None
+        self._token_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def principals(self, userid):
+        """Principals of the groups of the user, without calling Google
+
+        On a cache miss, the groups are loaded in background: no
+        principals until then.
+        """
+        entry = self.cache.get(userid)
+        if entry is None:
+            self.schedule(userid)
+            self.metrics.incr('groups.misses')
+            return ()
+        if entry.refresh_at <= time.time():
+            self.schedule(userid)
+        return entry.principals
+
+    def load(self, userid):
+        """Fetch the groups of the user now, return the new entry"""
+        return self.flights.do(userid, self._load, userid)
+
+    def resolve_many(self, userids):
+        """Fetch the groups of many users by batches of ``batch_size`` (one
+        Google batch request each), ``concurrency`` batches at a time,
+        return their principals by userid
+        """
+        userids = list(userids)
+        batches = [userids[start:start + self.batch_size]
+                   for start in range(0, len(userids), self.batch_size)]
+        principals = {}
+        for entries in imap_bounded(self._load_batch, batches,
+                                    self.concurrency):
+            for userid, entry in entries:
+                principals[userid] = entry.principals
+        return principals
+
+    def forget(self, userid):
+        self.cache.delete(userid)
+
+    def schedule(self, userid):
+        """Refresh the groups of the user in background"""
+        if userid in self.pending or self.flights.in_flight(userid):
+            return
+        with self._lock:
+            self.pending.add(userid)
+        self.ensure_started()
+        self._wakeup.set()
+
+    def ensure_started(self):
+        """Start the refresh thread (once per process)"""
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run,
+                                            name='google-groups-refresh')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self):
+        return dict(self.cache.stats(), pending=len(self.pending))
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            if self._stop.is_set():
+                return
+            self._wakeup.clear()
+
+            with self._lock:
+                userids, self.pending = list(self.pending), set()
+            try:
+                self.resolve_many(userids)
+            except Exception:
+                log.exception('Failed to refresh the Google groups')
+            self.metrics.incr('groups.refreshes', len(userids))
+
+    def _load(self, userid):
+        try:
+            api = new_api_client_from_registry(self.registry, self.tenant)
+            groups = api.get_user_groups(self.get_access_token(api), userid)
+        except Exception as err:
+            return self._store(userid, None, err)
+        return self._store(userid, groups)
+
+    def _load_batch(self, userids):
+        """Fetch the groups of the users in a batch request, return the
+        ``(userid, entry)`` pairs
+        """
+        try:
+            api = new_api_client_from_registry(self.registry, self.tenant)
+            results = list(api.get_users_groups(
+                self.get_access_token(api), userids,
+                batch_size=self.batch_size))
+        except Exception as err:
+            return [(userid, self._store(userid, None, err))
+                    for userid in userids]
+        return [(result.key, self._store(result.key, result.result,
+                                         result.error))
+                for result in results]
+
+    def _store(self, userid, groups, error=None):
+        """Cache the groups of the user (or the failure of their lookup),
+        return the new entry
+        """
+        now = time.time()
+        if error is not None:
+            log.warning('Failed to get the Google groups of %s: %s', userid,
+                        error)
+            self.metrics.incr('groups.errors')
+            previous = self.cache.get(userid)
+            if previous is not None and previous.expires_at > now:
+                # Keep the previous groups, retry later
+                entry = previous._replace(
+                    refresh_at=now + self.negative_ttl)
+            else:
+                entry = GroupsEntry((), now + self.negative_ttl,
+                                    now + self.negative_ttl)
+        else:
+            self.metrics.incr('groups.fetches')
+            entry = GroupsEntry(
+                tuple(self.principal_prefix + group.lower()
+                      for group in sorted(groups)),
+                now + self.ttl,
+                now + self.ttl + self.max_stale)
+
+        self.cache.set(userid, entry, ttl=entry.expires_at - now)
+        return entry
+
+    def get_access_token(self, api):
+        """Access token of ``refresh_token``, refreshed when expired"""
+        with self._token_lock:
+            if (self._access_token is None or
+                    self._access_token[1] <= time.time() + 60):
+                oauth2_tokens = api.refresh_access_token(self.refresh_token)
+                self._access_token = (
+                    oauth2_tokens['access_token'],
+                    time.time() + int(oauth2_tokens.get('expires_in', 3600)))
+            return self._access_token[0]
+
+
+def fetch_groups_at_login(event):
+    resolver = query_groups_resolver(event.request)
+    if resolver is not None:
+        resolver.load(event.userid)
+
+
+def groups_finder(userid, request):
+    """Callback of the authentication policies"""
+    resolver = query_groups_resolver(request)
+    if resolver is None:
+        return []
+    return list(resolver.principals(userid))
+
+
+def includeme(config):
+    settings = config.registry.settings
+    prefix = SETTINGS_PREFIX
+    metrics = get_metrics_sink(config.registry)
+
+    resolvers = [groups_resolver_from_settings(config.registry, settings,
+                                               prefix, metrics)]
+    for name in tenant_names(settings, prefix):
+        resolvers.append(groups_resolver_from_settings(
+            config.registry, tenant_settings(settings, prefix, name), prefix,
+            metrics, tenant=name))
+
+    resolvers = [resolver for resolver in resolvers if resolver is not None]
+    if not resolvers:
+        return
+
+    for resolver in resolvers:
+        config.registry.registerUtility(resolver, provided=IGroupsResolver,
+                                        name=resolver.tenant or '')
+    config.add_request_method(get_groups_resolver, 'google_groups',
+                              reify=True)
+    config.add_deferred_subscriber(fetch_groups_at_login, UserLoggedIn)
+
+
+def groups_resolver_from_settings(registry, settings, prefix, metrics,
+                                  tenant=None):
+    """Build the :class:`GroupsResolver` of the settings (or None)"""
+    if not asbool(settings.get(prefix + 'groups', False)):
+        return None
+
+    try:
+        return GroupsResolver(
+            registry,
+            refresh_token=settings[prefix + 'groups_refresh_token'],
+            ttl=int(settings.get(prefix + 'groups_ttl', 600)),
+            negative_ttl=int(settings.get(prefix + 'groups_negative_ttl',
+                                          60)),
+            max_stale=int(settings.get(prefix + 'groups_max_stale', 86400)),
+            maxsize=int(settings.get(prefix + 'groups_cache_maxsize', 10000)),
+            batch_size=int(settings.get(prefix + 'groups_batch_size', 50)),
+            concurrency=int(settings.get(prefix + 'groups_concurrency', 4)),
+            principal_prefix=settings.get(prefix + 'groups_principal_prefix',
+                                          'group:'),
+            metrics=metrics,
+            tenant=tenant,
+            )
+    except (KeyError, ValueError) as err:
+        log.error('Invalid groups setting: %s', err)
+        raise
+
+
+def query_groups_resolver(request):
+    """Resolver of the tenant of the request, or None"""
+    return request.registry.queryUtility(
+        IGroupsResolver, name=get_tenant_name(request) or '')
+
+
+def get_groups_resolver(request):
+    """Resolver of the tenant of the request"""
+    return request.registry.getUtility(IGroupsResolver,
+                                       name=get_tenant_name(request) or '')
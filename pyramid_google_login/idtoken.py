@@ -0,0 +1,181 @@
+"""Local verification of the OpenID Connect id_token issued by Google
+
+-> https://developers.google.com/identity/protocols/OpenIDConnect
+
+The RSA signatures are verified by ``cryptography`` when it is installed
+(``pip install pyramid_google_login[crypto]``, constant time and much
+faster). Without it, a pure Python implementation is used: correct, but
+slower and not hardened against timing side channels.
+"""
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import time
+
+import six
+
+from pyramid_google_login.exceptions import AuthFailed
+
+ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+
+# DER encoded DigestInfo prefix for SHA-256 (RFC 3447, section 9.2)
+SHA256_DIGEST_INFO = binascii.unhexlify(
+    '3031300d060960864801650304020105000420')
+
+# Userinfo fields (oauth2/v2/userinfo) as found in the id_token claims
+USERINFO_CLAIMS = {
+    'id': 'sub',
+    'email': 'email',
+    'verified_email': 'email_verified',
+    'hd': 'hd',
+    'name': 'name',
+    'given_name': 'given_name',
+    'family_name': 'family_name',
+    'picture': 'picture',
+    'locale': 'locale',
+}
+
+
+def b64url_decode(data):
+    if isinstance(data, six.text_type):
+        data = data.encode('ascii')
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+def b64url_to_int(data):
+    return int(binascii.hexlify(b64url_decode(data)), 16)
+
+
+def load_crypto_key(n, e):
+    """``cryptography`` public key of ``n`` and ``e``, or None when
+    ``cryptography`` is not installed
+    """
+    try:
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives.asymmetric.rsa import (
+            RSAPublicNumbers)
+    except ImportError:
+        return None
+    return RSAPublicNumbers(e, n).public_key(default_backend())
+
+
+def crypto_verify(crypto_key, message, signature):
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import padding
+
+    try:
+        crypto_key.verify(signature, message, padding.PKCS1v15(),
+                          hashes.SHA256())
+    except InvalidSignature:
+        return False
+    return True
+
+
+class RsaPublicKey(object):
+    """RSA public key verifying RSASSA-PKCS1-v1_5 SHA-256 signatures
+
+    With ``cryptography`` when installed (unless ``use_cryptography`` is
+    False), in pure Python otherwise.
+    """
+
+    def __init__(self, n, e, use_cryptography=True):
+        self.n = n
+        self.e = e
+        self.size = (n.bit_length() + 7) // 8
+        self.crypto_key = load_crypto_key(n, e) if use_cryptography else None
+
+    @classmethod
+    def from_jwk(cls, jwk):
+        return cls(b64url_to_int(jwk['n']), b64url_to_int(jwk['e']))
+
+    def verify(self, message, signature):
+        if len(signature) != self.size:
+            return False
+        if self.crypto_key is not None:
+            return crypto_verify(self.crypto_key, message, signature)
+        return self.verify_python(message, signature)
+
+    def verify_python(self, message, signature):
+        """Pure Python verification, the fallback without cryptography"""
+        if len(signature) != self.size:
+            return False
+
+        s = int(binascii.hexlify(signature), 16)
+        if s >= self.n:
+            return False
+
+        m = pow(s, self.e, self.n)
+        encoded = binascii.unhexlify('%0*x' % (self.size * 2, m))
+
+        digest_info = SHA256_DIGEST_INFO + hashlib.sha256(message).digest()
+        padding = self.size - len(digest_info) - 3
+        if padding < 8:
+            return False
+        expected = b'\x00\x01' + b'\xff' * padding + b'\x00' + digest_info
+
+        return hmac.compare_digest(encoded, expected)
+
+
+def decode_id_token(id_token, get_key, audience, now=None, leeway=60):
+    """Verify the signature and the claims of an id_token, return the claims
+
+    ``get_key`` is called with the ``kid`` of the token header and must return
+    a :class:`RsaPublicKey` (or None when the key is unknown).
+    """
+    if isinstance(id_token, six.text_type):
+        id_token = id_token.encode('ascii')
+
+    try:
+        signing_input, signature = id_token.rsplit(b'.', 1)
+        header, payload = signing_input.split(b'.')
+        header = json.loads(b64url_decode(header).decode('utf-8'))
+        claims = json.loads(b64url_decode(payload).decode('utf-8'))
+        signature = b64url_decode(signature)
+    except (ValueError, TypeError, binascii.Error):
+        raise AuthFailed('Malformed id_token')
+
+    if not isinstance(header, dict) or not isinstance(claims, dict):
+        raise AuthFailed('Malformed id_token')
+
+    if header.get('alg') != 'RS256':
+        raise AuthFailed('Unsupported id_token algorithm')
+
+    key = get_key(header.get('kid'))
+    if key is None:
+        raise AuthFailed('Unknown id_token signing key')
+
+    if not key.verify(signing_input, signature):
+        raise AuthFailed('Invalid id_token signature')
+
+    if now is None:
+        now = time.time()
+
+    if claims.get('iss') not in ISSUERS:
+        raise AuthFailed('Invalid id_token issuer')
+
+    if claims.get('aud') != audience:
+        raise AuthFailed('Invalid id_token audience')
+
+    try:
+        expires_at = float(claims['exp'])
+        issued_at = float(claims.get('iat', 0))
+    except (KeyError, TypeError, ValueError):
+        raise AuthFailed('Invalid id_token timestamps')
+
+    if expires_at + leeway < now:
+        raise AuthFailed('Expired id_token')
+
+    if issued_at - leeway > now:
+        raise AuthFailed('id_token issued in the future')
+
+    return claims
+
+
+def userinfo_from_claims(claims):
+    """Build a dict shaped like the userinfo endpoint response"""
+    return dict((field, claims[claim])
+                for field, claim in USERINFO_CLAIMS.items()
+                if claim in claims)
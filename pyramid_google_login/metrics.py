@@ -0,0 +1,301 @@
+"""Metrics of the login flow and of the calls to Google
+
+The metrics are sent to the sinks listed by ``metrics_sinks``:
+
+- ``logging``: log lines on the ``pyramid_google_login.metrics`` logger
+- ``statsd``: StatsD over UDP (tags in the DogStatsD format)
+- ``prometheus``: aggregated in memory, exposed in the Prometheus text format
+  at ``metrics_prometheus_path``
+"""
+from contextlib import contextmanager
+import logging
+import socket
+import threading
+import time
+
+from six.moves.urllib import parse
+from pyramid.exceptions import ConfigurationError
+from pyramid.response import Response
+from pyramid.settings import aslist
+from zope.interface import Interface
+
+from pyramid_google_login import SETTINGS_PREFIX
+
+log = logging.getLogger(__name__)
+
+# Default permission of the Prometheus view
+METRICS_PERMISSION = 'google_login.metrics'
+
+# Seconds
+TIMING_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class IMetricsSink(Interface):
+    pass
+
+
+class MetricsSink(object):
+    """Base sink: discard everything"""
+
+    def __init__(self, prefix='google_login'):
+        self.prefix = prefix
+
+    def name(self, name):
+        return '%s.%s' % (self.prefix, name) if self.prefix else name
+
+    def incr(self, name, value=1, tags=None):
+        pass
+
+    def gauge(self, name, value, tags=None):
+        pass
+
+    def timing(self, name, seconds, tags=None):
+        pass
+
+    @contextmanager
+    def timer(self, name, tags=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.timing(name, time.time() - start, tags)
+
+
+class LoggingSink(MetricsSink):
+
+    def _log(self, kind, name, value, tags):
+        log.info('%s %s=%s %s', kind, self.name(name), value,
+                 ' '.join('%s=%s' % item for item in sorted((tags or {})
+                                                            .items())))
+
+    def incr(self, name, value=1, tags=None):
+        self._log('counter', name, value, tags)
+
+    def gauge(self, name, value, tags=None):
+        self._log('gauge', name, value, tags)
+
+    def timing(self, name, seconds, tags=None):
+        self._log('timing', name, '%.1fms' % (seconds * 1000), tags)
+
+
+class StatsdSink(MetricsSink):
+
+    def __init__(self, host='127.0.0.1', port=8125, **kwargs):
+        super(StatsdSink, self).__init__(**kwargs)
+        self.address = (host, port)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, name, value, kind, tags):
+        line = '%s:%s|%s' % (self.name(name), value, kind)
+        if tags:
+            line += '|#' + ','.join('%s:%s' % item
+                                    for item in sorted(tags.items()))
+        try:
+            self._socket.sendto(line.encode('utf-8'), self.address)
+        except socket.error:
+            log.debug('Failed to send metric %s', line, exc_info=True)
+
+    def incr(self, name, value=1, tags=None):
+        self._send(name, value, 'c', tags)
+
+    def gauge(self, name, value, tags=None):
+        self._send(name, value, 'g', tags)
+
+    def timing(self, name, seconds, tags=None):
+        self._send(name, int(round(seconds * 1000)), 'ms', tags)
+
+
+class PrometheusSink(MetricsSink):
+    """Aggregate the metrics of the process for the Prometheus scraper"""
+
+    def __init__(self, buckets=TIMING_BUCKETS, **kwargs):
+        super(PrometheusSink, self).__init__(**kwargs)
+        self.buckets = buckets
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def key(self, name, tags):
+        name = self.name(name).replace('.', '_').replace('-', '_')
+        return name, tuple(sorted((key, str(value))
+                                  for key, value in (tags or {}).items()))
+
+    def incr(self, name, value=1, tags=None):
+        key = self.key(name, tags)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, tags=None):
+        with self._lock:
+            self.gauges[self.key(name, tags)] = value
+
+    def timing(self, name, seconds, tags=None):
+        key = self.key(name, tags)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [
+                    [0] * len(self.buckets), 0, 0.0]
+            counts = histogram[0]
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    counts[index] += 1
+            histogram[1] += 1
+            histogram[2] += seconds
+
+    @staticmethod
+    def labels(labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ''
+        return '{%s}' % ','.join(
+            '%s="%s"' % (key, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"'))
+            for key, value in labels)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+            histograms = sorted((key, (list(h[0]), h[1], h[2]))
+                                for key, h in self.histograms.items())
+
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s %s' % (name, kind))
+
+        for (name, labels), value in counters:
+            declare(name + '_total', 'counter')
+            lines.append('%s_total%s %s' % (name, self.labels(labels), value))
+
+        for (name, labels), value in gauges:
+            declare(name, 'gauge')
+            lines.append('%s%s %s' % (name, self.labels(labels), value))
+
+        for (name, labels), (counts, count, total) in histograms:
+            name += '_seconds'
+            declare(name, 'histogram')
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append('%s_bucket%s %s' % (
+                    name, self.labels(labels, [('le', bound)]),
+                    bucket_count))
+            lines.append('%s_bucket%s %s' % (
+                name, self.labels(labels, [('le', '+Inf')]), count))
+            lines.append('%s_sum%s %s' % (name, self.labels(labels), total))
+            lines.append('%s_count%s %s' % (name, self.labels(labels), count))
+
+        return '\n'.join(lines) + '\n'
+
+
+class MultiSink(MetricsSink):
+
+    def __init__(self, sinks):
+        super(MultiSink, self).__init__()
+        self.sinks = sinks
+
+    def incr(self, name, value=1, tags=None):
+        for sink in self.sinks:
+            sink.incr(name, value, tags)
+
+    def gauge(self, name, value, tags=None):
+        for sink in self.sinks:
+            sink.gauge(name, value, tags)
+
+    def timing(self, name, seconds, tags=None):
+        for sink in self.sinks:
+            sink.timing(name, seconds, tags)
+
+
+class PhaseTimer(object):
+    """Time the consecutive phases of a flow, remember the current one"""
+
+    def __init__(self, sink, name):
+        self.sink = sink
+        self.name = name
+        self.phase = None
+
+    @contextmanager
+    def __call__(self, phase):
+        self.phase = phase
+        with self.sink.timer(self.name, {'phase': phase}):
+            yield
+
+
+def record_http_call(sink, method, url, status, seconds):
+    """Count the responses of an endpoint by status (``error`` if none)"""
+    url = parse.urlsplit(url)
+    tags = {'method': method, 'endpoint': url.netloc + url.path}
+    sink.timing('http.duration', seconds, tags)
+    sink.incr('http.responses', tags=dict(tags, status=status))
+
+
+NULL_SINK = MetricsSink()
+
+
+def get_metrics_sink(registry):
+    return registry.queryUtility(IMetricsSink, default=NULL_SINK)
+
+
+def find_sink(sink, sink_class):
+    """Return the sink of this class (possibly within a MultiSink)"""
+    for candidate in getattr(sink, 'sinks', [sink]):
+        if isinstance(candidate, sink_class):
+            return candidate
+    return None
+
+
+def prometheus_view(request):
+    sink = find_sink(request.registry.getUtility(IMetricsSink),
+                     PrometheusSink)
+    response = Response(sink.render(), content_type='text/plain',
+                        charset='utf-8')
+    response.cache_control.no_store = True
+    return response
+
+
+def includeme(config):
+    settings = config.registry.settings
+    prefix = SETTINGS_PREFIX
+    metrics_prefix = settings.get(prefix + 'metrics_prefix', 'google_login')
+
+    sinks = []
+    for name in aslist(settings.get(prefix + 'metrics_sinks', '')):
+        if name == 'logging':
+            sinks.append(LoggingSink(prefix=metrics_prefix))
+        elif name == 'statsd':
+            sinks.append(StatsdSink(
+                host=settings.get(prefix + 'metrics_statsd_host',
+                                  '127.0.0.1'),
+                port=int(settings.get(prefix + 'metrics_statsd_port', 8125)),
+                prefix=metrics_prefix))
+        elif name == 'prometheus':
+            sinks.append(PrometheusSink(prefix=metrics_prefix))
+        else:
+            raise ConfigurationError(
+                'Invalid %smetrics_sinks: %s' % (prefix, name))
+
+    if not sinks:
+        sink = MetricsSink(prefix=metrics_prefix)
+    elif len(sinks) == 1:
+        sink = sinks[0]
+    else:
+        sink = MultiSink(sinks)
+
+    config.registry.registerUtility(sink, provided=IMetricsSink)
+
+    path = settings.get(prefix + 'metrics_prometheus_path')
+    if path:
+        if find_sink(sink, PrometheusSink) is None:
+            raise ConfigurationError(
+                '%smetrics_prometheus_path requires the prometheus sink'
+                % prefix)
+        config.add_route('auth_metrics', path)
+        config.add_view(prometheus_view, route_name='auth_metrics',
+                        permission=settings.get(
+                            prefix + 'metrics_prometheus_permission',
+                            METRICS_PERMISSION))
@@ -0,0 +1,236 @@
+"""Client-side rate limiting of the calls to Google
+
+Configured per endpoint name (``token``, ``userinfo``, ``certs``,
+``directory``), the calls wait for their turn rather than exceeding the
+quotas of the Google project. A ``Retry-After`` answered by Google pauses
+the endpoint for all the callers.
+"""
+from contextlib import contextmanager
+import email.utils
+import logging
+import os
+import struct
+import threading
+import time
+
+from zope.interface import Interface
+
+from pyramid_google_login.exceptions import TransportError
+from pyramid_google_login.metrics import NULL_SINK
+
+log = logging.getLogger(__name__)
+
+
+class IRateLimiter(Interface):
+    pass
+
+
+class RateLimitedError(TransportError):
+    """The call would have waited too long for the rate limit"""
+
+
+class TokenBucket(object):
+    """Allow ``rate`` calls per second on average, bursts of ``burst`` calls
+
+    The callers are served in order: a caller reserves its token (possibly
+    in the future) then waits for it outside of the lock.
+    """
+
+    def __init__(self, rate, burst=1):
+        if rate <= 0:
+            raise ValueError('Invalid rate: %s' % rate)
+        self.rate = float(rate)
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated_at = time.time()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            yield
+
+    def reserve(self, tokens=1):
+        """Take the tokens, return the seconds to wait before using them"""
+        with self._locked():
+            now = time.time()
+            if now > self.updated_at:
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.updated_at) * self.rate)
+                self.updated_at = now
+            self.tokens -= tokens
+            # The bucket refills from updated_at (in the future if paused)
+            return (self.updated_at - now) + max(-self.tokens, 0) / self.rate
+
+    def release(self, tokens=1):
+        """Give back reserved tokens which won't be used"""
+        with self._locked():
+            self.tokens += tokens
+
+    def pause(self, seconds):
+        """Hold the calls for some seconds (e.g. ``Retry-After``)"""
+        with self._locked():
+            self.updated_at = max(self.updated_at, time.time() + seconds)
+            self.tokens = min(self.tokens, 1)
+
+    def acquire(self, tokens=1):
+        """Wait for the tokens, return the seconds waited"""
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class FileTokenBucket(TokenBucket):
+    """Token bucket shared by the processes of a host
+
+    The state of the bucket is kept in a file, locked (flock) while updated.
+    """
+    state_format = struct.Struct('>dd')
+
+    def __init__(self, path, rate, burst=1):
+        import fcntl
+        super(FileTokenBucket, self).__init__(rate, burst)
+        self._fcntl = fcntl
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        open(path, 'ab').close()
+
+    @contextmanager
+    def _locked(self):
+        with self._lock:
+            with open(self.path, 'r+b') as fd:
+                self._fcntl.flock(fd, self._fcntl.LOCK_EX)
+                try:
+                    data = fd.read(self.state_format.size)
+                    if len(data) == self.state_format.size:
+                        self.tokens, self.updated_at = (
+                            self.state_format.unpack(data))
+                    yield
+                    fd.seek(0)
+                    fd.write(self.state_format.pack(self.tokens,
+                                                    self.updated_at))
+                    fd.flush()
+                finally:
+                    self._fcntl.flock(fd, self._fcntl.LOCK_UN)
+
+
+class RateLimiter(object):
+    """Token buckets of the endpoints, with quota usage counters
+
+    A call which would wait more than ``max_wait`` seconds fails with
+    :class:`RateLimitedError`. The endpoints without bucket are unlimited.
+    """
+
+    def __init__(self, buckets, max_wait=10, metrics=None):
+        self.buckets = buckets
+        self.max_wait = max_wait
+        self.metrics = metrics or NULL_SINK
+        self.counters = dict((endpoint, self.new_counters())
+                             for endpoint in buckets)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def new_counters():
+        return {'calls': 0, 'throttled': 0, 'rejected': 0,
+                'waited': 0.0, 'retry_after': 0}
+
+    def _count(self, endpoint, name, value=1):
+        with self._lock:
+            self.counters[endpoint][name] += value
+
+    def reserve(self, endpoint):
+        """Return the seconds to wait before calling the endpoint"""
+        bucket = self.buckets.get(endpoint)
+        if bucket is None:
+            return 0
+
+        wait = bucket.reserve()
+        tags = {'endpoint': endpoint}
+        if wait > self.max_wait:
+            bucket.release()
+            self._count(endpoint, 'rejected')
+            self.metrics.incr('ratelimit.rejected', tags=tags)
+            raise RateLimitedError('Rate limit of the %s endpoint exceeded'
+                                   % endpoint)
+
+        self._count(endpoint, 'calls')
+        self.metrics.incr('quota.calls', tags=tags)
+        if wait > 0:
+            self._count(endpoint, 'throttled')
+            self._count(endpoint, 'waited', wait)
+            self.metrics.timing('ratelimit.wait', wait, tags)
+        return wait
+
+    def acquire(self, endpoint):
+        wait = self.reserve(endpoint)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def retry_after(self, endpoint, seconds):
+        """Pause the endpoint, return False if it is not rate limited"""
+        bucket = self.buckets.get(endpoint)
+        if bucket is None:
+            return False
+        log.warning('Google asked to retry the %s endpoint after %ss',
+                    endpoint, seconds)
+        bucket.pause(seconds)
+        self._count(endpoint, 'retry_after')
+        self.metrics.incr('ratelimit.retry_after',
+                          tags={'endpoint': endpoint})
+        return True
+
+    def stats(self):
+        with self._lock:
+            return dict((endpoint, dict(counters))
+                        for endpoint, counters in self.counters.items())
+
+
+def parse_retry_after(headers):
+    """Seconds to wait from a ``Retry-After`` header (or None)"""
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_tz(value)
+    except (TypeError, ValueError):
+        return None
+    if date is None:
+        return None
+    return max(email.utils.mktime_tz(date) - time.time(), 0)
+
+
+def rate_limiter_from_settings(settings, prefix, endpoints, metrics=None):
+    """Build the rate limiter of the ``ratelimit_<endpoint>`` settings
+    (``"rate burst"``), or None if no endpoint is limited
+    """
+    path = settings.get(prefix + 'ratelimit_path')
+    buckets = {}
+    for endpoint in endpoints:
+        value = settings.get(prefix + 'ratelimit_' + endpoint)
+        if not value:
+            continue
+        values = value.split()
+        if len(values) > 2:
+            raise ValueError('Invalid rate limit: %s' % value)
+        rate = float(values[0])
+        burst = int(values[1]) if len(values) > 1 else 1
+        if path:
+            buckets[endpoint] = FileTokenBucket(
+                os.path.join(path, endpoint + '.bucket'), rate, burst)
+        else:
+            buckets[endpoint] = TokenBucket(rate, burst)
+
+    if not buckets:
+        return None
+    return RateLimiter(
+        buckets,
+        max_wait=float(settings.get(prefix + 'ratelimit_max_wait', 10)),
+        metrics=metrics)
@@ -0,0 +1,120 @@
+"""Silent re-authentication of the returning users
+
+At login, a long-lived signed cookie remembers the userid (sent to the sign
+in page only). When the session of the application has expired, the sign in
+page logs the returning user in again without showing the page:
+
+- ``silent_reauth = token``: the access token of the user is refreshed
+  server-side with the refresh token of the token store, in the same request
+  (requires ``access_type = offline``).
+- ``silent_reauth = prompt_none``: the user is sent to Google with
+  ``prompt=none``: Google answers at once if the user is still signed in
+  (no consent screen), otherwise the sign in page is shown.
+
+The cookie is deleted at logout and when the re-authentication fails. It is
+not extended by the ``token`` re-authentications: they stop
+``silent_reauth_max_age`` seconds after the last login through Google.
+"""
+import logging
+
+from pyramid.exceptions import ConfigurationError
+from zope.interface import Interface
+
+from pyramid_google_login import SETTINGS_PREFIX
+from pyramid_google_login.exceptions import AuthFailed
+from pyramid_google_login.state import StateSerializer, secrets_from_settings
+from pyramid_google_login.tenants import get_tenant_name
+
+log = logging.getLogger(__name__)
+
+COOKIE_NAME = 'google_login_user'
+SILENT_REAUTH_MODES = ('off', 'token', 'prompt_none')
+
+# Errors of an authorize call with prompt=none: the user must interact
+SILENT_ERRORS = frozenset(['login_required', 'interaction_required',
+                           'consent_required', 'account_selection_required'])
+
+
+class ISilentReauth(Interface):
+    pass
+
+
+class SilentReauth(object):
+    """Remember the returning users and log them in again"""
+
+    def __init__(self, mode, serializer):
+        if mode not in SILENT_REAUTH_MODES[1:]:
+            raise ValueError('Invalid silent_reauth: %s' % mode)
+        self.mode = mode
+        self.serializer = serializer
+
+    def remember_user(self, request, response, userid):
+        value, _ = self.serializer.dumps(userid)
+        response.set_cookie(COOKIE_NAME, value,
+                            max_age=self.serializer.max_age,
+                            path=request.route_path('auth_signin'),
+                            secure=request.scheme == 'https',
+                            httponly=True,
+                            samesite='Lax')
+
+    def forget_user(self, request, response):
+        response.delete_cookie(COOKIE_NAME,
+                               path=request.route_path('auth_signin'))
+
+    def returning_userid(self, request):
+        """Userid of the cookie, or None if missing, forged or expired"""
+        value = request.cookies.get(COOKIE_NAME)
+        if not value:
+            return None
+        try:
+            userid, _ = self.serializer.loads(value)
+        except AuthFailed as err:
+            log.info('Ignore returning user cookie (%s)', err)
+            return None
+        return userid
+
+    def refresh(self, request, userid):
+        """Refresh the tokens of the user, return them with its userinfo
+
+        A single call to Google when the userinfo is read from the id_token.
+        The new tokens are saved by the login, once the user is checked.
+        """
+        tenant = get_tenant_name(request)
+        tokens = request.google_tokens.get(userid, tenant=tenant)
+        if not tokens or not tokens.get('refresh_token'):
+            raise AuthFailed('No refresh token for %s' % userid)
+
+        api = request.googleapi
+        oauth2_tokens = api.refresh_access_token(tokens['refresh_token'])
+        oauth2_tokens.setdefault('refresh_token', tokens['refresh_token'])
+
+        userinfo = api.get_userinfo_from_token(oauth2_tokens)
+        api.check_hosted_domain_user(userinfo)
+        if api.get_user_id_from_userinfo(userinfo) != userid:
+            raise AuthFailed('Tokens of another user')
+        return oauth2_tokens, userinfo
+
+
+def includeme(config):
+    settings = config.registry.settings
+    prefix = SETTINGS_PREFIX
+
+    mode = settings.get(prefix + 'silent_reauth', 'off')
+    if mode not in SILENT_REAUTH_MODES:
+        raise ConfigurationError('Invalid %ssilent_reauth: %s' % (prefix,
+                                                                  mode))
+    if mode == 'off':
+        return
+
+    try:
+        serializer = StateSerializer(
+            secrets_from_settings(settings, prefix),
+            max_age=int(settings.get(prefix + 'silent_reauth_max_age',
+                                     30 * 24 * 3600)),
+            purpose='returning_user')
+    except ValueError as err:
+        log.error('Invalid silent reauth setting: %s', err)
+        raise
+
+    config.registry.registerUtility(SilentReauth(mode, serializer),
+                                    provided=ISilentReauth)
@@ -0,0 +1,169 @@
+"""Signed OAuth2 state, protecting the callback against CSRF without storage
+
+The state carries the next url, a timestamp and a random nonce, signed with
+HMAC-SHA256. The nonce is also set in a cookie by the signin redirect: the
+callback accepts the state only from the browser which started the flow.
+
+Binary layout, encoded in base64url without padding::
+
+    version (1) | key id (1) | timestamp (4) | nonce (8) | url | mac (16)
+"""
+import base64
+import binascii
+import hashlib
+import hmac
+import logging
+import os
+import struct
+import time
+
+import six
+from pyramid.settings import aslist
+from zope.interface import Interface
+
+from pyramid_google_login import SETTINGS_PREFIX
+from pyramid_google_login.exceptions import AuthFailed
+
+log = logging.getLogger(__name__)
+
+VERSION = 1
+HEADER = struct.Struct('>BBI8s')
+MAC_SIZE = 16
+COOKIE_NAME = 'google_login_state'
+
+
+class IStateSerializer(Interface):
+    pass
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(data):
+    data = data.encode('ascii')
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+class StateSerializer(object):
+    """Sign with the first secret, verify with any of them (key rotation)
+
+    The keys are derived from the secrets and the ``purpose``: a value
+    signed for a purpose is rejected by the serializers of the others.
+    """
+
+    def __init__(self, secrets, max_age=600, purpose='state'):
+        if not secrets:
+            raise ValueError('At least one secret is required')
+        self.purpose = purpose
+        self.keys = [self._key(secret) for secret in secrets]
+        self.max_age = max_age
+
+    def _key(self, secret):
+        if isinstance(secret, six.text_type):
+            secret = secret.encode('utf-8')
+        label = ('pyramid_google_login.%s:' % self.purpose).encode('ascii')
+        key = hashlib.sha256(label + secret).digest()
+        return six.indexbytes(hashlib.sha256(key).digest(), 0), key
+
+    def _mac(self, key, data):
+        return hmac.new(key, data, hashlib.sha256).digest()[:MAC_SIZE]
+
+    def dumps(self, url=None, now=None):
+        """Return the state and its nonce"""
+        key_id, key = self.keys[0]
+        nonce = os.urandom(8)
+        if now is None:
+            now = time.time()
+        data = HEADER.pack(VERSION, key_id, int(now), nonce)
+        data += (url or '').encode('utf-8')
+        return _b64encode(data + self._mac(key, data)), _b64encode(nonce)
+
+    def loads(self, state, now=None):
+        """Verify the state, return its url (or None) and its nonce"""
+        try:
+            raw = _b64decode(state)
+        except (TypeError, ValueError, UnicodeEncodeError, binascii.Error):
+            raise AuthFailed('Invalid state')
+
+        if len(raw) < HEADER.size + MAC_SIZE:
+            raise AuthFailed('Invalid state')
+
+        data, mac = raw[:-MAC_SIZE], raw[-MAC_SIZE:]
+        version, key_id, timestamp, nonce = HEADER.unpack_from(data)
+        if version != VERSION:
+            raise AuthFailed('Invalid state')
+
+        for candidate_id, key in self.keys:
+            if (candidate_id == key_id and
+                    hmac.compare_digest(self._mac(key, data), mac)):
+                break
+        else:
+            raise AuthFailed('Invalid state signature')
+
+        if now is None:
+            now = time.time()
+        if not timestamp - 60 <= now <= timestamp + self.max_age:
+            raise AuthFailed('Expired state')
+
+        try:
+            url = data[HEADER.size:].decode('utf-8') or None
+        except UnicodeDecodeError:
+            raise AuthFailed('Invalid state')
+        return url, _b64encode(nonce)
+
+
+def set_state_cookie(request, response, nonce):
+    serializer = request.registry.getUtility(IStateSerializer)
+    response.set_cookie(COOKIE_NAME, nonce,
+                        max_age=serializer.max_age,
+                        path=request.route_path('auth_callback'),
+                        secure=request.scheme == 'https',
+                        httponly=True,
+                        samesite='Lax')
+
+
+def delete_state_cookie(request, response):
+    response.delete_cookie(COOKIE_NAME,
+                           path=request.route_path('auth_callback'))
+
+
+def check_state(request):
+    """Verify the state of the OAuth2 callback, return its url (or None)"""
+    serializer = request.registry.getUtility(IStateSerializer)
+    try:
+        state = request.params['state']
+    except KeyError:
+        raise AuthFailed('Missing state')
+
+    url, nonce = serializer.loads(state)
+
+    cookie_nonce = request.cookies.get(COOKIE_NAME, '')
+    if not hmac.compare_digest(cookie_nonce.encode('ascii', 'replace'),
+                               nonce.encode('ascii')):
+        raise AuthFailed('State not issued to this browser')
+
+    return url
+
+
+def secrets_from_settings(settings, prefix=SETTINGS_PREFIX):
+    secrets = aslist(settings.get(prefix + 'state_secrets', ''))
+    if not secrets:
+        # Shared by all the processes of the application
+        secrets = [settings[prefix + 'client_secret']]
+    return secrets
+
+
+def includeme(config):
+    settings = config.registry.settings
+    prefix = SETTINGS_PREFIX
+
+    try:
+        serializer = StateSerializer(
+            secrets_from_settings(settings, prefix),
+            max_age=int(settings.get(prefix + 'state_max_age', 600)))
+    except ValueError as err:
+        log.error('Invalid state setting: %s', err)
+        raise
+
+    config.registry.registerUtility(serializer, provided=IStateSerializer)
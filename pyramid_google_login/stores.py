@@ -0,0 +1,299 @@
+"""Storage backends for the OAuth2 tokens of the users
+
+All the backends provide ``get(userid)``, ``set(userid, tokens)``,
+``delete(userid)`` and ``flush()``. ``tokens`` is a dict serializable to
+JSON. The persistent backends buffer the writes and flush them in batches,
+and can encrypt the refresh tokens. The redis backend requires the ``redis``
+package (``pip install pyramid_google_login[redis]``).
+"""
+import abc
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import six
+from pyramid.exceptions import ConfigurationError
+from pyramid.settings import aslist
+from zope.interface import Interface
+
+from pyramid_google_login.cache import LRUCache
+
+log = logging.getLogger(__name__)
+
+
+class ITokenStore(Interface):
+    pass
+
+
+class MemoryTokenStore(LRUCache):
+    """Tokens kept in the memory of the process (least recently used are
+    evicted)
+    """
+
+    def flush(self):
+        pass
+
+
+class TokenCodec(object):
+    """JSON serialization, encrypting the refresh token (Fernet)
+
+    The first key encrypts, all the keys decrypt (for key rotation).
+    """
+
+    def __init__(self, encryption_keys=()):
+        self.fernet = None
+        if encryption_keys:
+            try:
+                from cryptography.fernet import Fernet, MultiFernet
+            except ImportError:
+                raise ConfigurationError(
+                    'Encryption of the tokens requires cryptography')
+            self.fernet = MultiFernet([Fernet(key) for key in encryption_keys])
+
+    def encode(self, tokens):
+        if self.fernet is not None and tokens.get('refresh_token'):
+            tokens = dict(tokens)
+            refresh_token = tokens.pop('refresh_token').encode('utf-8')
+            tokens['encrypted_refresh_token'] = self.fernet.encrypt(
+                refresh_token).decode('ascii')
+        return json.dumps(tokens, separators=(',', ':'))
+
+    def decode(self, data):
+        if isinstance(data, six.binary_type):
+            data = data.decode('utf-8')
+        tokens = json.loads(data)
+        if 'encrypted_refresh_token' in tokens:
+            if self.fernet is None:
+                raise ValueError('Missing key to decrypt the refresh token')
+            encrypted = tokens.pop('encrypted_refresh_token')
+            tokens['refresh_token'] = self.fernet.decrypt(
+                encrypted.encode('ascii')).decode('utf-8')
+        return tokens
+
+
+@six.add_metaclass(abc.ABCMeta)
+class BatchedTokenStore(object):
+    """Base of the persistent backends: the writes are buffered and flushed
+    by a background thread every ``flush_interval`` seconds or as soon as
+    ``batch_size`` writes are pending.
+
+    The backends implement :meth:`read` and :meth:`write`.
+    """
+
+    def __init__(self, codec=None, batch_size=100, flush_interval=1.0):
+        self.codec = codec or TokenCodec()
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._pending = {}
+        self._flushing = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread_pid = None
+        atexit.register(self._flush_at_exit)
+
+    def get(self, userid):
+        with self._lock:
+            for buffered in (self._pending, self._flushing):
+                if userid in buffered:
+                    return buffered[userid]
+        data = self.read(userid)
+        if data is None:
+            return None
+        return self.codec.decode(data)
+
+    def set(self, userid, tokens):
+        self._buffer(userid, tokens)
+
+    def delete(self, userid):
+        self._buffer(userid, None)
+
+    def _buffer(self, userid, tokens):
+        with self._lock:
+            self._pending[userid] = tokens
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self.flush()
+        else:
+            self._ensure_thread()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._flushing = pending
+            if not pending:
+                return
+            try:
+                self.write(dict(
+                    (userid, None if tokens is None
+                     else self.codec.encode(tokens))
+                    for userid, tokens in pending.items()))
+            except Exception:
+                # Keep the writes for the next flush (unless overwritten)
+                with self._lock:
+                    pending.update(self._pending)
+                    self._pending = pending
+                raise
+            finally:
+                with self._lock:
+                    self._flushing = {}
+
+    def _flush_at_exit(self):
+        try:
+            self.flush()
+        except Exception:
+            log.exception('Failed to write the tokens in %s', self)
+
+    def _ensure_thread(self):
+        if self._thread_pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread_pid == os.getpid():
+                return
+            thread = threading.Thread(target=self._run,
+                                      name='google-token-store-flush')
+            thread.daemon = True
+            thread.start()
+            self._thread_pid = os.getpid()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                log.exception('Failed to write the tokens in %s', self)
+
+    @abc.abstractmethod
+    def read(self, userid):
+        """Return the serialized tokens of the user (or None)"""
+
+    @abc.abstractmethod
+    def write(self, serialized_tokens):
+        """Write a batch ``{userid: serialized tokens or None to delete}``"""
+
+
+class SqliteTokenStore(BatchedTokenStore):
+    """Tokens in a SQLite database (WAL mode), for a single host"""
+
+    def __init__(self, path, **kwargs):
+        super(SqliteTokenStore, self).__init__(**kwargs)
+        self.path = path
+        self._db_lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+
+    def __repr__(self):
+        return '<SqliteTokenStore %s>' % self.path
+
+    @property
+    def connection(self):
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS tokens '
+                               '(userid TEXT PRIMARY KEY, data TEXT NOT NULL,'
+                               ' updated_at REAL NOT NULL)')
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    def read(self, userid):
+        with self._db_lock:
+            row = self.connection.execute(
+                'SELECT data FROM tokens WHERE userid = ?',
+                (userid,)).fetchone()
+        return row[0] if row is not None else None
+
+    def write(self, serialized_tokens):
+        now = time.time()
+        with self._db_lock:
+            with self.connection as connection:
+                connection.executemany(
+                    'DELETE FROM tokens WHERE userid = ?',
+                    [(userid,) for userid, data in serialized_tokens.items()
+                     if data is None])
+                connection.executemany(
+                    'INSERT OR REPLACE INTO tokens VALUES (?, ?, ?)',
+                    [(userid, data, now)
+                     for userid, data in serialized_tokens.items()
+                     if data is not None])
+
+
+class RedisTokenStore(BatchedTokenStore):
+    """Tokens in Redis, with a client of the ``redis`` package (thread-safe,
+    reconnecting after a fork)
+    """
+
+    def __init__(self, client, key_prefix='google_login:tokens:', ttl=None,
+                 **kwargs):
+        super(RedisTokenStore, self).__init__(**kwargs)
+        self.client = client
+        self.key_prefix = key_prefix
+        self.ttl = ttl
+
+    @classmethod
+    def from_url(cls, url, timeout=5, **kwargs):
+        try:
+            import redis
+        except ImportError:
+            raise ConfigurationError('The redis token store requires redis')
+        client = redis.StrictRedis.from_url(url, socket_timeout=timeout,
+                                            socket_connect_timeout=timeout)
+        return cls(client, **kwargs)
+
+    def __repr__(self):
+        return '<RedisTokenStore %r>' % self.client
+
+    def read(self, userid):
+        return self.client.get(self.key_prefix + userid)
+
+    def write(self, serialized_tokens):
+        pipeline = self.client.pipeline(transaction=False)
+        for userid, data in serialized_tokens.items():
+            key = self.key_prefix + userid
+            if data is None:
+                pipeline.delete(key)
+            else:
+                pipeline.set(key, data, ex=self.ttl or None)
+        pipeline.execute()
+
+
+def token_store_from_settings(settings, prefix):
+    """Build the token store configured by ``token_store`` (or None)"""
+    backend = settings.get(prefix + 'token_store')
+    if not backend:
+        return None
+
+    ttl = settings.get(prefix + 'token_store_ttl')
+    ttl = int(ttl) if ttl else None
+
+    if backend == 'memory':
+        return MemoryTokenStore(
+            maxsize=int(settings.get(prefix + 'token_store_maxsize', 10000)),
+            ttl=ttl)
+
+    batch_options = dict(
+        codec=TokenCodec(aslist(
+            settings.get(prefix + 'token_store_encryption_keys', ''))),
+        batch_size=int(settings.get(prefix + 'token_store_batch_size', 100)),
+        flush_interval=float(
+            settings.get(prefix + 'token_store_flush_interval', 1)),
+        )
+
+    if backend == 'sqlite':
+        return SqliteTokenStore(settings[prefix + 'token_store_path'],
+                                **batch_options)
+
+    if backend == 'redis':
+        return RedisTokenStore.from_url(
+            settings.get(prefix + 'token_store_url', 'redis://localhost'),
+            ttl=ttl, **batch_options)
+
+    raise ConfigurationError('Invalid %stoken_store: %s' % (prefix, backend))
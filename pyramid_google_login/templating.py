@@ -0,0 +1,108 @@
+"""Rendering of the sign in page
+
+The template is rendered by ``pyramid_mako``, which compiles it on its first
+rendering: with ``mako.module_directory``, the compiled template is written
+on disk and reused by the next processes.
+
+The pages without message are rendered once and kept in memory, served with
+validators (``ETag``, ``Last-Modified``). The urls of the static assets are
+fingerprinted by their content and cached for long by the browsers.
+"""
+from collections import namedtuple
+from contextlib import closing
+import hashlib
+import logging
+import time
+
+from pyramid.path import AssetResolver
+from pyramid.renderers import render
+from pyramid.response import Response
+from pyramid.static import QueryStringCacheBuster
+from zope.interface import Interface
+
+from pyramid_google_login import SETTINGS_PREFIX
+from pyramid_google_login.cache import LRUCache
+
+log = logging.getLogger(__name__)
+
+SIGNIN_TEMPLATE = 'pyramid_google_login:templates/signin.mako'
+
+# The urls of the fingerprinted assets change with their content
+STATIC_MAX_AGE = 365 * 24 * 3600
+
+Page = namedtuple('Page', 'body etag last_modified')
+
+
+class ISigninPageCache(Interface):
+    pass
+
+
+class PageCache(object):
+    """Pages rendered once by key, served with validators
+
+    The browsers revalidate the page on every display (``no-cache``) unless
+    ``max_age`` is set: an unchanged page is then answered by a 304.
+    """
+
+    def __init__(self, renderer, maxsize=100, max_age=0):
+        self.renderer = renderer
+        self.max_age = max_age
+        self.cache = LRUCache(maxsize=maxsize)
+
+    def render(self, request, values):
+        body = render(self.renderer, values, request=request).encode('utf-8')
+        return Page(body=body,
+                    etag=hashlib.sha1(body).hexdigest(),
+                    last_modified=int(time.time()))
+
+    def response(self, request, key, values):
+        page = self.cache.get(key)
+        if page is None:
+            page = self.render(request, values)
+            self.cache.set(key, page)
+
+        response = Response(body=page.body, content_type='text/html',
+                            charset='utf-8', conditional_response=True)
+        response.etag = page.etag
+        response.last_modified = page.last_modified
+        response.cache_control.private = True
+        if self.max_age:
+            response.cache_control.max_age = self.max_age
+        else:
+            response.cache_control.no_cache = True
+        return response
+
+
+class ContentCacheBuster(QueryStringCacheBuster):
+    """Add the hash of the content of the asset to its url"""
+
+    def __init__(self, param='x'):
+        QueryStringCacheBuster.__init__(self, param)
+        self.tokens = {}
+
+    def tokenize(self, request, subpath, kw):
+        pathspec = kw['pathspec']
+        token = self.tokens.get(pathspec)
+        if token is None:
+            digest = hashlib.sha1()
+            with closing(AssetResolver().resolve(pathspec).stream()) as fd:
+                for chunk in iter(lambda: fd.read(65536), b''):
+                    digest.update(chunk)
+            token = self.tokens[pathspec] = digest.hexdigest()[:16]
+        return token
+
+
+def includeme(config):
+    settings = config.registry.settings
+    prefix = SETTINGS_PREFIX
+
+    try:
+        maxsize = int(settings.get(prefix + 'signin_cache_maxsize', 100))
+        max_age = int(settings.get(prefix + 'signin_cache_max_age', 0))
+    except ValueError as err:
+        log.error('Invalid signin cache setting: %s', err)
+        raise
+    if maxsize:
+        config.registry.registerUtility(
+            PageCache(SIGNIN_TEMPLATE, maxsize=maxsize, max_age=max_age),
+            provided=ISigninPageCache)
@@ -0,0 +1,111 @@
+"""Tenants: Google settings resolved per request host or path
+
+One application can serve many Google Workspace domains, each with its own
+OAuth2 client::
+
+    security.google_login.tenants = acme globex
+    security.google_login.tenant.acme.hosts = acme.example.com
+    security.google_login.tenant.acme.client_id = ...
+    security.google_login.tenant.acme.client_secret = ...
+    security.google_login.tenant.acme.hosted_domain = acme.com
+    security.google_login.tenant.globex.paths = globex
+    ...
+
+The settings of a tenant override the global ones, except the
+``NOT_INHERITED`` ones (bound to the OAuth2 client or the domain of the
+tenant), which must be set per tenant. The settings, the
+authorize url prefix and the connection pool of every tenant are built once
+at configuration time (``registry.settings['googleapi_tenants']``), then
+found by a dict lookup on the host (then on the first segment of the path).
+The requests of no tenant use the global settings.
+"""
+from collections import namedtuple
+
+from pyramid.settings import aslist
+
+Tenant = namedtuple('Tenant', 'name api_settings http')
+
+# Settings never inherited from the global settings by a tenant
+NOT_INHERITED = ('hosted_domain_file', 'directory_mirror',
+                 'directory_refresh_token', 'directory_path', 'groups',
+                 'groups_refresh_token')
+
+# Key of the request environ forcing the tenant (e.g. for the calls made
+# outside of a request)
+TENANT_ENVIRON_KEY = 'pyramid_google_login.tenant'
+
+
+class TenantRegistry(object):
+    """Tenants indexed by host and by first path segment"""
+
+    def __init__(self):
+        self.tenants = {}
+        self.by_host = {}
+        self.by_path = {}
+
+    def __len__(self):
+        return len(self.tenants)
+
+    def add(self, tenant, hosts=(), paths=()):
+        if tenant.name in self.tenants:
+            raise ValueError('Duplicate tenant: %s' % tenant.name)
+        self.tenants[tenant.name] = tenant
+        for index, keys in ((self.by_host, [h.lower() for h in hosts]),
+                            (self.by_path, [p.strip('/') for p in paths])):
+            for key in keys:
+                if key in index:
+                    raise ValueError('%s is already mapped to the tenant %s'
+                                     % (key, index[key].name))
+                index[key] = tenant
+
+    def get(self, name):
+        return self.tenants[name]
+
+    def resolve(self, request):
+        """Tenant of the request, or None"""
+        tenant = self.by_host.get(request.domain.lower())
+        if tenant is None and self.by_path:
+            segment = request.path.split('/', 2)[1]
+            tenant = self.by_path.get(segment)
+        return tenant
+
+
+def tenant_settings(settings, prefix, name):
+    """Global settings overridden by the settings of the tenant"""
+    tenant_prefix = '%stenant.%s.' % (prefix, name)
+    merged = dict(settings)
+    for key in NOT_INHERITED:
+        merged.pop(prefix + key, None)
+    for key, value in settings.items():
+        if key.startswith(tenant_prefix):
+            merged[prefix + key[len(tenant_prefix):]] = value
+    return merged
+
+
+def tenant_names(settings, prefix):
+    return aslist(settings.get(prefix + 'tenants', ''))
+
+
+def get_tenant(request):
+    """Tenant of the request (None: global settings)"""
+    tenants = request.registry.settings.get('googleapi_tenants')
+    if tenants is None:
+        return None
+    name = request.environ.get(TENANT_ENVIRON_KEY)
+    if name is not None:
+        return tenants.get(name)
+    return tenants.resolve(request)
+
+
+def get_tenant_name(request):
+    """Name of the tenant of the request (None: global settings)"""
+    tenant = get_tenant(request)
+    return None if tenant is None else tenant.name
+
+
+def get_api_settings(request):
+    """:class:`ApiSettings` of the tenant of the request"""
+    tenant = get_tenant(request)
+    if tenant is None:
+        return request.registry.settings['googleapi_settings']
+    return tenant.api_settings
@@ -0,0 +1,237 @@
+from collections import Counter
+import json
+import random
+import threading
+import time
+
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib import parse
+
+
+class StubGoogleHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status=200, headers=()):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_degraded(self):
+        """Apply the latency and the error rate of the server"""
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.should_fail():
+            self.send_json({'error': 'backendError'}, status=503)
+            return True
+        return False
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        url = parse.urlparse(self.path)
+        path = url.path
+        self.server.hits[path] += 1
+        if self.send_degraded():
+            return
+        if path.startswith('/batch/'):
+            self.send_batch(body)
+            return
+        body = body.decode('utf-8')
+        params = parse.parse_qs(url.query)
+        params.update(parse.parse_qs(body))
+        refresh_token = params.get('refresh_token', [None])[0]
+        if path == '/token' and refresh_token in self.server.revoked_tokens:
+            self.send_json({'error': 'invalid_grant'}, status=400)
+        elif path == '/token':
+            self.send_json({'access_token': 'ACCESS TOKEN',
+                            'expires_in': 3600,
+                            'token_type': 'Bearer'})
+        else:
+            self.send_json({'error': 'not_found'}, status=404)
+
+    def do_GET(self):
+        url = parse.urlparse(self.path)
+        self.server.hits[url.path] += 1
+        if self.send_degraded():
+            return
+        status, payload, headers = self.route(url.path,
+                                              parse.parse_qs(url.query))
+        self.send_json(payload, status=status, headers=headers)
+
+    def route(self, path, query, access_token=None):
+        """Return the status, payload and headers of a GET call"""
+        if access_token is None:
+            access_token = query.get('access_token', [None])[0]
+        if path == '/userinfo':
+            if access_token in self.server.revoked_tokens:
+                return 401, {'error': 'invalid_token'}, []
+            return 200, self.server.userinfos.get(
+                access_token, {'email': 'bob@bob.com',
+                               'hd': 'bob.com',
+                               'id': '42'}), []
+        elif path == '/users':
+            return 200, self.users_page(query), []
+        elif path.startswith('/users/'):
+            user_key = parse.unquote(path[len('/users/'):])
+            for user in self.server.users:
+                if user_key in (user['id'], user['primaryEmail']):
+                    return 200, user, []
+            return 404, {'error': {'code': 404,
+                                   'message': 'Resource Not Found'}}, []
+        elif path == '/groups':
+            return self.groups_page(query)
+        elif path == '/certs':
+            cache_control = 'public, max-age=%d' % self.server.certs_max_age
+            return (200, {'keys': self.server.jwks},
+                    [('Cache-Control', cache_control)])
+        return 404, {'error': 'not_found'}, []
+
+    def users_page(self, query):
+        self.server.users_queries.append(query)
+        offset = int(query.get('pageToken', ['0'])[0])
+        limit = int(query.get('maxResults', ['100'])[0])
+        page = {'users': self.server.users[offset:offset + limit]}
+        if offset + limit < len(self.server.users):
+            page['nextPageToken'] = str(offset + limit)
+        return page
+
+    def groups_page(self, query):
+        user_key = query['userKey'][0]
+        if user_key not in self.server.groups:
+            return 404, {'error': 'not_found'}, []
+        groups = self.server.groups[user_key]
+        offset = int(query.get('pageToken', ['0'])[0])
+        limit = int(query.get('maxResults', ['200'])[0])
+        page = {'groups': [{'email': email}
+                           for email in groups[offset:offset + limit]]}
+        if offset + limit < len(groups):
+            page['nextPageToken'] = str(offset + limit)
+        return 200, page, []
+
+    def send_batch(self, body):
+        """Answer a multipart batch request, one part per call"""
+        content_type = self.headers.get('Content-Type', '')
+        boundary = content_type.split('boundary=', 1)[1].strip('"')
+        self.server.batch_sizes.append(0)
+        response_boundary = 'batch_response'
+        chunks = []
+        for part in body.split(b'--' + boundary.encode('ascii'))[1:]:
+            if part.startswith(b'--'):
+                break
+            mime, _, http = part.strip(b'\r\n').partition(b'\r\n\r\n')
+            content_id = [line.split(b':', 1)[1].strip()
+                          for line in mime.split(b'\r\n')
+                          if line.lower().startswith(b'content-id:')][0]
+            lines = http.decode('utf-8').split('\r\n')
+            url = parse.urlparse(lines[0].split()[1])
+            access_token = None
+            for line in lines[1:]:
+                if line.lower().startswith('authorization: bearer '):
+                    access_token = line.split(' ', 2)[2]
+            status, payload, _ = self.route(
+                url.path, parse.parse_qs(url.query), access_token)
+            self.server.batch_sizes[-1] += 1
+            chunks.append(
+                '--%s\r\n'
+                'Content-Type: application/http\r\n'
+                'Content-ID: <response-%s>\r\n'
+                '\r\n'
+                'HTTP/1.1 %d %s\r\n'
+                'Content-Type: application/json; charset=UTF-8\r\n'
+                '\r\n'
+                '%s\r\n' % (
+                    response_boundary, content_id.decode('ascii').strip('<>'),
+                    status, 'OK' if status == 200 else 'Error',
+                    json.dumps(payload)))
+        chunks.append('--%s--\r\n' % response_boundary)
+        body = ''.join(chunks).encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type',
+                         'multipart/mixed; boundary=%s' % response_boundary)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StubGoogleServer(socketserver.ThreadingMixIn,
+                       BaseHTTPServer.HTTPServer):
+    """Local stand-in for the Google endpoints, counting TCP connections
+
+    Every response is delayed by ``latency`` seconds, a ``error_rate``
+    fraction of them are 503 errors (reproducible with ``seed``).
+    """
+
+    daemon_threads = True
+
+    def __init__(self, handler_class=StubGoogleHandler, latency=0,
+                 error_rate=0, seed=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           handler_class)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self.connections = 0
+        self.hits = Counter()
+        self.jwks = []
+        self.certs_max_age = 3600
+        self.users = []
+        self.users_queries = []
+        self.groups = {}
+        self.userinfos = {}
+        self.batch_sizes = []
+        self.revoked_tokens = set()
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%s' % self.server_address
+
+    def should_fail(self):
+        if not self.error_rate:
+            return False
+        with self._random_lock:
+            return self.random.random() < self.error_rate
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        socketserver.ThreadingMixIn.process_request(self, request,
+                                                    client_address)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+
+def stub_api_client_factory(base_url, api_client_class=None):
+    if api_client_class is None:
+        from pyramid_google_login.utility import ApiClient
+        api_client_class = ApiClient
+
+    class StubApiClient(api_client_class):
+        token_endpoint = base_url + '/token'
+        userinfo_endpoint = base_url + '/userinfo'
+        domain_users_endpoint = base_url + '/users'
+        groups_endpoint = base_url + '/groups'
+        directory_batch_endpoint = base_url + '/batch/directory'
+        userinfo_batch_endpoint = base_url + '/batch/userinfo'
+
+    return StubApiClient
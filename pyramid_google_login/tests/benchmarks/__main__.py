@@ -0,0 +1,27 @@
+"""Load test of the login flow, or the benchmarks with ``suite``::
+
+    python -m pyramid_google_login.tests.benchmarks [--logins 1000 ...]
+    python -m pyramid_google_login.tests.benchmarks suite
+"""
+import os
+import sys
+import unittest
+
+from .loadtest import main
+
+
+def run_suite():
+    """Run the benchmarks (``bench_*.py``): timings, printed, not collected
+    by the test runners
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    top_level = os.path.dirname(os.path.dirname(os.path.dirname(here)))
+    suite = unittest.defaultTestLoader.discover(
+        here, pattern='bench_*.py', top_level_dir=top_level)
+    result = unittest.TextTestRunner(verbosity=2).run(suite)
+    return 0 if result.wasSuccessful() else 1
+
+
+if sys.argv[1:2] == ['suite']:
+    sys.exit(run_suite())
+sys.exit(main())
@@ -0,0 +1,51 @@
+import timeit
+
+from six.moves.urllib import parse
+
+from pyramid_google_login.tests.functional import Base
+
+
+class TestAuthorizeUrlBenchmark(Base):
+
+    settings = dict(Base.settings, **{
+        'security.google_login.scopes': (
+            'email profile '
+            'https://www.googleapis.com/auth/admin.directory.user.readonly'),
+        })
+
+    iterations = 5000
+
+    def test_prefix_faster_than_full_encoding(self):
+        from pyramid_google_login.utility import ApiClient
+
+        request = self.get_request()
+        googleapi = ApiClient(request)
+        settings = request.registry.settings['googleapi_settings']
+
+        def full_encoding():
+            params = {
+                'response_type': 'code',
+                'client_id': settings.id,
+                'redirect_uri': 'http://localhost/auth/oauth2callback',
+                'scope': ' '.join(set(settings.scope_list)),
+                'state': 'url=%2Fsome%2Fpage',
+                'access_type': settings.access_type,
+            }
+            if settings.hosted_domain:
+                params['hd'] = settings.hosted_domain
+            return '%s?%s' % (googleapi.authorize_endpoint,
+                              parse.urlencode(params))
+
+        def precomputed():
+            return googleapi.build_authorize_url(
+                'url=%2Fsome%2Fpage', 'http://localhost/auth/oauth2callback')
+
+        full = min(timeit.repeat(full_encoding, number=self.iterations,
+                                 repeat=3))
+        prefix = min(timeit.repeat(precomputed, number=self.iterations,
+                                   repeat=3))
+
+        print('\nauthorize url: full encoding %.2fus, precomputed prefix '
+              '%.2fus' % (full * 1e6 / self.iterations,
+                          prefix * 1e6 / self.iterations))
+        self.assertLess(prefix, full)
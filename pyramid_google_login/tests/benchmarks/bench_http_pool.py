@@ -0,0 +1,73 @@
+import time
+import unittest
+
+import requests
+from pyramid.config import Configurator
+from webtest import TestApp
+
+from pyramid_google_login.transport import HttpSessionPool
+from pyramid_google_login.utility import IApiClientFactory, IHttpSessionPool
+
+from . import StubGoogleServer, stub_api_client_factory
+
+
+class NoReuseHttpSessionPool(HttpSessionPool):
+    """One connection per call, as with the module-level requests API"""
+
+    def send(self, method, url, **kwargs):
+        return requests.request(method, url, **kwargs)
+
+
+class TestCallbackLatency(unittest.TestCase):
+
+    logins = 200
+
+    settings = {
+        'security.google_login.client_id': 'client id',
+        'security.google_login.client_secret': 'client secret',
+        }
+
+    def setUp(self):
+        self.server = StubGoogleServer().start()
+        self.addCleanup(self.server.stop)
+
+    def make_app(self, http_pool):
+        from pyramid_google_login.state import COOKIE_NAME, IStateSerializer
+
+        config = Configurator(settings=self.settings)
+        config.include('pyramid_google_login')
+        config.commit()
+        config.registry.registerUtility(
+            stub_api_client_factory(self.server.url),
+            provided=IApiClientFactory)
+        config.registry.registerUtility(http_pool, provided=IHttpSessionPool)
+        self.addCleanup(http_pool.close)
+
+        app = TestApp(config.make_wsgi_app())
+        state, nonce = config.registry.getUtility(IStateSerializer).dumps()
+        app.set_cookie(COOKIE_NAME, nonce)
+        return app, state
+
+    def run_logins(self, http_pool):
+        app, state = self.make_app(http_pool)
+        connections = self.server.connections
+        start = time.time()
+        for _ in range(self.logins):
+            resp = app.get('/auth/oauth2callback',
+                           params={'code': 'CODE', 'state': state},
+                           status=302)
+            self.assertEqual(resp.location, 'http://localhost/')
+        elapsed = time.time() - start
+        return elapsed, self.server.connections - connections
+
+    def test_reuse(self):
+        reuse_time, reuse_connections = self.run_logins(HttpSessionPool())
+        fresh_time, fresh_connections = self.run_logins(
+            NoReuseHttpSessionPool())
+
+        print('\ncallback latency over %d logins: '
+              'pooled %.2fms (%d connections), '
+              'not pooled %.2fms (%d connections)' % (
+                  self.logins,
+                  reuse_time * 1000 / self.logins, reuse_connections,
+                  fresh_time * 1000 / self.logins, fresh_connections))
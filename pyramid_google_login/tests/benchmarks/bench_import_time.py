@@ -0,0 +1,50 @@
+import subprocess
+import sys
+import unittest
+
+from pyramid_google_login.tests.functional.test_lazy_imports import (
+    STARTUP, python_env)
+
+
+def import_times(code):
+    """Run ``code`` in a new interpreter, return the self and cumulative
+    import times (microseconds) by module name
+    """
+    process = subprocess.Popen([sys.executable, '-X', 'importtime', '-c',
+                                code],
+                               stderr=subprocess.PIPE, env=python_env())
+    _, stderr = process.communicate()
+    if process.returncode != 0:
+        raise AssertionError(stderr.decode('utf-8'))
+
+    times = {}
+    for line in stderr.decode('utf-8').splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        if not self_us.strip().isdigit():
+            continue  # header
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+@unittest.skipIf(sys.version_info < (3, 7), '-X importtime requires 3.7')
+class TestImportTime(unittest.TestCase):
+
+    # Self import time of the modules of the package (microseconds),
+    # dependencies excluded. Generous: CI machines are slow and noisy
+    budget_us = 150000
+
+    def test_startup(self):
+        times = import_times(STARTUP)
+
+        own = dict((name, self_us) for name, (self_us, _) in times.items()
+                   if name.split('.')[0] == 'pyramid_google_login')
+        total = sum(own.values())
+        print('\nimport time of pyramid_google_login: %.1fms (%s)' % (
+            total / 1000.0,
+            ', '.join('%s %.1fms' % (name, us / 1000.0)
+                      for name, us in sorted(own.items(),
+                                             key=lambda item: -item[1])[:3])))
+
+        self.assertLess(total, self.budget_us)
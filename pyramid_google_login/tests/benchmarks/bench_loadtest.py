@@ -0,0 +1,33 @@
+import unittest
+
+from .loadtest import (HttpClient, WebTestClient, WSGIServerThread,
+                       format_report, make_app, run_load)
+from . import StubGoogleServer
+
+
+class TestLoad(unittest.TestCase):
+
+    logins = 200
+    concurrency = 4
+
+    def start_server(self, **kwargs):
+        server = StubGoogleServer(**kwargs).start()
+        self.addCleanup(server.stop)
+        return server
+
+    def test_webtest(self):
+        server = self.start_server(latency=0.002)
+        app = make_app(server)
+
+        report = run_load(lambda: WebTestClient(app), self.logins,
+                          self.concurrency, server=server, alloc_samples=5)
+        print('\n' + format_report(report))
+
+    def test_wsgi_server(self):
+        server = self.start_server()
+        wsgi_server = WSGIServerThread(make_app(server)).start()
+        self.addCleanup(wsgi_server.stop)
+
+        report = run_load(lambda: HttpClient(wsgi_server.url), self.logins,
+                          self.concurrency, server=server, alloc_samples=5)
+        print('\n' + format_report(report))
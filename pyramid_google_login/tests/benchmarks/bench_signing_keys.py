@@ -0,0 +1,38 @@
+import time
+import unittest
+
+from pyramid_google_login.idtoken import decode_id_token
+from pyramid_google_login.tests.idtoken_helpers import (
+    RsaTestKey, make_claims, make_id_token)
+from pyramid_google_login.transport import HttpSessionPool
+from pyramid_google_login.utility import SigningKeys
+
+from . import StubGoogleServer
+
+
+class TestSigningKeysCache(unittest.TestCase):
+
+    verifications = 5000
+
+    def setUp(self):
+        self.key = RsaTestKey(seed=1)
+        self.server = StubGoogleServer().start()
+        self.addCleanup(self.server.stop)
+        self.server.jwks = [self.key.jwk('kid1')]
+
+        http_pool = HttpSessionPool()
+        self.addCleanup(http_pool.close)
+        self.signing_keys = SigningKeys(http_pool)
+        self.signing_keys.certs_endpoint = self.server.url + '/certs'
+
+    def test_warm_verification(self):
+        id_token = make_id_token(self.key, make_claims())
+        decode_id_token(id_token, self.signing_keys.get_key, 'client id')
+
+        start = time.time()
+        for _ in range(self.verifications):
+            decode_id_token(id_token, self.signing_keys.get_key, 'client id')
+        elapsed = time.time() - start
+
+        print('\n%d id_token verifications: %.1fus each' % (
+            self.verifications, elapsed * 1e6 / self.verifications))
@@ -0,0 +1,41 @@
+import timeit
+
+from pyramid_google_login.tests.functional import Base
+
+
+class TestTenantsBenchmark(Base):
+
+    iterations = 5000
+    tenants = 500
+
+    @property
+    def settings(self):
+        settings = dict(Base.settings)
+        names = ['tenant%d' % i for i in range(self.tenants)]
+        settings['security.google_login.tenants'] = ' '.join(names)
+        for name in names:
+            settings['security.google_login.tenant.%s.hosts' % name] = (
+                '%s.example.com' % name)
+            settings['security.google_login.tenant.%s.client_id' % name] = (
+                '%s id' % name)
+        return settings
+
+    def test_lookup_independent_of_tenant_count(self):
+        from pyramid_google_login.utility import ApiClient
+
+        request = self.get_request()
+
+        def new_client():
+            return ApiClient(request)
+
+        no_tenant = min(timeit.repeat(new_client, number=self.iterations,
+                                      repeat=3))
+        request.host = 'tenant%d.example.com' % (self.tenants - 1)
+        self.assertEqual(new_client().id, 'tenant%d id' % (self.tenants - 1))
+        tenant = min(timeit.repeat(new_client, number=self.iterations,
+                                   repeat=3))
+
+        print('\napi client: no tenant %.2fus, 1 of %d tenants %.2fus' % (
+            no_tenant * 1e6 / self.iterations, self.tenants,
+            tenant * 1e6 / self.iterations))
+        self.assertLess(tenant, no_tenant * 2)
@@ -0,0 +1,310 @@
+"""Load test of the signin redirect and OAuth2 callback flow
+
+The Google endpoints are served by a local :class:`StubGoogleServer`, the
+application is driven in process through WebTest or over HTTP through a real
+WSGI server. Runs offline::
+
+    python -m pyramid_google_login.tests.benchmarks --concurrency 8 \\
+        --logins 1000 --latency 0.005 --error-rate 0.01 [--wsgi-server]
+"""
+from __future__ import print_function
+
+import argparse
+from collections import namedtuple
+import logging
+import os
+import sys
+import threading
+import time
+from wsgiref import simple_server
+
+import requests
+from pyramid.config import Configurator
+from six.moves import socketserver
+from six.moves.urllib import parse
+from webtest import TestApp
+
+from pyramid_google_login.utility import IApiClientFactory
+
+from . import StubGoogleServer, stub_api_client_factory
+
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover
+    tracemalloc = None
+
+SETTINGS = {
+    'security.google_login.client_id': 'client id',
+    'security.google_login.client_secret': 'client secret',
+    }
+
+LoadReport = namedtuple(
+    'LoadReport',
+    """
+        logins
+        failures
+        concurrency
+        elapsed
+        throughput
+        p50
+        p99
+        alloc_kib_per_login
+        open_sockets
+        upstream_connections
+    """
+    )
+
+
+def make_app(server, settings=None):
+    """WSGI application calling the stub server rather than Google"""
+    config = Configurator(settings=dict(settings or SETTINGS))
+    config.include('pyramid_google_login')
+    config.commit()
+    config.registry.registerUtility(stub_api_client_factory(server.url),
+                                    provided=IApiClientFactory)
+    return config.make_wsgi_app()
+
+
+class WebTestClient(object):
+    """Browser driving the application in process"""
+
+    def __init__(self, app):
+        self.app = TestApp(app)
+
+    def login(self):
+        """Run a signin redirect and its callback, return True if logged in
+        """
+        response = self.app.get('/auth/signin_redirect', status=302)
+        response = self.app.get('/auth/oauth2callback',
+                                params={'code': 'CODE',
+                                        'state': extract_state(response)},
+                                status=302)
+        return '/auth/signin' not in response.location
+
+    def close(self):
+        pass
+
+
+class HttpClient(object):
+    """Browser driving the application served over HTTP"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.session = requests.Session()
+
+    def login(self):
+        response = self.session.get(self.base_url + '/auth/signin_redirect',
+                                    allow_redirects=False)
+        response = self.session.get(self.base_url + '/auth/oauth2callback',
+                                    params={'code': 'CODE',
+                                            'state': extract_state(response)},
+                                    allow_redirects=False)
+        return '/auth/signin' not in response.headers['Location']
+
+    def close(self):
+        self.session.close()
+
+
+def extract_state(response):
+    query = parse.urlparse(response.headers['Location']).query
+    return parse.parse_qs(query)['state'][0]
+
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn,
+                          simple_server.WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(simple_server.WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+class WSGIServerThread(object):
+    """Serve a WSGI application on a local port in a background thread"""
+
+    def __init__(self, app):
+        self.server = simple_server.make_server(
+            '127.0.0.1', 0, app, server_class=ThreadingWSGIServer,
+            handler_class=QuietHandler)
+        self.url = 'http://%s:%s' % self.server.server_address
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join()
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def count_open_sockets():
+    """Sockets held by the process (None if /proc is not available)"""
+    try:
+        fds = os.listdir('/proc/self/fd')
+    except OSError:
+        return None
+    count = 0
+    for fd in fds:
+        try:
+            if os.readlink('/proc/self/fd/' + fd).startswith('socket:'):
+                count += 1
+        except OSError:
+            pass
+    return count
+
+
+def measure_allocations(login, samples=20):
+    """Average peak of memory allocated by a login, in KiB"""
+    if tracemalloc is None or tracemalloc.is_tracing():
+        return None
+    total = 0
+    for _ in range(samples):
+        tracemalloc.start()
+        try:
+            start, _ = tracemalloc.get_traced_memory()
+            login()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        total += peak - start
+    return total / 1024.0 / samples
+
+
+def run_load(client_factory, logins, concurrency, server=None,
+             alloc_samples=20):
+    """Run ``logins`` logins from ``concurrency`` browsers in parallel
+
+    ``client_factory`` returns a new browser (one per thread), with a
+    ``login()`` method returning True when the user was logged in.
+    """
+    latencies = []
+    failures = []
+    remaining = [logins]
+    lock = threading.Lock()
+    clients = [client_factory() for _ in range(concurrency)]
+
+    def worker(client):
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            start = time.time()
+            try:
+                ok = client.login()
+            except Exception:
+                ok = False
+            latencies.append(time.time() - start)
+            if not ok:
+                failures.append(1)
+
+    connections = server.connections if server is not None else 0
+    threads = [threading.Thread(target=worker, args=(client,))
+               for client in clients]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    open_sockets = count_open_sockets()
+    if server is not None:
+        connections = server.connections - connections
+    alloc = measure_allocations(clients[0].login, alloc_samples)
+    for client in clients:
+        client.close()
+
+    latencies.sort()
+    return LoadReport(
+        logins=logins,
+        failures=len(failures),
+        concurrency=concurrency,
+        elapsed=elapsed,
+        throughput=logins / elapsed if elapsed else None,
+        p50=percentile(latencies, 0.5),
+        p99=percentile(latencies, 0.99),
+        alloc_kib_per_login=alloc,
+        open_sockets=open_sockets,
+        upstream_connections=connections if server is not None else None,
+        )
+
+
+def format_report(report):
+    def ms(seconds):
+        return '%.2fms' % (seconds * 1000) if seconds is not None else '-'
+
+    def optional(value, fmt='%d'):
+        return fmt % value if value is not None else '-'
+
+    return '\n'.join([
+        'logins:               %d (%d failed)' % (report.logins,
+                                                  report.failures),
+        'concurrency:          %d' % report.concurrency,
+        'throughput:           %.1f logins/s' % report.throughput,
+        'latency p50:          %s' % ms(report.p50),
+        'latency p99:          %s' % ms(report.p99),
+        'allocated per login:  %s KiB' % optional(
+            report.alloc_kib_per_login, '%.1f'),
+        'open sockets:         %s' % optional(report.open_sockets),
+        'upstream connections: %s' % optional(report.upstream_connections),
+        ])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--logins', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds added to each response of the stub')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='fraction of 503 responses from the stub')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--wsgi-server', action='store_true',
+                        help='serve the application over HTTP')
+    args = parser.parse_args(argv)
+
+    # The failed logins injected by --error-rate are expected
+    logging.basicConfig(level=logging.ERROR)
+
+    server = StubGoogleServer(latency=args.latency,
+                              error_rate=args.error_rate,
+                              seed=args.seed).start()
+    app = make_app(server)
+    wsgi_server = None
+    try:
+        if args.wsgi_server:
+            wsgi_server = WSGIServerThread(app).start()
+
+            def client_factory():
+                return HttpClient(wsgi_server.url)
+        else:
+            def client_factory():
+                return WebTestClient(app)
+
+        report = run_load(client_factory, args.logins, args.concurrency,
+                          server=server)
+    finally:
+        if wsgi_server is not None:
+            wsgi_server.stop()
+        server.stop()
+
+    print(format_report(report))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,6 @@
 import unittest
 
+import mock
 from pyramid.config import Configurator
 from pyramid.decorator import reify
 from pyramid.request import Request
@@ -30,6 +31,29 @@ class Base(unittest.TestCase):
         self.addCleanup(delattr, self, 'app')
         return TestApp(self.config.make_wsgi_app())
 
+    def start_flow(self, url=None):
+        """ Return a state, as issued by the signin redirect to this app """
+        from pyramid_google_login.state import COOKIE_NAME, IStateSerializer
+        serializer = self.config.registry.getUtility(IStateSerializer)
+        state, nonce = serializer.dumps(url)
+        self.app.set_cookie(COOKIE_NAME, nonce)
+        return state
+
+    def use_stub_server(self, server):
+        """Call the stub of Google with the API clients of the requests and
+        of the background services
+        """
+        from pyramid_google_login.tests.benchmarks import (
+            stub_api_client_factory)
+
+        api_client_class = stub_api_client_factory(server.url)
+        self.config.registry.registerUtility(api_client_class,
+                                             provided=IApiClientFactory)
+        patcher = mock.patch('pyramid_google_login.utility.ApiClient',
+                             api_client_class)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     def get_request(self, path='/'):
         self.app  # to bootstrap env
         request = Request.blank(path)
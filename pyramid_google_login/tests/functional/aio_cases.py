@@ -0,0 +1,222 @@
+"""Tests of pyramid_google_login.aio: Python 3.6+ syntax, imported by
+test_aio.py on these versions only
+"""
+import unittest
+
+from pyramid.decorator import reify
+
+from . import Base
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+@unittest.skipIf(aiohttp is None, 'requires aiohttp')
+class TestAsyncApiClient(Base):
+
+    def setUp(self):
+        from pyramid_google_login.tests.benchmarks import StubGoogleServer
+        self.server = StubGoogleServer().start()
+        self.addCleanup(self.server.stop)
+
+    @reify
+    def config(self):
+        _config = super(TestAsyncApiClient, self).config
+        _config.commit()
+        _config.include('pyramid_google_login.aio')
+        return _config
+
+    def get_googleapi(self, path='/?code=CODE'):
+        from pyramid_google_login.aio import AsyncApiClient
+        from pyramid_google_login.tests.benchmarks import (
+            stub_api_client_factory)
+
+        factory = stub_api_client_factory(self.server.url, AsyncApiClient)
+        return factory(self.get_request(path))
+
+    def run_async(self, coroutine_function):
+        import asyncio
+
+        async def run():
+            from pyramid_google_login.aio import IAsyncHttpSessionPool
+            try:
+                return await coroutine_function()
+            finally:
+                http_pool = self.config.registry.getUtility(
+                    IAsyncHttpSessionPool)
+                await http_pool.close()
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        return loop.run_until_complete(run())
+
+    def test_includeme(self):
+        from pyramid_google_login.aio import (AsyncApiClient,
+                                              IAsyncApiClientFactory)
+        from pyramid_google_login.utility import ApiClient, IApiClientFactory
+
+        registry = self.config.registry
+        self.assertIs(registry.getUtility(IAsyncApiClientFactory),
+                      AsyncApiClient)
+        # The sync client is kept for the views and the background services
+        self.assertIs(registry.getUtility(IApiClientFactory), ApiClient)
+        request = self.get_request()
+        self.assertIsInstance(request.googleapi_async, AsyncApiClient)
+        self.assertNotIsInstance(request.googleapi, AsyncApiClient)
+
+    def test_sync_only(self):
+        googleapi = self.get_googleapi()
+
+        with self.assertRaises(NotImplementedError):
+            googleapi.get_user_groups('TOKEN', 'bob@bob.com')
+        with self.assertRaises(NotImplementedError):
+            list(googleapi.get_users('TOKEN', ['bob@bob.com']))
+        with self.assertRaises(NotImplementedError):
+            list(googleapi.get_users_groups('TOKEN', ['bob@bob.com']))
+
+    def test_userinfo_cache(self):
+        from pyramid_google_login.cache import LRUCache
+        from pyramid_google_login.utility import IUserinfoCache
+
+        self.config.registry.registerUtility(LRUCache(maxsize=10, ttl=60),
+                                             provided=IUserinfoCache)
+        googleapi = self.get_googleapi()
+        tokens = {'access_token': 'TOKEN', 'expires_in': 3600}
+
+        first = self.run_async(
+            lambda: googleapi.get_userinfo_from_token(tokens))
+        second = self.run_async(
+            lambda: googleapi.get_userinfo_from_token(tokens))
+
+        self.assertEqual(first, second)
+        self.assertEqual(self.server.hits['/userinfo'], 1)
+
+    def test_callback_flow(self):
+        googleapi = self.get_googleapi()
+
+        async def flow():
+            tokens = await googleapi.exchange_token_from_code('http://cb')
+            userinfo = await googleapi.get_userinfo_from_token(tokens)
+            googleapi.check_hosted_domain_user(userinfo)
+            return googleapi.get_user_id_from_userinfo(userinfo)
+
+        self.assertEqual(self.run_async(flow), 'bob@bob.com')
+
+    def test_concurrent_callbacks(self):
+        import asyncio
+
+        async def many():
+            return await asyncio.gather(*[
+                self.get_googleapi().exchange_token_from_code('http://cb')
+                for _ in range(200)])
+
+        results = self.run_async(many)
+
+        self.assertEqual(len(results), 200)
+        self.assertEqual(self.server.hits['/token'], 200)
+        self.assertLessEqual(self.server.connections, 100)
+
+    def test_refresh_access_token(self):
+        googleapi = self.get_googleapi()
+        tokens = self.run_async(
+            lambda: googleapi.refresh_access_token('REFRESH'))
+        self.assertEqual(tokens['access_token'], 'ACCESS TOKEN')
+
+    def test_refresh_many(self):
+        self.server.revoked_tokens = {'REFRESH 3', 'REFRESH 7'}
+        googleapi = self.get_googleapi()
+
+        async def collect():
+            return [result async for result in googleapi.refresh_many(
+                ('REFRESH %d' % i for i in range(20)), concurrency=4)]
+
+        results = self.run_async(collect)
+
+        self.assertEqual(len(results), 20)
+        failed = set(r.refresh_token for r in results if r.error)
+        self.assertEqual(failed, {'REFRESH 3', 'REFRESH 7'})
+        self.assertEqual(self.server.hits['/token'], 20)
+
+    def test_no_code(self):
+        from pyramid_google_login.exceptions import AuthFailed
+        googleapi = self.get_googleapi('/')
+        with self.assertRaises(AuthFailed):
+            self.run_async(
+                lambda: googleapi.exchange_token_from_code('http://cb'))
+
+    def test_http_error(self):
+        from pyramid_google_login.exceptions import AuthFailed
+        googleapi = self.get_googleapi()
+        googleapi.token_endpoint = self.server.url + '/nowhere'
+        with self.assertRaises(AuthFailed):
+            self.run_async(
+                lambda: googleapi.exchange_token_from_code('http://cb'))
+
+    def test_token_transport_error(self):
+        import mock
+        from pyramid_google_login.exceptions import AuthFailed
+        from pyramid_google_login.ratelimit import RateLimitedError
+        googleapi = self.get_googleapi()
+
+        calls = (lambda: googleapi.exchange_token_from_code('http://cb'),
+                 lambda: googleapi.refresh_access_token('REFRESH'))
+        for call in calls:
+            with mock.patch.object(googleapi, 'request_json',
+                                   side_effect=RateLimitedError('limited')):
+                with mock.patch('pyramid_google_login.aio.log') as log:
+                    with self.assertRaises(AuthFailed) as context:
+                        self.run_async(call)
+
+            self.assertIn('Failed to get token from Google (limited)',
+                          str(context.exception))
+            self.assertFalse(log.warning.called)
+
+    def test_userinfo_error(self):
+        from pyramid_google_login.exceptions import AuthFailed
+        googleapi = self.get_googleapi()
+        googleapi.userinfo_endpoint = self.server.url + '/nowhere'
+        with self.assertRaises(AuthFailed):
+            self.run_async(lambda: googleapi.get_userinfo_from_token(
+                {'access_token': 'TOKEN'}))
+
+    def test_domain_users_error(self):
+        from pyramid_google_login.exceptions import ApiError
+        googleapi = self.get_googleapi()
+        googleapi.domain_users_endpoint = self.server.url + '/nowhere'
+        with self.assertRaises(ApiError):
+            self.run_async(lambda: googleapi.get_domain_users('TOKEN'))
+
+    def test_domain_users_transport_error(self):
+        import asyncio
+        import mock
+        from pyramid_google_login.exceptions import ApiError
+        from pyramid_google_login.ratelimit import RateLimitedError
+        googleapi = self.get_googleapi()
+
+        for error in (RateLimitedError('limited'), asyncio.TimeoutError()):
+            with mock.patch.object(googleapi, 'request_json',
+                                   side_effect=error):
+                with self.assertRaises(ApiError):
+                    self.run_async(
+                        lambda: googleapi.get_domain_users('TOKEN'))
+
+                async def collect():
+                    return [user async for user in
+                            googleapi.iter_domain_users('TOKEN')]
+
+                with self.assertRaises(ApiError):
+                    self.run_async(collect)
+
+    def test_iter_domain_users(self):
+        self.server.users = [{'primaryEmail': '%d@bob.com' % i}
+                             for i in range(25)]
+        googleapi = self.get_googleapi()
+
+        async def collect():
+            return [user async for user in
+                    googleapi.iter_domain_users('TOKEN', page_size=10)]
+
+        self.assertEqual(self.run_async(collect), self.server.users)
+        self.assertEqual(self.server.hits['/users'], 3)
@@ -0,0 +1,108 @@
+from pyramid.decorator import reify
+
+from . import Base
+
+
+def make_user(index):
+    return {'id': str(index), 'primaryEmail': 'user%d@bob.com' % index}
+
+
+class TestBatch(Base):
+
+    def setUp(self):
+        from pyramid_google_login.tests.benchmarks import (
+            StubGoogleServer, stub_api_client_factory)
+
+        self.server = StubGoogleServer().start()
+        self.addCleanup(self.server.stop)
+        self.server.users = [make_user(i) for i in range(250)]
+        self.api_client_class = stub_api_client_factory(self.server.url)
+
+    @reify
+    def googleapi(self):
+        return self.api_client_class(self.get_request())
+
+    def test_get_users(self):
+        keys = ['user%d@bob.com' % i for i in range(250)]
+
+        results = list(self.googleapi.get_users('TOKEN', keys))
+
+        self.assertEqual(sorted(r.key for r in results), sorted(keys))
+        self.assertTrue(all(r.error is None for r in results))
+        by_key = dict((r.key, r.result) for r in results)
+        self.assertEqual(by_key['user42@bob.com'], make_user(42))
+        # 3 HTTP calls rather than 250
+        self.assertEqual(self.server.batch_sizes, [100, 100, 50])
+        self.assertEqual(self.server.hits['/batch/directory'], 3)
+
+    def test_get_users_by_id(self):
+        results = list(self.googleapi.get_users('TOKEN', ['7']))
+
+        self.assertEqual(results[0].result, make_user(7))
+
+    def test_batch_size(self):
+        keys = ['user%d@bob.com' % i for i in range(10)]
+
+        list(self.googleapi.get_users('TOKEN', keys, batch_size=4))
+        list(self.googleapi.get_users('TOKEN', keys, batch_size=500))
+
+        self.assertEqual(self.server.batch_sizes, [4, 4, 2, 10])
+
+    def test_part_error(self):
+        from pyramid_google_login.exceptions import ApiError
+
+        results = dict((r.key, r) for r in self.googleapi.get_users(
+            'TOKEN', ['user1@bob.com', 'nobody@bob.com']))
+
+        self.assertEqual(results['user1@bob.com'].result, make_user(1))
+        self.assertIsNone(results['nobody@bob.com'].result)
+        self.assertIsInstance(results['nobody@bob.com'].error, ApiError)
+        self.assertIn('404 (Resource Not Found)',
+                      str(results['nobody@bob.com'].error))
+
+    def test_get_userinfos(self):
+        from pyramid_google_login.exceptions import ApiError
+
+        self.server.userinfos = {
+            'TOKEN1': {'email': 'alice@bob.com', 'hd': 'bob.com'},
+            }
+        self.server.revoked_tokens.add('REVOKED')
+
+        results = dict((r.key, r) for r in self.googleapi.get_userinfos(
+            ['TOKEN1', 'REVOKED']))
+
+        self.assertEqual(results['TOKEN1'].result['email'], 'alice@bob.com')
+        self.assertIsInstance(results['REVOKED'].error, ApiError)
+        self.assertEqual(self.server.batch_sizes, [2])
+
+    def test_lazy(self):
+        def keys():
+            for i in range(250):
+                yield 'user%d@bob.com' % i
+
+        results = self.googleapi.get_users('TOKEN', keys())
+        next(results)
+        results.close()
+
+        self.assertEqual(self.server.batch_sizes, [100])
+
+    def test_batch_failure(self):
+        from pyramid_google_login.exceptions import ApiError
+
+        self.server.error_rate = 1
+
+        with self.assertRaises(ApiError):
+            list(self.googleapi.get_users('TOKEN', ['user1@bob.com']))
+
+    def test_missing_part(self):
+        import mock
+        from pyramid_google_login.exceptions import ApiError
+
+        with mock.patch.object(self.googleapi, 'send_batch',
+                               return_value=iter([(0, {'id': '0'}, None)])):
+            results = list(self.googleapi.get_users(
+                'TOKEN', ['user0@bob.com', 'user1@bob.com']))
+
+        self.assertEqual(results[0].result, {'id': '0'})
+        self.assertEqual(results[1].key, 'user1@bob.com')
+        self.assertIsInstance(results[1].error, ApiError)
@@ -0,0 +1,161 @@
+import os
+import shutil
+import tempfile
+import time
+
+import mock
+from pyramid.config import Configurator
+
+from . import Base
+
+
+def make_user(index, name=None, etag='etag0'):
+    return {'id': str(index),
+            'etag': etag,
+            'primaryEmail': 'user%d@bob.com' % index,
+            'name': {'fullName': name or 'User %d' % index}}
+
+
+class TestDirectorySnapshot(Base):
+
+    def get_snapshot(self, users):
+        from pyramid_google_login.directory import DirectorySnapshot
+        return DirectorySnapshot(users)
+
+    def test_indexes(self):
+        user = make_user(1)
+        user['aliases'] = ['Alias@bob.com']
+        snapshot = self.get_snapshot([user, make_user(2)])
+
+        self.assertEqual(len(snapshot), 2)
+        self.assertIs(snapshot.by_id['1'], user)
+        self.assertIs(snapshot.by_email['user1@bob.com'], user)
+        self.assertIs(snapshot.by_email['alias@bob.com'], user)
+
+    def test_search(self):
+        users = [make_user(1, 'Bob Marley'), make_user(2, 'bobby Brown'),
+                 make_user(3, 'Alice'), make_user(4, 'Bobette')]
+        snapshot = self.get_snapshot(users)
+
+        found = snapshot.search('BOB')
+        self.assertEqual([u['id'] for u in found], ['1', '2', '4'])
+        self.assertEqual(len(snapshot.search('bob', limit=2)), 2)
+        self.assertEqual(snapshot.search('zed'), [])
+
+
+class TestDirectoryMirror(Base):
+
+    settings = dict(Base.settings, **{
+        'security.google_login.directory_mirror': 'true',
+        'security.google_login.directory_refresh_token': 'REFRESH',
+        })
+
+    def setUp(self):
+        from pyramid_google_login.tests.benchmarks import StubGoogleServer
+
+        self.server = StubGoogleServer().start()
+        self.addCleanup(self.server.stop)
+        self.server.users = [make_user(i) for i in range(5)]
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+        self.use_stub_server(self.server)
+
+    def get_mirror(self, path=None):
+        from pyramid_google_login.directory import (
+            DirectoryMirror, DirectoryStore)
+        store = DirectoryStore(path) if path else None
+        return DirectoryMirror(self.config.registry, store,
+                               refresh_token='REFRESH', page_size=2)
+
+    def test_includeme(self):
+        from pyramid_google_login.directory import IDirectoryMirror
+
+        request = self.get_request()
+        mirror = self.config.registry.getUtility(IDirectoryMirror)
+        self.assertIs(request.google_directory, mirror)
+        self.assertEqual(mirror.sync_interval, 3600)
+
+    def test_includeme_disabled(self):
+        from pyramid_google_login.directory import IDirectoryMirror
+
+        config = Configurator(settings=Base.settings)
+        config.include('pyramid_google_login.directory')
+        self.assertIsNone(config.registry.queryUtility(IDirectoryMirror))
+
+    def test_includeme_not_persisted_logged(self):
+        from pyramid_google_login.directory import IDirectoryMirror
+
+        config = Configurator(settings=self.settings)
+
+        with mock.patch('pyramid_google_login.directory.log') as log:
+            config.include('pyramid_google_login.directory')
+
+        self.assertIn('not persisted', log.info.call_args[0][0])
+        mirror = config.registry.getUtility(IDirectoryMirror)
+        self.assertIsNone(mirror.store)
+
+    def test_tenant_without_mirror(self):
+        request = self.get_request()
+        with mock.patch('pyramid_google_login.directory.get_tenant_name',
+                        return_value='other'):
+            self.assertIsNone(request.google_directory)
+
+    def test_includeme_missing_refresh_token(self):
+        settings = dict(self.settings)
+        del settings['security.google_login.directory_refresh_token']
+        config = Configurator(settings=settings)
+
+        with self.assertRaises(KeyError):
+            config.include('pyramid_google_login.directory')
+
+    def test_sync(self):
+        mirror = self.get_mirror()
+        self.assertEqual(mirror.sync(), (5, 0))
+
+        self.assertEqual(mirror.snapshot.by_email['user3@bob.com']['id'], '3')
+        self.assertEqual(self.server.hits['/token'], 1)
+        self.assertEqual(self.server.hits['/users'], 3)
+        query = self.server.users_queries[0]
+        self.assertIn('users(id,etag,primaryEmail', query['fields'][0])
+
+    def test_only_changes_stored(self):
+        mirror = self.get_mirror(os.path.join(self.tmpdir, 'dir.sqlite'))
+        mirror.sync()
+
+        self.server.users[1] = make_user(1, 'Renamed', etag='etag1')
+        del self.server.users[4]
+        self.assertEqual(mirror.sync(), (1, 1))
+
+        # Not incremental: all the users are listed again
+        self.assertEqual(self.server.hits['/users'], 5)
+
+        self.assertEqual(mirror.get('1')['name']['fullName'], 'Renamed')
+        self.assertIsNone(mirror.get('4'))
+        self.assertEqual(len(mirror.store.load()), 4)
+
+    def test_lookup_without_network(self):
+        path = os.path.join(self.tmpdir, 'directory.sqlite')
+        self.get_mirror(path).sync()
+        hits = sum(self.server.hits.values())
+
+        mirror = self.get_mirror(path)
+        mirror.sync_interval = 3600
+        self.addCleanup(mirror.stop)
+
+        self.assertEqual(mirror.lookup('USER2@bob.com')['id'], '2')
+        self.assertEqual(mirror.search('user 4')[0]['id'], '4')
+        self.assertIsNone(mirror.lookup('nobody@bob.com'))
+        self.assertEqual(sum(self.server.hits.values()), hits)
+
+    def test_background_sync(self):
+        mirror = self.get_mirror()
+        self.addCleanup(mirror.stop)
+
+        mirror.ensure_started()
+        deadline = time.time() + 5
+        while mirror.synced_at is None and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(len(mirror.snapshot), 5)
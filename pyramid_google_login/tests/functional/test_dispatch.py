@@ -0,0 +1,167 @@
+import threading
+
+import mock
+from pyramid.config import Configurator
+
+from . import Base, ApiMockBase
+
+
+class TestIncludeme(Base):
+
+    def test_settings(self):
+        from pyramid_google_login.dispatch import IDeferredDispatcher
+
+        settings = dict(self.settings)
+        settings['security.google_login.deferred_events_workers'] = '4'
+        settings['security.google_login.deferred_events_overflow'] = 'drop'
+        config = Configurator(settings=settings)
+        config.include('pyramid_google_login.dispatch')
+
+        dispatcher = config.registry.getUtility(IDeferredDispatcher)
+        self.assertEqual(dispatcher.workers, 4)
+        self.assertEqual(dispatcher.overflow, 'drop')
+
+    def test_invalid_overflow(self):
+        settings = dict(self.settings)
+        settings['security.google_login.deferred_events_overflow'] = 'block'
+        config = Configurator(settings=settings)
+
+        with self.assertRaises(ValueError):
+            config.include('pyramid_google_login.dispatch')
+
+
+class TestDeferredSubscribers(ApiMockBase):
+
+    def setUp(self):
+        self.googleapi.get_user_id_from_userinfo.return_value = 'bob@bob.com'
+        self.events = []
+        self.threads = []
+
+    @property
+    def dispatcher(self):
+        from pyramid_google_login.dispatch import IDeferredDispatcher
+        return self.config.registry.getUtility(IDeferredDispatcher)
+
+    def deferred_subscriber(self, event):
+        self.events.append(event)
+        self.threads.append(threading.current_thread())
+
+    def login(self):
+        return self.app.get('/auth/oauth2callback',
+                            params={'state': self.start_flow()},
+                            status=302)
+
+    def test_deferred(self):
+        from pyramid_google_login.events import UserLoggedIn
+
+        def set_headers(event):
+            event.headers = [('X-Logged-In', event.userid)]
+
+        self.config.add_subscriber(set_headers, UserLoggedIn)
+        self.config.add_deferred_subscriber(self.deferred_subscriber,
+                                            UserLoggedIn)
+
+        response = self.login()
+        self.dispatcher.join()
+
+        self.assertEqual(response.headers['X-Logged-In'], 'bob@bob.com')
+        self.assertEqual([e.userid for e in self.events], ['bob@bob.com'])
+        self.assertIsNot(self.threads[0], threading.current_thread())
+
+    def test_not_deferred_when_login_fails(self):
+        from pyramid_google_login.events import UserLoggedIn
+
+        self.config.add_subscriber(mock.Mock(side_effect=ValueError()),
+                                   UserLoggedIn)
+        self.config.add_deferred_subscriber(self.deferred_subscriber,
+                                            UserLoggedIn)
+
+        self.login()
+        self.dispatcher.join()
+
+        self.assertEqual(self.events, [])
+
+    def test_dotted_names(self):
+        self.config.add_deferred_subscriber(
+            self.deferred_subscriber,
+            'pyramid_google_login.events.UserLoggedIn')
+
+        self.login()
+        self.dispatcher.join()
+
+        self.assertEqual(len(self.events), 1)
+
+    def test_failing_subscriber(self):
+        from pyramid_google_login.events import UserLoggedIn
+
+        self.config.add_deferred_subscriber(mock.Mock(side_effect=ValueError),
+                                            UserLoggedIn)
+        self.config.add_deferred_subscriber(self.deferred_subscriber,
+                                            UserLoggedIn)
+
+        response = self.login()
+        self.dispatcher.join()
+
+        self.assertEqual(response.location, 'http://localhost/')
+        self.assertEqual(len(self.events), 1)
+
+
+class TestDeferredDispatcher(Base):
+
+    def get_dispatcher(self, **kwargs):
+        from pyramid_google_login.dispatch import DeferredDispatcher
+        from pyramid_google_login.events import UserLoggedOut
+        from pyramid_google_login.metrics import MetricsSink
+
+        self.events = []
+        self.metrics = MetricsSink()
+        self.metrics.incr = mock.Mock()
+        self.metrics.gauge = mock.Mock()
+        dispatcher = DeferredDispatcher(metrics=self.metrics, **kwargs)
+        dispatcher.add_subscriber(self.events.append, UserLoggedOut)
+        return dispatcher
+
+    def test_defer_after_request(self):
+        from pyramid_google_login.events import UserLoggedIn, UserLoggedOut
+
+        dispatcher = self.get_dispatcher()
+        request = mock.Mock()
+
+        dispatcher.defer(request, UserLoggedIn(request, 'bob', {}, {}))
+        self.assertFalse(request.add_finished_callback.called)
+
+        event = UserLoggedOut('bob', request)
+        dispatcher.defer(request, event)
+        callback, = request.add_finished_callback.call_args[0]
+        self.assertEqual(self.events, [])
+
+        callback(request)
+        dispatcher.join()
+        self.assertEqual(self.events, [event])
+
+    def test_overflow_inline(self):
+        from pyramid_google_login.events import UserLoggedOut
+
+        # No worker: the queue is never consumed
+        dispatcher = self.get_dispatcher(workers=0, queue_size=1)
+
+        dispatcher.submit(UserLoggedOut('alice'))
+        dispatcher.submit(UserLoggedOut('bob'))
+
+        self.assertEqual([e.userid for e in self.events], ['bob'])
+        self.metrics.incr.assert_called_with(
+            'events.inline', tags={'event': 'UserLoggedOut'})
+        self.metrics.gauge.assert_called_with('events.queue_depth', 1)
+
+    def test_overflow_drop(self):
+        from pyramid_google_login.events import UserLoggedOut
+
+        dispatcher = self.get_dispatcher(workers=0, queue_size=1,
+                                         overflow='drop')
+
+        dispatcher.submit(UserLoggedOut('alice'))
+        dispatcher.submit(UserLoggedOut('bob'))
+
+        self.assertEqual(self.events, [])
+        self.metrics.incr.assert_called_with(
+            'events.dropped', tags={'event': 'UserLoggedOut'})
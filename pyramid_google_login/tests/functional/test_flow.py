@@ -37,7 +37,7 @@ class Test(Base):
         location_base = 'https://accounts.google.com/o/oauth2/auth?'
         self.assertTrue(location.startswith(location_base))
         self.assertIn('access_type=offline', location)
-        self.assertIn('state=url%3DTEST%252FURL', location)
+        self.assertIn('state=', location)
         redir = 'redirect_uri=http%3A%2F%2Flocalhost%2Fauth%2Foauth2callback'
         self.assertIn(redir, location)
         self.assertIn('response_type=code', location)
@@ -45,9 +45,28 @@ class Test(Base):
         self.assertIn('scope=email', location)
         self.assertIn('hd=bob.com', location)
 
+        cookie = resp.headers['Set-Cookie']
+        self.assertIn('google_login_state=', cookie)
+        self.assertIn('Path=/auth/oauth2callback', cookie)
+        self.assertIn('HttpOnly', cookie)
+
+    def test_signin_redirect_state(self):
+        from six.moves.urllib import parse
+        from pyramid_google_login.state import IStateSerializer
+
+        resp = self.app.get('/auth/signin_redirect?url=TEST%2FURL',
+                            status=302)
+        query = parse.parse_qs(parse.urlparse(resp.location).query)
+
+        serializer = self.config.registry.getUtility(IStateSerializer)
+        url, nonce = serializer.loads(query['state'][0])
+        self.assertEqual(url, 'TEST/URL')
+        self.assertEqual(self.app.cookies['google_login_state'], nonce)
+
     def test_callback_error(self):
         resp = self.app.get('/auth/oauth2callback',
-                            params={'error': 'ERROR'},
+                            params={'error': 'ERROR',
+                                    'state': self.start_flow()},
                             status=302)
 
         expected = ('http://localhost/auth/signin?message='
@@ -56,6 +75,7 @@ class Test(Base):
 
     def test_callback_no_code(self):
         resp = self.app.get('/auth/oauth2callback',
+                            params={'state': self.start_flow()},
                             status=302)
 
         expected = ('http://localhost/auth/signin?message='
@@ -88,11 +108,50 @@ class TestCallback(ApiMockBase):
     def test_callback_nominal(self):
         self.googleapi.get_user_id_from_userinfo.return_value = 'bob@bob.com'
 
-        response = self.app.get('/auth/oauth2callback', status=302)
+        response = self.app.get('/auth/oauth2callback',
+                                params={'state': self.start_flow()},
+                                status=302)
         self.assertEqual(
             'http://localhost/',
             response.headers.get('Location')
             )
+        cookie = response.headers['Set-Cookie']
+        self.assertIn('google_login_state=;', cookie)
+        self.assertIn('Max-Age=0', cookie)
+
+    def test_callback_state_url(self):
+        self.googleapi.get_user_id_from_userinfo.return_value = 'bob@bob.com'
+
+        response = self.app.get('/auth/oauth2callback',
+                                params={'state': self.start_flow('/next')},
+                                status=302)
+        self.assertEqual('http://localhost/next',
+                         response.headers.get('Location'))
+
+    def test_callback_missing_state(self):
+        response = self.app.get('/auth/oauth2callback', status=302)
+        self.assertIn('Missing+state', response.headers.get('Location'))
+        self.assertFalse(self.googleapi.exchange_token_from_code.called)
+
+    def test_callback_forged_state(self):
+        state = self.start_flow()
+        forged = state[:-2] + ('AA' if state[-2:] != 'AA' else 'BB')
+
+        response = self.app.get('/auth/oauth2callback',
+                                params={'state': forged},
+                                status=302)
+        self.assertIn('Invalid+state', response.headers.get('Location'))
+        self.assertFalse(self.googleapi.exchange_token_from_code.called)
+
+    def test_callback_state_from_other_browser(self):
+        state = self.start_flow()
+        self.app.reset()
+
+        response = self.app.get('/auth/oauth2callback',
+                                params={'state': state},
+                                status=302)
+        self.assertIn('State+not+issued', response.headers.get('Location'))
+        self.assertFalse(self.googleapi.exchange_token_from_code.called)
 
     def test_callback_api_raises_exception(self):
         self.googleapi.exchange_token_from_code.side_effect = Exception('wtf')
@@ -0,0 +1,246 @@
+import time
+
+import mock
+from pyramid.config import Configurator
+
+from . import Base
+
+
+class TestGroupsResolver(Base):
+
+    settings = dict(Base.settings, **{
+        'security.google_login.groups': 'true',
+        'security.google_login.groups_refresh_token': 'REFRESH',
+        })
+
+    def setUp(self):
+        from pyramid_google_login.tests.benchmarks import StubGoogleServer
+
+        self.server = StubGoogleServer().start()
+        self.addCleanup(self.server.stop)
+        self.server.groups = {
+            'bob@bob.com': ['Admins@bob.com', 'devs@bob.com'],
+            'alice@bob.com': [],
+            }
+
+        self.use_stub_server(self.server)
+        self.addCleanup(self.resolver.stop)
+
+    @property
+    def resolver(self):
+        from pyramid_google_login.groups import IGroupsResolver
+        return self.config.registry.getUtility(IGroupsResolver)
+
+    def test_includeme(self):
+        request = self.get_request()
+        self.assertIs(request.google_groups, self.resolver)
+        self.assertEqual(self.resolver.ttl, 600)
+        self.assertEqual(self.resolver.negative_ttl, 60)
+
+    def test_missing_refresh_token(self):
+        config = Configurator(settings=dict(Base.settings, **{
+            'security.google_login.groups': 'true',
+            }))
+        with self.assertRaises(KeyError):
+            config.include('pyramid_google_login')
+
+    def wait_loaded(self, userid):
+        for _ in range(500):
+            if self.resolver.cache.get(userid) is not None:
+                return
+            time.sleep(0.01)
+        self.fail('Not loaded')
+
+    def test_principals(self):
+        resolver = self.resolver
+        resolver.load('bob@bob.com')
+        resolver.load('alice@bob.com')
+
+        principals = resolver.principals('bob@bob.com')
+
+        self.assertEqual(principals, ('group:admins@bob.com',
+                                      'group:devs@bob.com'))
+        self.assertEqual(resolver.principals('bob@bob.com'), principals)
+        self.assertEqual(resolver.principals('alice@bob.com'), ())
+        self.assertEqual(self.server.hits['/groups'], 2)
+        # The access token is reused
+        self.assertEqual(self.server.hits['/token'], 1)
+
+    def test_miss_not_blocking(self):
+        resolver = self.resolver
+        resolver.metrics = mock.Mock()
+
+        with mock.patch.object(resolver, 'schedule') as schedule:
+            self.assertEqual(resolver.principals('bob@bob.com'), ())
+
+        schedule.assert_called_once_with('bob@bob.com')
+        self.assertEqual(sum(self.server.hits.values()), 0)
+        resolver.metrics.incr.assert_called_once_with('groups.misses')
+
+    def test_miss_loaded_in_background(self):
+        resolver = self.resolver
+
+        self.assertEqual(resolver.principals('bob@bob.com'), ())
+        self.wait_loaded('bob@bob.com')
+
+        self.assertEqual(len(resolver.principals('bob@bob.com')), 2)
+        # A batch request
+        self.assertEqual(self.server.hits['/batch/directory'], 1)
+        self.assertEqual(self.server.hits['/groups'], 0)
+
+    def test_pages(self):
+        self.server.groups['bob@bob.com'] = [
+            'group%d@bob.com' % i for i in range(450)]
+
+        entry = self.resolver.load('bob@bob.com')
+
+        self.assertEqual(len(entry.principals), 450)
+        self.assertEqual(self.server.hits['/groups'], 3)
+
+    def test_pages_in_batch(self):
+        self.server.groups['bob@bob.com'] = [
+            'group%d@bob.com' % i for i in range(450)]
+
+        principals = self.resolver.resolve_many(['bob@bob.com',
+                                                 'alice@bob.com'])
+
+        self.assertEqual(len(principals['bob@bob.com']), 450)
+        self.assertEqual(principals['alice@bob.com'], ())
+        # The first pages in the batch, then the next pages of bob
+        self.assertEqual(self.server.batch_sizes, [2])
+        self.assertEqual(self.server.hits['/groups'], 2)
+
+    def test_groups_finder(self):
+        from pyramid_google_login.groups import groups_finder
+
+        self.resolver.load('bob@bob.com')
+        self.assertEqual(groups_finder('bob@bob.com', self.get_request()),
+                         ['group:admins@bob.com', 'group:devs@bob.com'])
+
+    def test_negative_cache(self):
+        resolver = self.resolver
+
+        resolver.load('eve@bob.com')
+        self.assertEqual(resolver.principals('eve@bob.com'), ())
+        self.assertEqual(resolver.principals('eve@bob.com'), ())
+
+        self.assertEqual(self.server.hits['/groups'], 1)
+        entry = resolver.cache.get('eve@bob.com')
+        self.assertLessEqual(entry.expires_at, time.time() + 60)
+
+    def test_keep_previous_groups_on_error(self):
+        resolver = self.resolver
+        resolver.load('bob@bob.com')
+        del self.server.groups['bob@bob.com']
+
+        entry = resolver.load('bob@bob.com')
+
+        self.assertEqual(len(entry.principals), 2)
+        self.assertLessEqual(entry.refresh_at, time.time() + 60)
+
+    def test_background_refresh(self):
+        resolver = self.resolver
+        self.addCleanup(resolver.stop)
+        resolver.load('bob@bob.com')
+        self.server.groups['bob@bob.com'] = ['ops@bob.com']
+        entry = resolver.cache.get('bob@bob.com')
+        resolver.cache.set('bob@bob.com', entry._replace(refresh_at=0))
+
+        # The stale entry is used while refreshed
+        self.assertEqual(len(resolver.principals('bob@bob.com')), 2)
+
+        for _ in range(100):
+            if resolver.cache.get('bob@bob.com').principals == (
+                    'group:ops@bob.com',):
+                break
+            time.sleep(0.01)
+        else:
+            self.fail('Not refreshed')
+
+    def test_resolve_many(self):
+        for i in range(20):
+            self.server.groups['user%d@bob.com' % i] = ['g%d@bob.com' % i]
+
+        self.resolver.batch_size = 8
+
+        principals = self.resolver.resolve_many(
+            'user%d@bob.com' % i for i in range(20))
+
+        self.assertEqual(len(principals), 20)
+        self.assertEqual(principals['user7@bob.com'], ('group:g7@bob.com',))
+        self.assertEqual(sorted(self.server.batch_sizes), [4, 8, 8])
+        self.assertEqual(
+            self.resolver.principals('user7@bob.com'), ('group:g7@bob.com',))
+        self.assertEqual(self.server.hits['/batch/directory'], 3)
+        self.assertEqual(self.server.hits['/groups'], 0)
+
+    def test_resolve_many_errors(self):
+        resolver = self.resolver
+        resolver.metrics = mock.Mock()
+
+        principals = resolver.resolve_many(['bob@bob.com', 'eve@bob.com'])
+
+        self.assertEqual(len(principals['bob@bob.com']), 2)
+        self.assertEqual(principals['eve@bob.com'], ())
+        entry = resolver.cache.get('eve@bob.com')
+        self.assertLessEqual(entry.expires_at, time.time() + 60)
+        resolver.metrics.incr.assert_any_call('groups.errors')
+
+    def test_fetched_at_login(self):
+        from pyramid_google_login.dispatch import IDeferredDispatcher
+        from pyramid_google_login.events import UserLoggedIn
+        from pyramid_google_login.groups import fetch_groups_at_login
+
+        event = UserLoggedIn(self.get_request(), 'bob@bob.com', {}, {})
+        fetch_groups_at_login(event)
+
+        self.assertEqual(self.server.hits['/groups'], 1)
+        self.assertEqual(len(self.resolver.cache), 1)
+        dispatcher = self.config.registry.getUtility(IDeferredDispatcher)
+        self.assertIn((fetch_groups_at_login, UserLoggedIn),
+                      dispatcher.subscribers)
+
+    def test_tenants(self):
+        from pyramid_google_login.groups import (IGroupsResolver,
+                                                 groups_finder)
+
+        config = Configurator(settings=dict(self.settings, **{
+            'security.google_login.tenants': 'acme globex',
+            'security.google_login.tenant.acme.hosts': 'acme.com',
+            'security.google_login.tenant.acme.client_id': 'acme id',
+            'security.google_login.tenant.acme.groups': 'true',
+            'security.google_login.tenant.acme.groups_refresh_token': 'R2',
+            'security.google_login.tenant.globex.hosts': 'globex.com',
+            }))
+        config.include('pyramid_google_login')
+
+        registry = config.registry
+        resolver = registry.getUtility(IGroupsResolver, name='acme')
+        self.assertEqual(resolver.tenant, 'acme')
+        self.assertEqual(resolver.refresh_token, 'R2')
+        self.assertEqual(registry.getUtility(IGroupsResolver).refresh_token,
+                         'REFRESH')
+        # Not inherited: globex has no resolver
+        self.assertIsNone(
+            registry.queryUtility(IGroupsResolver, name='globex'))
+
+        request = self.get_request()
+        request.registry = registry
+        request.host = 'globex.com'
+        self.assertEqual(groups_finder('bob@globex.com', request), [])
+
+    def test_not_enabled(self):
+        from pyramid_google_login.groups import IGroupsResolver
+
+        config = Configurator(settings=Base.settings)
+        config.include('pyramid_google_login')
+
+        self.assertIsNone(config.registry.queryUtility(IGroupsResolver))
+
+    def test_errors_counted(self):
+        resolver = self.resolver
+        resolver.metrics = mock.Mock()
+
+        resolver.load('eve@bob.com')
+
+        resolver.metrics.incr.assert_called_once_with('groups.errors')
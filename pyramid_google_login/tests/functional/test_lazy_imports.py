@@ -0,0 +1,61 @@
+import os
+import subprocess
+import sys
+import unittest
+
+import pyramid_google_login
+
+STARTUP = """
+from pyramid.config import Configurator
+config = Configurator(settings={
+    'security.google_login.client_id': 'client id',
+    'security.google_login.client_secret': 'client secret',
+    })
+config.include('pyramid_google_login')
+config.commit()
+"""
+
+# Loaded on first use only
+LAZY_MODULES = ('requests',)
+
+
+def python_env():
+    """Environment of a new interpreter importing this package"""
+    package_root = os.path.dirname(
+        os.path.dirname(os.path.abspath(pyramid_google_login.__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [package_root] + [p for p in [env.get('PYTHONPATH')] if p])
+    return env
+
+
+def loaded_modules(code):
+    """Run ``code`` in a new interpreter, return the names of the modules
+    loaded
+    """
+    code += '\nimport sys\nsys.stdout.write(" ".join(sys.modules))\n'
+    process = subprocess.Popen([sys.executable, '-c', code],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE, env=python_env())
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        raise AssertionError(stderr.decode('utf-8'))
+    return set(stdout.decode('utf-8').split())
+
+
+class TestLazyImports(unittest.TestCase):
+
+    def test_startup(self):
+        modules = loaded_modules(STARTUP)
+
+        for name in LAZY_MODULES:
+            self.assertNotIn(name, modules)
+
+    def test_signin_page_without_requests(self):
+        modules = loaded_modules(STARTUP + """
+from webtest import TestApp
+TestApp(config.make_wsgi_app()).get('/auth/signin', status=200)
+""")
+
+        self.assertIn('pyramid_mako', modules)
+        self.assertNotIn('requests', modules)
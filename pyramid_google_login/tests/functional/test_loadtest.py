@@ -0,0 +1,67 @@
+import unittest
+
+from pyramid_google_login.tests.benchmarks import StubGoogleServer
+from pyramid_google_login.tests.benchmarks.loadtest import (
+    HttpClient, WebTestClient, WSGIServerThread, make_app, percentile,
+    run_load)
+
+
+class TestLoad(unittest.TestCase):
+    """Correctness of the login flow under load: the timings are printed by
+    the ``bench_loadtest`` benchmark
+    """
+
+    logins = 20
+    concurrency = 4
+
+    def start_server(self, **kwargs):
+        server = StubGoogleServer(**kwargs).start()
+        self.addCleanup(server.stop)
+        return server
+
+    def test_webtest(self):
+        server = self.start_server(latency=0.002)
+        app = make_app(server)
+
+        report = run_load(lambda: WebTestClient(app), self.logins,
+                          self.concurrency, server=server, alloc_samples=1)
+
+        self.assertEqual(report.failures, 0)
+        self.assertEqual(server.hits['/token'], self.logins + 1)
+        self.assertGreaterEqual(report.p50, 2 * 0.002)
+        self.assertGreaterEqual(report.p99, report.p50)
+        # Keep-alive connections shared by the browsers
+        self.assertLessEqual(report.upstream_connections, self.concurrency)
+
+    def test_error_rate(self):
+        server = self.start_server(error_rate=0.2, seed=42)
+        app = make_app(server)
+
+        report = run_load(lambda: WebTestClient(app), self.logins,
+                          self.concurrency, server=server, alloc_samples=1)
+
+        self.assertGreater(report.failures, 0)
+        self.assertLess(report.failures, self.logins)
+
+    def test_wsgi_server(self):
+        server = self.start_server()
+        wsgi_server = WSGIServerThread(make_app(server)).start()
+        self.addCleanup(wsgi_server.stop)
+
+        report = run_load(lambda: HttpClient(wsgi_server.url), self.logins,
+                          self.concurrency, server=server, alloc_samples=1)
+
+        self.assertEqual(report.failures, 0)
+        self.assertGreater(report.throughput, 0)
+        self.assertLessEqual(report.upstream_connections, self.concurrency)
+
+
+class TestPercentile(unittest.TestCase):
+
+    def test_percentile(self):
+        values = list(range(101))
+        self.assertEqual(percentile(values, 0.5), 50)
+        self.assertEqual(percentile(values, 0.99), 99)
+
+    def test_empty(self):
+        self.assertIsNone(percentile([], 0.5))
@@ -0,0 +1,156 @@
+import os
+
+import mock
+from pyramid.config import Configurator
+from pyramid.exceptions import ConfigurationError
+
+from . import Base, ApiMockBase
+
+
+class TestIncludeme(Base):
+
+    def include(self, **extra):
+        settings = dict(self.settings)
+        settings.update(('security.google_login.' + key, value)
+                        for key, value in extra.items())
+        config = Configurator(settings=settings)
+        config.include('pyramid_google_login.metrics')
+        return config
+
+    def test_default(self):
+        from pyramid_google_login.metrics import IMetricsSink, MetricsSink
+
+        config = self.include()
+        sink = config.registry.getUtility(IMetricsSink)
+        self.assertIs(type(sink), MetricsSink)
+
+    def test_multiple_sinks(self):
+        from pyramid_google_login.metrics import (IMetricsSink, LoggingSink,
+                                                  MultiSink, StatsdSink)
+
+        config = self.include(metrics_sinks='logging statsd',
+                              metrics_statsd_port='9125',
+                              metrics_prefix='myapp.login')
+        sink = config.registry.getUtility(IMetricsSink)
+        self.assertIsInstance(sink, MultiSink)
+        logging_sink, statsd_sink = sink.sinks
+        self.assertIsInstance(logging_sink, LoggingSink)
+        self.assertIsInstance(statsd_sink, StatsdSink)
+        self.assertEqual(statsd_sink.address, ('127.0.0.1', 9125))
+        self.assertEqual(statsd_sink.name('x'), 'myapp.login.x')
+
+    def test_invalid_sink(self):
+        with self.assertRaises(ConfigurationError):
+            self.include(metrics_sinks='graphite')
+
+    def test_prometheus_path_without_sink(self):
+        with self.assertRaises(ConfigurationError):
+            self.include(metrics_prometheus_path='/metrics')
+
+
+class TestCallbackMetrics(ApiMockBase):
+
+    settings = dict(ApiMockBase.settings)
+    settings.update({
+        'security.google_login.metrics_sinks': 'prometheus',
+        'security.google_login.metrics_prometheus_path': '/auth/metrics',
+        })
+
+    def test_nominal(self):
+        self.googleapi.get_user_id_from_userinfo.return_value = 'bob@bob.com'
+
+        self.app.get('/auth/oauth2callback',
+                     params={'state': self.start_flow()},
+                     status=302)
+
+        response = self.app.get('/auth/metrics', status=200)
+        self.assertEqual(response.content_type, 'text/plain')
+        self.assertIn('google_login_callback_logins_total 1', response.text)
+        for phase in ('state', 'token_exchange', 'userinfo',
+                      'hosted_domain', 'user_id', 'event_dispatch',
+                      'remember'):
+            self.assertIn('google_login_callback_phase_seconds_count'
+                          '{phase="%s"} 1' % phase, response.text)
+
+    def test_auth_failed(self):
+        from pyramid_google_login.exceptions import AuthFailed
+
+        self.googleapi.check_hosted_domain_user.side_effect = AuthFailed('hd')
+
+        self.app.get('/auth/oauth2callback',
+                     params={'state': self.start_flow()},
+                     status=302)
+        self.app.get('/auth/oauth2callback', status=302)
+
+        response = self.app.get('/auth/metrics', status=200)
+        self.assertIn('google_login_callback_auth_failed_total'
+                      '{phase="hosted_domain"} 1', response.text)
+        self.assertIn('google_login_callback_auth_failed_total'
+                      '{phase="state"} 1', response.text)
+        self.assertNotIn('callback_logins', response.text)
+
+    def test_event_error(self):
+        self.config.add_subscriber(mock.Mock(side_effect=ValueError()),
+                                   'pyramid_google_login.events.UserLoggedIn')
+
+        self.app.get('/auth/oauth2callback',
+                     params={'state': self.start_flow()},
+                     status=302)
+
+        response = self.app.get('/auth/metrics', status=200)
+        self.assertIn('google_login_callback_errors_total'
+                      '{phase="event_dispatch"} 1', response.text)
+
+
+class TestHttpMetrics(Base):
+
+    def test_status(self):
+        from pyramid_google_login.metrics import PrometheusSink
+        from pyramid_google_login.transport import HttpSessionPool
+
+        sink = PrometheusSink()
+        pool = HttpSessionPool(metrics=sink, max_retries=0)
+        pool._session = mock.Mock()
+        pool._session.request.return_value.status_code = 503
+        pool._session.request.return_value.headers = {}
+        pool._pid = os.getpid()
+
+        pool.get('https://www.googleapis.com/oauth2/v2/userinfo')
+        pool._session.request.side_effect = IOError()
+        with self.assertRaises(IOError):
+            pool.get('https://www.googleapis.com/oauth2/v2/userinfo')
+
+        output = sink.render()
+        self.assertIn('status="503"} 1', output)
+        self.assertIn('status="error"} 1', output)
+
+
+class TestPrometheusPermission(Base):
+
+    settings = dict(Base.settings, **{
+        'security.google_login.metrics_sinks': 'prometheus',
+        'security.google_login.metrics_prometheus_path': '/auth/metrics',
+        })
+
+    def get_app(self, **extra):
+        from pyramid.authentication import AuthTktAuthenticationPolicy
+        from pyramid.authorization import ACLAuthorizationPolicy
+        from webtest import TestApp
+
+        settings = dict(self.settings)
+        settings.update(('security.google_login.' + key, value)
+                        for key, value in extra.items())
+        config = Configurator(settings=settings)
+        config.set_authentication_policy(
+            AuthTktAuthenticationPolicy('secret', hashalg='sha512'))
+        config.set_authorization_policy(ACLAuthorizationPolicy())
+        config.include('pyramid_google_login')
+        return TestApp(config.make_wsgi_app())
+
+    def test_default_permission(self):
+        self.get_app().get('/auth/metrics', status=403)
+
+    def test_no_permission_required(self):
+        app = self.get_app(
+            metrics_prometheus_permission='__no_permission_required__')
+        app.get('/auth/metrics', status=200)
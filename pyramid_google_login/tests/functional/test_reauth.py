@@ -0,0 +1,184 @@
+import mock
+from pyramid.config import Configurator
+from pyramid.exceptions import ConfigurationError
+
+from . import Base, ApiMockBase
+
+
+def set_cookies(response):
+    return '\n'.join(response.headers.getall('Set-Cookie'))
+
+
+class TestIncludeme(Base):
+
+    def test_off(self):
+        from pyramid_google_login.reauth import ISilentReauth
+
+        self.assertIsNone(self.config.registry.queryUtility(ISilentReauth))
+
+    def test_invalid_mode(self):
+        settings = dict(self.settings, **{
+            'security.google_login.silent_reauth': 'always',
+            })
+        config = Configurator(settings=settings)
+
+        with self.assertRaises(ConfigurationError):
+            config.include('pyramid_google_login.reauth')
+
+
+class TestSilentReauthToken(ApiMockBase):
+
+    settings = dict(Base.settings, **{
+        'security.google_login.silent_reauth': 'token',
+        'security.google_login.token_store': 'memory',
+        })
+
+    def setUp(self):
+        self.googleapi.exchange_token_from_code.return_value = {
+            'access_token': 'ACCESS', 'refresh_token': 'REFRESH',
+            'expires_in': 3600}
+        self.googleapi.refresh_access_token.return_value = {
+            'access_token': 'NEW ACCESS', 'expires_in': 3600}
+        self.googleapi.get_user_id_from_userinfo.return_value = 'bob@bob.com'
+
+    def login(self):
+        response = self.app.get('/auth/oauth2callback',
+                                params={'state': self.start_flow()},
+                                status=302)
+        self.assertIn('google_login_user=', set_cookies(response))
+        self.googleapi.reset_mock()
+
+    def test_returning_user(self):
+        from pyramid_google_login.events import UserLoggedIn
+
+        events = []
+        self.config.add_subscriber(events.append, UserLoggedIn)
+        self.login()
+
+        response = self.app.get('/auth/signin', params={'url': '/next'},
+                                status=302)
+
+        self.assertEqual(response.location, 'http://localhost/next')
+        self.googleapi.refresh_access_token.assert_called_once_with(
+            'REFRESH')
+        self.assertEqual(events[-1].userid, 'bob@bob.com')
+        self.assertEqual(events[-1].oauth2_token['access_token'],
+                         'NEW ACCESS')
+        tokens = self.get_request().google_tokens.store.get('bob@bob.com')
+        self.assertEqual(tokens['access_token'], 'NEW ACCESS')
+        self.assertEqual(tokens['refresh_token'], 'REFRESH')
+        # The cookie keeps its expiration
+        self.assertNotIn('google_login_user=', set_cookies(response))
+
+    def test_tokens_saved_once(self):
+        self.login()
+        request = self.get_request()
+        store = request.google_tokens.store
+
+        with mock.patch.object(store, 'set', wraps=store.set) as store_set:
+            self.app.get('/auth/signin', status=302)
+
+        self.assertEqual(store_set.call_count, 1)
+
+    def test_other_user_tokens_not_saved(self):
+        self.login()
+        self.googleapi.get_user_id_from_userinfo.return_value = 'eve@bob.com'
+
+        self.app.get('/auth/signin', status=200)
+
+        tokens = self.get_request().google_tokens.store.get('bob@bob.com')
+        self.assertEqual(tokens['access_token'], 'ACCESS')
+
+    def test_no_cookie(self):
+        self.app.get('/auth/signin', status=200)
+
+        self.assertFalse(self.googleapi.refresh_access_token.called)
+
+    def test_forged_cookie(self):
+        # A state is signed for another purpose
+        self.app.set_cookie('google_login_user',
+                            self.start_flow('bob@bob.com'))
+
+        self.app.get('/auth/signin', status=200)
+
+        self.assertFalse(self.googleapi.refresh_access_token.called)
+
+    def test_message(self):
+        self.login()
+
+        self.app.get('/auth/signin', params={'message': 'Login failed'},
+                     status=200)
+
+        self.assertFalse(self.googleapi.refresh_access_token.called)
+
+    def test_refresh_failed(self):
+        from pyramid_google_login.exceptions import AuthFailed
+
+        self.login()
+        self.googleapi.refresh_access_token.side_effect = AuthFailed(
+            'invalid_grant')
+
+        response = self.app.get('/auth/signin', status=200)
+
+        self.assertIn('google_login_user=;', set_cookies(response))
+        self.app.get('/auth/signin', status=200)
+        self.assertEqual(self.googleapi.refresh_access_token.call_count, 1)
+
+    def test_other_user(self):
+        self.login()
+        self.googleapi.get_user_id_from_userinfo.return_value = 'eve@bob.com'
+
+        self.app.get('/auth/signin', status=200)
+
+    def test_logout(self):
+        self.login()
+        self.app.set_cookie('auth_tkt', 'whatever')
+
+        response = self.app.get('/auth/logout', status=302)
+        self.assertIn('google_login_user=;', set_cookies(response))
+
+        self.app.get('/auth/signin', status=200)
+        self.assertFalse(self.googleapi.refresh_access_token.called)
+
+
+class TestSilentReauthPromptNone(ApiMockBase):
+
+    settings = dict(Base.settings, **{
+        'security.google_login.silent_reauth': 'prompt_none',
+        })
+
+    def setUp(self):
+        self.googleapi.get_user_id_from_userinfo.return_value = 'bob@bob.com'
+        self.googleapi.build_authorize_url.return_value = (
+            'https://accounts.google.com/o/oauth2/auth?a=b')
+        self.app.get('/auth/oauth2callback',
+                     params={'state': self.start_flow()},
+                     status=302)
+
+    def test_redirect(self):
+        response = self.app.get('/auth/signin', params={'url': '/next'},
+                                status=302)
+
+        self.assertEqual(response.location,
+                         'https://accounts.google.com/o/oauth2/auth?a=b')
+        state, redirect_uri, extra_params = (
+            self.googleapi.build_authorize_url.call_args[0])
+        self.assertEqual(extra_params, (('prompt', 'none'),
+                                        ('login_hint', 'bob@bob.com')))
+        self.assertIn('google_login_state=', set_cookies(response))
+
+    def test_login_required(self):
+        from pyramid_google_login.exceptions import AuthFailed
+
+        self.googleapi.exchange_token_from_code.side_effect = AuthFailed(
+            'Error from Google (login_required)')
+
+        response = self.app.get('/auth/oauth2callback',
+                                params={'state': self.start_flow('/next'),
+                                        'error': 'login_required'},
+                                status=302)
+
+        self.assertEqual(response.location,
+                         'http://localhost/auth/signin?url=%2Fnext')
+        self.assertIn('google_login_user=;', set_cookies(response))
+        self.app.get('/auth/signin', status=200)
@@ -0,0 +1,126 @@
+import time
+import unittest
+
+import mock
+from requests.exceptions import RequestException
+
+from pyramid_google_login.tests.idtoken_helpers import RsaTestKey
+
+KEY = RsaTestKey(seed=1)
+
+
+class TestSigningKeys(unittest.TestCase):
+
+    def setUp(self):
+        from pyramid_google_login.utility import SigningKeys
+
+        self.http = mock.Mock()
+        self.response = self.http.get.return_value
+        self.response.headers = {'Cache-Control': 'public, max-age=1000'}
+        self.response.json.return_value = {'keys': [KEY.jwk('kid1')]}
+        self.signing_keys = SigningKeys(self.http, refresh_ahead=100)
+
+    def test_fetch_once(self):
+        key = self.signing_keys.get_key('kid1')
+        self.assertEqual(key.n, KEY.n)
+        self.signing_keys.get_key('kid1')
+        self.assertEqual(self.http.get.call_count, 1)
+
+    def test_ttl_from_cache_control(self):
+        before = time.time()
+        self.signing_keys.get_key('kid1')
+        self.assertGreaterEqual(self.signing_keys.expires_at, before + 1000)
+        self.assertLessEqual(self.signing_keys.expires_at, time.time() + 1000)
+
+    def test_age_header(self):
+        self.assertEqual(self.signing_keys.parse_max_age(
+            {'Cache-Control': 'max-age=1000', 'Age': '300'}), 700)
+
+    def test_default_max_age(self):
+        self.assertEqual(self.signing_keys.parse_max_age({}), 3600)
+
+    def test_unknown_kid(self):
+        self.assertIsNone(self.signing_keys.get_key('kid2'))
+        # Unknown keys do not trigger a new fetch right away
+        self.assertIsNone(self.signing_keys.get_key('kid3'))
+        self.assertEqual(self.http.get.call_count, 1)
+
+    def test_refresh_ahead_in_background(self):
+        self.signing_keys.get_key('kid1')
+        self.signing_keys.expires_at = time.time() + 50
+        self.signing_keys.fetched_at -= 100
+
+        self.assertIsNotNone(self.signing_keys.get_key('kid1'))
+        self.signing_keys._refresh_thread.join()
+
+        self.assertEqual(self.http.get.call_count, 2)
+        self.assertEqual(self.signing_keys.fetch_count, 2)
+        self.assertGreater(self.signing_keys.expires_at, time.time() + 900)
+
+    def test_background_refresh_throttled(self):
+        self.signing_keys.get_key('kid1')
+        self.signing_keys.expires_at = time.time() + 50
+        self.signing_keys.fetched_at -= 100
+        self.response.raise_for_status.side_effect = RequestException()
+
+        for _ in range(3):
+            self.assertIsNotNone(self.signing_keys.get_key('kid1'))
+            self.signing_keys._refresh_thread.join()
+
+        # The failed refresh is not retried before min_fetch_interval
+        self.assertEqual(self.http.get.call_count, 2)
+
+    def test_expired_refreshed_synchronously(self):
+        self.signing_keys.get_key('kid1')
+        self.signing_keys.expires_at = self.signing_keys.fetched_at = 0
+
+        self.signing_keys.get_key('kid1')
+        self.assertEqual(self.http.get.call_count, 2)
+        self.assertIsNone(self.signing_keys._refresh_thread)
+
+    def test_stale_keys_on_failure(self):
+        self.signing_keys.get_key('kid1')
+        self.signing_keys.expires_at = self.signing_keys.fetched_at = 0
+        self.response.raise_for_status.side_effect = RequestException()
+
+        key = self.signing_keys.get_key('kid1')
+        self.assertEqual(key.n, KEY.n)
+        self.assertEqual(self.http.get.call_count, 2)
+
+    def test_failure_without_keys(self):
+        from pyramid_google_login.exceptions import AuthFailed
+        self.response.raise_for_status.side_effect = RequestException()
+
+        with self.assertRaises(AuthFailed):
+            self.signing_keys.get_key('kid1')
+
+
+class TestSigningKeysWarm(unittest.TestCase):
+
+    verifications = 2000
+
+    def setUp(self):
+        from pyramid_google_login.tests.benchmarks import StubGoogleServer
+        from pyramid_google_login.transport import HttpSessionPool
+        from pyramid_google_login.utility import SigningKeys
+
+        self.server = StubGoogleServer().start()
+        self.addCleanup(self.server.stop)
+        self.server.jwks = [KEY.jwk('kid1')]
+
+        http_pool = HttpSessionPool()
+        self.addCleanup(http_pool.close)
+        self.signing_keys = SigningKeys(http_pool)
+        self.signing_keys.certs_endpoint = self.server.url + '/certs'
+
+    def test_no_fetch_when_warm(self):
+        from pyramid_google_login.idtoken import decode_id_token
+        from pyramid_google_login.tests.idtoken_helpers import (
+            make_claims, make_id_token)
+
+        id_token = make_id_token(KEY, make_claims())
+        for _ in range(self.verifications):
+            decode_id_token(id_token, self.signing_keys.get_key, 'client id')
+
+        self.assertEqual(self.server.hits['/certs'], 1)
+        self.assertEqual(self.signing_keys.fetch_count, 1)
@@ -0,0 +1,254 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+from pyramid.config import Configurator
+
+from . import Base, ApiMockBase
+
+try:
+    from cryptography.fernet import Fernet
+except ImportError:
+    Fernet = None
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+TOKENS = {'access_token': 'A', 'refresh_token': 'R', 'expires_at': 1.0}
+
+
+class TestTokenCodec(unittest.TestCase):
+
+    def test_plain(self):
+        from pyramid_google_login.stores import TokenCodec
+        codec = TokenCodec()
+        self.assertIn('"refresh_token":"R"', codec.encode(TOKENS))
+        self.assertEqual(codec.decode(codec.encode(TOKENS)), TOKENS)
+
+    @unittest.skipIf(Fernet is None, 'requires cryptography')
+    def test_encrypted(self):
+        from pyramid_google_login.stores import TokenCodec
+        key1, key2 = Fernet.generate_key(), Fernet.generate_key()
+
+        encoded = TokenCodec([key1]).encode(TOKENS)
+        self.assertNotIn('"R"', encoded)
+        self.assertIn('encrypted_refresh_token', encoded)
+
+        # Rotation: new key first, old key still decrypts
+        self.assertEqual(TokenCodec([key2, key1]).decode(encoded), TOKENS)
+
+    @unittest.skipIf(Fernet is None, 'requires cryptography')
+    def test_encrypted_without_key(self):
+        from pyramid_google_login.stores import TokenCodec
+        encoded = TokenCodec([Fernet.generate_key()]).encode(TOKENS)
+        with self.assertRaises(ValueError):
+            TokenCodec().decode(encoded)
+
+
+class TestSqliteTokenStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'tokens.sqlite')
+
+    def get_store(self, **kwargs):
+        from pyramid_google_login.stores import SqliteTokenStore
+        kwargs.setdefault('flush_interval', 3600)
+        return SqliteTokenStore(self.path, **kwargs)
+
+    def test_write_batch(self):
+        store = self.get_store()
+        store.set('bob', TOKENS)
+        self.assertEqual(store.get('bob'), TOKENS)
+        self.assertIsNone(self.get_store().get('bob'))
+
+        store.flush()
+        self.assertEqual(self.get_store().get('bob'), TOKENS)
+
+    def test_batch_size(self):
+        store = self.get_store(batch_size=2)
+        store.set('bob', TOKENS)
+        store.set('alice', TOKENS)
+        self.assertEqual(self.get_store().get('alice'), TOKENS)
+
+    def test_delete(self):
+        store = self.get_store()
+        store.set('bob', TOKENS)
+        store.flush()
+        store.delete('bob')
+        self.assertIsNone(store.get('bob'))
+        store.flush()
+        self.assertIsNone(self.get_store().get('bob'))
+
+    def test_wal(self):
+        store = self.get_store()
+        mode, = store.connection.execute('PRAGMA journal_mode').fetchone()
+        self.assertEqual(mode, 'wal')
+
+    def test_write_failure_kept_for_next_flush(self):
+        store = self.get_store()
+        self.addCleanup(store._pending.clear)
+        store.set('bob', TOKENS)
+        store.connection.execute('DROP TABLE tokens')
+        with self.assertRaises(Exception):
+            store.flush()
+        self.assertEqual(store.get('bob'), TOKENS)
+
+
+class TestRedisTokenStore(unittest.TestCase):
+
+    def get_store(self, **kwargs):
+        from pyramid_google_login.stores import RedisTokenStore
+        self.client = mock.Mock()
+        self.pipeline = self.client.pipeline.return_value
+        kwargs.setdefault('flush_interval', 3600)
+        return RedisTokenStore(self.client, **kwargs)
+
+    def test_write_batch(self):
+        store = self.get_store(ttl=60)
+        store.set('bob', TOKENS)
+        store.set('alice', TOKENS)
+        store.flush()
+
+        self.client.pipeline.assert_called_once_with(transaction=False)
+        self.assertEqual(self.pipeline.set.call_count, 2)
+        key, data = self.pipeline.set.call_args[0]
+        self.assertTrue(key.startswith('google_login:tokens:'))
+        self.assertEqual(self.pipeline.set.call_args[1], {'ex': 60})
+        self.pipeline.execute.assert_called_once_with()
+
+    def test_read(self):
+        from pyramid_google_login.stores import TokenCodec
+        store = self.get_store()
+        self.client.get.return_value = TokenCodec().encode(
+            TOKENS).encode('utf-8')
+
+        self.assertEqual(store.get('bob'), TOKENS)
+        self.client.get.assert_called_once_with('google_login:tokens:bob')
+
+    def test_missing(self):
+        store = self.get_store()
+        self.client.get.return_value = None
+        self.assertIsNone(store.get('nobody'))
+
+    def test_delete(self):
+        store = self.get_store()
+        store.delete('bob')
+        store.flush()
+        self.pipeline.delete.assert_called_once_with(
+            'google_login:tokens:bob')
+        self.assertFalse(self.pipeline.set.called)
+
+    def test_write_failure_kept_for_next_flush(self):
+        store = self.get_store()
+        store.set('bob', TOKENS)
+        self.pipeline.execute.side_effect = IOError('down')
+
+        with self.assertRaises(IOError):
+            store.flush()
+        self.assertEqual(store.get('bob'), TOKENS)
+
+        self.pipeline.execute.side_effect = None
+        store.flush()
+        self.assertEqual(self.pipeline.set.call_count, 2)
+
+    @unittest.skipIf(redis is None, 'requires redis')
+    def test_from_url(self):
+        from pyramid_google_login.stores import RedisTokenStore
+        store = RedisTokenStore.from_url('redis://redis.local:1234/2')
+
+        kwargs = store.client.connection_pool.connection_kwargs
+        self.assertEqual(kwargs['host'], 'redis.local')
+        self.assertEqual(kwargs['port'], 1234)
+        self.assertEqual(kwargs['db'], 2)
+        self.assertEqual(kwargs['socket_timeout'], 5)
+
+    def test_abstract_base(self):
+        from pyramid_google_login.stores import BatchedTokenStore
+        with self.assertRaises(TypeError):
+            BatchedTokenStore()
+
+
+class TestIncludeme(Base):
+
+    def include(self, **settings):
+        from pyramid_google_login.stores import ITokenStore
+        settings = dict(self.settings, **dict(
+            ('security.google_login.' + k, v) for k, v in settings.items()))
+        config = Configurator(settings=settings)
+        config.include('pyramid_google_login.utility')
+        return config.registry.queryUtility(ITokenStore)
+
+    def test_no_store(self):
+        self.assertIsNone(self.include())
+
+    def test_memory(self):
+        from pyramid_google_login.stores import MemoryTokenStore
+        store = self.include(token_store='memory', token_store_maxsize='5')
+        self.assertIsInstance(store, MemoryTokenStore)
+        self.assertEqual(store.maxsize, 5)
+
+    def test_sqlite(self):
+        from pyramid_google_login.stores import SqliteTokenStore
+        store = self.include(token_store='sqlite',
+                             token_store_path=':memory:')
+        self.assertIsInstance(store, SqliteTokenStore)
+
+    @unittest.skipIf(redis is None, 'requires redis')
+    def test_redis(self):
+        from pyramid_google_login.stores import RedisTokenStore
+        store = self.include(token_store='redis',
+                             token_store_url='redis://redis.local:1234/2',
+                             token_store_ttl='60')
+        self.assertIsInstance(store, RedisTokenStore)
+        kwargs = store.client.connection_pool.connection_kwargs
+        self.assertEqual(kwargs['host'], 'redis.local')
+        self.assertEqual(kwargs['db'], 2)
+        self.assertEqual(store.ttl, 60)
+
+    def test_redis_not_installed(self):
+        from pyramid.exceptions import ConfigurationError
+        with mock.patch.dict('sys.modules', {'redis': None}):
+            with self.assertRaises(ConfigurationError):
+                self.include(token_store='redis')
+
+    def test_invalid(self):
+        from pyramid.exceptions import ConfigurationError
+        with self.assertRaises(ConfigurationError):
+            self.include(token_store='magic')
+
+    def test_used_by_token_manager(self):
+        from pyramid_google_login.stores import ITokenStore
+        from pyramid_google_login.tokens import ITokenManager
+        settings = dict(self.settings, **{
+            'security.google_login.token_store': 'memory'})
+        config = Configurator(settings=settings)
+        config.include('pyramid_google_login')
+
+        manager = config.registry.getUtility(ITokenManager)
+        self.assertIs(manager.store,
+                      config.registry.getUtility(ITokenStore))
+
+
+class TestCallbackStoresTokens(ApiMockBase):
+
+    settings = dict(Base.settings, **{
+        'security.google_login.token_store': 'memory',
+        })
+
+    def test_callback(self):
+        from pyramid_google_login.stores import ITokenStore
+        self.googleapi.exchange_token_from_code.return_value = {
+            'access_token': 'A', 'refresh_token': 'R', 'expires_in': 3600}
+        self.googleapi.get_user_id_from_userinfo.return_value = 'bob@bob.com'
+
+        self.app.get('/auth/oauth2callback',
+                     params={'state': self.start_flow()}, status=302)
+
+        store = self.config.registry.getUtility(ITokenStore)
+        self.assertEqual(store.get('bob@bob.com')['refresh_token'], 'R')
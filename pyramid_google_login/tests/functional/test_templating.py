@@ -0,0 +1,134 @@
+import os
+import shutil
+import tempfile
+
+from . import Base
+
+
+class TestSigninTemplate(Base):
+
+    def test_escaped(self):
+        response = self.app.get('/auth/signin',
+                                params={'message': '<script>'},
+                                status=200)
+
+        self.assertEqual(response.content_type, 'text/html')
+        self.assertIn('&lt;script&gt;', response.text)
+        self.assertNotIn('<script>', response.text)
+
+
+class TestMakoModuleDirectory(Base):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.settings = dict(Base.settings, **{
+            'mako.module_directory': self.cache_dir,
+            })
+
+    def test_module_written(self):
+        self.config
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+        self.app.get('/auth/signin', status=200)
+
+        modules = [name for _, _, names in os.walk(self.cache_dir)
+                   for name in names]
+        self.assertEqual(modules, ['signin.mako.py'])
+
+
+class TestSigninPageCache(Base):
+
+    @property
+    def page_cache(self):
+        from pyramid_google_login.templating import ISigninPageCache
+        return self.config.registry.getUtility(ISigninPageCache)
+
+    def test_rendered_once(self):
+        first = self.app.get('/auth/signin', status=200)
+        second = self.app.get('/auth/signin', status=200)
+
+        self.assertEqual(first.body, second.body)
+        self.assertEqual(first.etag, second.etag)
+        self.assertIsNotNone(first.last_modified)
+        self.assertEqual(first.headers['Cache-Control'], 'no-cache, private')
+        self.assertEqual(self.page_cache.cache.stats()['misses'], 1)
+        self.assertEqual(self.page_cache.cache.stats()['hits'], 1)
+
+    def test_not_modified(self):
+        etag = self.app.get('/auth/signin', status=200).etag
+
+        self.app.get('/auth/signin', headers={'If-None-Match': '"%s"' % etag},
+                     status=304)
+
+    def test_url_not_cached(self):
+        self.app.get('/auth/signin', status=200)
+        for i in range(3):
+            response = self.app.get('/auth/signin',
+                                    params={'url': '/there%d' % i},
+                                    status=200)
+            self.assertIn('signin_redirect?url=%%2Fthere%d' % i,
+                          response.text)
+            self.assertIsNone(response.etag)
+
+        # The urls of the query don't fill the cache
+        self.assertEqual(len(self.page_cache.cache), 1)
+
+    def test_by_host(self):
+        self.app.get('/auth/signin', status=200)
+        response = self.app.get('/auth/signin', extra_environ={
+            'HTTP_HOST': 'other.example.com'}, status=200)
+
+        self.assertIn('http://other.example.com/auth/signin_redirect',
+                      response.text)
+
+    def test_message_not_cached(self):
+        response = self.app.get('/auth/signin',
+                                params={'message': 'Logged out'},
+                                status=200)
+
+        self.assertIn('Logged out', response.text)
+        self.assertIsNone(response.etag)
+        self.assertEqual(len(self.page_cache.cache), 0)
+
+    def test_max_age(self):
+        self.settings = dict(Base.settings, **{
+            'security.google_login.signin_cache_max_age': '60',
+            })
+
+        response = self.app.get('/auth/signin', status=200)
+
+        self.assertEqual(response.headers['Cache-Control'],
+                         'max-age=60, private')
+
+    def test_disabled(self):
+        from pyramid_google_login.templating import ISigninPageCache
+
+        self.settings = dict(Base.settings, **{
+            'security.google_login.signin_cache_maxsize': '0',
+            })
+
+        response = self.app.get('/auth/signin', status=200)
+
+        self.assertIsNone(response.etag)
+        self.assertIsNone(
+            self.config.registry.queryUtility(ISigninPageCache))
+
+
+class TestStaticAssets(Base):
+
+    def test_fingerprinted(self):
+        import hashlib
+        import re
+
+        page = self.app.get('/auth/signin', status=200)
+        urls = re.findall(r'href="(http://localhost/static/[^"]+)"',
+                          page.text)
+        self.assertEqual(len(urls), 2)
+
+        for url in urls:
+            response = self.app.get(url, status=200)
+            token = url.split('?x=')[1]
+            self.assertEqual(hashlib.sha1(response.body).hexdigest()[:16],
+                             token)
+            self.assertEqual(response.cache_control.max_age, 31536000)
@@ -0,0 +1,185 @@
+import mock
+from pyramid.config import Configurator
+from six.moves.urllib import parse
+
+from pyramid_google_login.metrics import MetricsSink, PhaseTimer
+from pyramid_google_login.views import login
+
+from . import Base
+
+
+class TestTenants(Base):
+
+    settings = dict(Base.settings, **{
+        'security.google_login.tenants': 'acme globex',
+        'security.google_login.tenant.acme.hosts': (
+            'acme.example.com login.acme.com'),
+        'security.google_login.tenant.acme.client_id': 'acme id',
+        'security.google_login.tenant.acme.client_secret': 'acme secret',
+        'security.google_login.tenant.acme.hosted_domain': 'acme.com',
+        'security.google_login.tenant.acme.landing_url': '/acme/home',
+        'security.google_login.tenant.globex.paths': '/globex',
+        'security.google_login.tenant.globex.client_id': 'globex id',
+        'security.google_login.tenant.globex.hosted_domain': 'globex.com',
+        'security.google_login.tenant.globex.http_timeout': '1 2',
+        })
+
+    def get_api(self, host='localhost', path='/'):
+        from pyramid_google_login.utility import ApiClient
+
+        request = self.get_request(path)
+        request.host = host
+        return ApiClient(request)
+
+    def authorize_params(self, api):
+        url = api.build_authorize_url('STATE', 'http://host/callback')
+        return dict(parse.parse_qsl(parse.urlparse(url).query))
+
+    def test_by_host(self):
+        api = self.get_api(host='login.acme.com:8080')
+
+        self.assertEqual(api.tenant.name, 'acme')
+        self.assertEqual(api.id, 'acme id')
+        self.assertEqual(api.secret, 'acme secret')
+        self.assertEqual(api.hosted_domain, 'acme.com')
+        self.assertEqual(self.authorize_params(api)['client_id'], 'acme id')
+        self.assertEqual(self.authorize_params(api)['hd'], 'acme.com')
+
+    def test_by_path(self):
+        api = self.get_api(path='/globex/auth/signin')
+
+        self.assertEqual(api.tenant.name, 'globex')
+        self.assertEqual(api.id, 'globex id')
+        # Inherited from the global settings
+        self.assertEqual(api.secret, 'client secret')
+        self.assertEqual(api.http.timeout, (1.0, 2.0))
+
+    def test_no_tenant(self):
+        from pyramid_google_login.utility import IHttpSessionPool
+
+        api = self.get_api(host='other.example.com', path='/acme')
+
+        self.assertIsNone(api.tenant)
+        self.assertEqual(api.id, 'client id')
+        self.assertEqual(api.hosted_domain, 'bob.com')
+        self.assertIs(api.http,
+                      self.config.registry.getUtility(IHttpSessionPool))
+
+    def test_built_once(self):
+        first = self.get_api(host='acme.example.com')
+        second = self.get_api(host='login.acme.com')
+
+        self.assertIs(first.tenant, second.tenant)
+        self.assertIsNot(first.http, self.get_api(path='/globex').http)
+
+    def test_signin_page(self):
+        response = self.app.get('/auth/signin',
+                                extra_environ={'HTTP_HOST': 'acme.com'},
+                                status=200)
+        self.assertIn('bob.com account', response.text)
+
+        response = self.app.get('/auth/signin', extra_environ={
+            'HTTP_HOST': 'acme.example.com'}, status=200)
+        self.assertIn('acme.com account', response.text)
+
+    def test_api_client_from_registry(self):
+        from pyramid_google_login.utility import new_api_client_from_registry
+
+        self.app
+        api = new_api_client_from_registry(self.config.registry, 'acme')
+        self.assertEqual(api.id, 'acme id')
+
+        api = new_api_client_from_registry(self.config.registry)
+        self.assertEqual(api.id, 'client id')
+
+    def test_api_client_from_registry_is_sync(self):
+        from pyramid_google_login.utility import (
+            ApiClient, IApiClientFactory, new_api_client_from_registry)
+
+        self.config.registry.registerUtility(mock.Mock(),
+                                             provided=IApiClientFactory)
+
+        api = new_api_client_from_registry(self.config.registry)
+        self.assertIsInstance(api, ApiClient)
+
+    def test_tokens_stored_by_tenant(self):
+        from pyramid_google_login.stores import ITokenStore, MemoryTokenStore
+
+        self.config.registry.registerUtility(MemoryTokenStore(),
+                                             provided=ITokenStore)
+        request = self.get_request()
+        request.host = 'acme.example.com'
+
+        with mock.patch('pyramid_google_login.views.remember',
+                        return_value=[]):
+            login(request, 'bob@acme.com', {'access_token': 'A'}, {}, '/',
+                  PhaseTimer(MetricsSink(), 'callback.phase'), 'callback')
+
+        self.assertEqual(
+            request.google_tokens.get('bob@acme.com', tenant='acme')
+            ['access_token'], 'A')
+        self.assertIsNone(request.google_tokens.get('bob@acme.com'))
+
+    def test_landing_url(self):
+        from pyramid_google_login import find_landing_path
+
+        request = self.get_request()
+        self.assertEqual(find_landing_path(request), '/')
+        request.host = 'acme.example.com'
+        self.assertEqual(find_landing_path(request), '/acme/home')
+
+
+class TestTenantSettings(Base):
+
+    def get_config(self, **settings):
+        settings = dict(self.settings, **dict(
+            ('security.google_login.' + key, value)
+            for key, value in settings.items()))
+        config = Configurator(settings=settings)
+        config.include('pyramid_google_login.utility')
+        return config
+
+    def test_duplicate_host(self):
+        with self.assertRaises(ValueError):
+            self.get_config(**{'tenants': 'a b',
+                               'tenant.a.hosts': 'a.com',
+                               'tenant.b.hosts': 'A.com'})
+
+    def test_not_inherited(self):
+        import os
+        import tempfile
+
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w') as domains:
+            domains.write('example.com\n')
+
+        config = self.get_config(**{'tenants': 'a',
+                                    'tenant.a.hosts': 'a.com',
+                                    'tenant.a.hosted_domain': 'a.com',
+                                    'hosted_domain_file': path})
+
+        api_settings = config.registry.settings['googleapi_settings']
+        self.assertIn('example.com', api_settings.hosted_domains)
+        tenant = config.registry.settings['googleapi_tenants'].get('a')
+        self.assertEqual(tenant.api_settings.hosted_domain, 'a.com')
+        self.assertIsNone(tenant.api_settings.hosted_domains)
+
+    def test_duplicate_name(self):
+        with self.assertRaises(ValueError):
+            self.get_config(tenants='a a')
+
+    def test_rate_limit_per_tenant(self):
+        import tempfile
+        import shutil
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        config = self.get_config(**{'tenants': 'a',
+                                    'tenant.a.hosts': 'a.com',
+                                    'ratelimit_token': '10',
+                                    'ratelimit_path': path})
+
+        tenant = config.registry.settings['googleapi_tenants'].get('a')
+        bucket = tenant.http.rate_limiter.buckets['token']
+        self.assertEqual(bucket.path, '%s/a/token.bucket' % path)
@@ -0,0 +1,253 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import mock
+from pyramid.config import Configurator
+
+from . import Base
+
+
+@mock.patch('pyramid_google_login.tokens.new_api_client_from_registry')
+class TestTokenManager(Base):
+
+    def get_manager(self, lock_backend=None):
+        from pyramid_google_login.tokens import (
+            MemoryTokenStore, ThreadLockBackend, TokenManager)
+        return TokenManager(self.config.registry, MemoryTokenStore(),
+                            lock_backend or ThreadLockBackend(),
+                            refresh_margin=300)
+
+    def expire(self, manager, userid, expires_in=0):
+        tokens = manager.store.get(userid)
+        tokens['expires_at'] = time.time() + expires_in
+
+    def test_unknown_user(self, new_api_client):
+        self.assertIsNone(self.get_manager().get_access_token('bob'))
+
+    def test_valid_token(self, new_api_client):
+        manager = self.get_manager()
+        manager.save('bob', {'access_token': 'A1', 'refresh_token': 'R',
+                             'expires_in': 3600})
+
+        self.assertEqual(manager.get_access_token('bob'), 'A1')
+        self.assertFalse(new_api_client.called)
+
+    def test_expired_token(self, new_api_client):
+        api = new_api_client.return_value
+        api.refresh_access_token.return_value = {'access_token': 'A2',
+                                                 'expires_in': 3600}
+        manager = self.get_manager()
+        manager.save('bob', {'access_token': 'A1', 'refresh_token': 'R'})
+        self.expire(manager, 'bob')
+
+        self.assertEqual(manager.get_access_token('bob'), 'A2')
+        api.refresh_access_token.assert_called_once_with('R')
+        self.assertEqual(manager.store.get('bob')['refresh_token'], 'R')
+
+    def test_tenants(self, new_api_client):
+        api = new_api_client.return_value
+        api.refresh_access_token.return_value = {'access_token': 'A3',
+                                                 'expires_in': 3600}
+        manager = self.get_manager()
+        manager.save('bob', {'access_token': 'A1', 'refresh_token': 'R1'})
+        manager.save('bob', {'access_token': 'A2', 'refresh_token': 'R2'},
+                     tenant='acme')
+
+        self.assertEqual(manager.get_access_token('bob'), 'A1')
+        self.assertEqual(manager.get_access_token('bob', tenant='acme'), 'A2')
+        self.assertEqual(manager.get('bob', tenant='acme')['tenant'], 'acme')
+
+        self.expire(manager, 'tenant:acme:bob')
+        self.assertEqual(manager.get_access_token('bob', tenant='acme'), 'A3')
+        # Refreshed with the OAuth2 client of the tenant
+        new_api_client.assert_called_once_with(self.config.registry, 'acme')
+        self.assertEqual(manager.get_access_token('bob'), 'A1')
+
+        manager.forget('bob', tenant='acme')
+        self.assertIsNone(manager.get('bob', tenant='acme'))
+        self.assertIsNotNone(manager.get('bob'))
+
+    def test_expired_without_refresh_token(self, new_api_client):
+        manager = self.get_manager()
+        manager.save('bob', {'access_token': 'A1'})
+        self.expire(manager, 'bob')
+
+        self.assertIsNone(manager.get_access_token('bob'))
+
+    def test_refresh_failure(self, new_api_client):
+        from pyramid_google_login.exceptions import AuthFailed
+        api = new_api_client.return_value
+        api.refresh_access_token.side_effect = AuthFailed('revoked')
+        manager = self.get_manager()
+        manager.save('bob', {'access_token': 'A1', 'refresh_token': 'R'})
+        self.expire(manager, 'bob')
+
+        with self.assertRaises(AuthFailed):
+            manager.get_access_token('bob')
+
+    def test_early_refresh_in_background(self, new_api_client):
+        api = new_api_client.return_value
+        api.refresh_access_token.return_value = {'access_token': 'A2'}
+        manager = self.get_manager()
+        manager.save('bob', {'access_token': 'A1', 'refresh_token': 'R'})
+        self.expire(manager, 'bob', expires_in=60)
+
+        self.assertEqual(manager.get_access_token('bob'), 'A1')
+
+        deadline = time.time() + 5
+        while (manager.store.get('bob')['access_token'] != 'A2' and
+               time.time() < deadline):
+            time.sleep(0.01)
+        self.assertEqual(manager.get_access_token('bob'), 'A2')
+
+    def test_background_refresh_backoff(self, new_api_client):
+        from pyramid_google_login.exceptions import AuthFailed
+        api = new_api_client.return_value
+        api.refresh_access_token.side_effect = AuthFailed('revoked')
+        manager = self.get_manager()
+        manager.save('bob', {'access_token': 'A1', 'refresh_token': 'R'})
+        self.expire(manager, 'bob', expires_in=60)
+
+        self.assertEqual(manager.get_access_token('bob'), 'A1')
+        deadline = time.time() + 5
+        while 'bob' not in manager.failed_at and time.time() < deadline:
+            time.sleep(0.01)
+
+        with mock.patch('threading.Thread') as thread:
+            self.assertEqual(manager.get_access_token('bob'), 'A1')
+            self.assertFalse(thread.called)
+
+            manager.failed_at['bob'] -= manager.refresh_backoff
+            manager.get_access_token('bob')
+            self.assertEqual(thread.call_count, 1)
+
+    def test_concurrent_refresh(self, new_api_client):
+        def refresh_access_token(refresh_token):
+            time.sleep(0.2)
+            return {'access_token': 'A2', 'expires_in': 3600}
+
+        api = new_api_client.return_value
+        api.refresh_access_token.side_effect = refresh_access_token
+        manager = self.get_manager()
+        manager.save('bob', {'access_token': 'A1', 'refresh_token': 'R'})
+        self.expire(manager, 'bob')
+
+        results = []
+
+        def worker():
+            results.append(manager.get_access_token('bob'))
+
+        threads = [threading.Thread(target=worker) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, ['A2'] * 20)
+        self.assertEqual(api.refresh_access_token.call_count, 1)
+
+    def test_file_lock_backend(self, new_api_client):
+        from pyramid_google_login.tokens import FileLockBackend
+        api = new_api_client.return_value
+        api.refresh_access_token.return_value = {'access_token': 'A2'}
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        manager = self.get_manager(FileLockBackend(path))
+        manager.save('bob', {'access_token': 'A1', 'refresh_token': 'R'})
+        self.expire(manager, 'bob')
+
+        self.assertEqual(manager.get_access_token('bob'), 'A2')
+        # The lock files are removed
+        self.assertEqual(os.listdir(path), [])
+
+    def test_refreshed_by_another_process(self, new_api_client):
+        manager = self.get_manager()
+        manager.save('bob', {'access_token': 'A1', 'refresh_token': 'R'})
+
+        # Token found valid after acquiring the lock
+        tokens = manager.refresh('bob', 'R')
+        self.assertEqual(tokens['access_token'], 'A1')
+        self.assertFalse(new_api_client.called)
+
+
+class TestLockBackends(Base):
+
+    def test_thread_lock_striped(self):
+        from pyramid_google_login.tokens import ThreadLockBackend
+        backend = ThreadLockBackend(stripes=4)
+
+        for i in range(100):
+            with backend.lock('key%d' % i):
+                pass
+
+        self.assertEqual(len(backend._locks), 4)
+
+    def test_file_lock_removed_while_waiting(self):
+        from pyramid_google_login.tokens import FileLockBackend
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        backend = FileLockBackend(path)
+        holders = []
+        first_locked = threading.Event()
+        release_first = threading.Event()
+
+        def hold(name, locked=None, release=None):
+            with backend.lock('key'):
+                holders.append(name)
+                if locked is not None:
+                    locked.set()
+                    release.wait()
+                holders.append(name)
+
+        first = threading.Thread(target=hold,
+                                 args=('first', first_locked, release_first))
+        first.start()
+        first_locked.wait()
+        second = threading.Thread(target=hold, args=('second',))
+        second.start()
+        release_first.set()
+        first.join()
+        second.join()
+
+        # Never held by both at once
+        self.assertEqual(holders, ['first', 'first', 'second', 'second'])
+        self.assertEqual(os.listdir(path), [])
+
+
+class TestIncludeme(Base):
+
+    def test_request_method(self):
+        from pyramid_google_login.tokens import ITokenManager, TokenManager
+        request = self.get_request()
+        manager = self.config.registry.getUtility(ITokenManager)
+        self.assertIsInstance(manager, TokenManager)
+        self.assertIs(request.google_tokens, manager)
+
+    def test_file_lock(self):
+        from pyramid_google_login.tokens import ITokenManager, FileLockBackend
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        settings = dict(self.settings, **{
+            'security.google_login.token_lock': 'file',
+            'security.google_login.token_lock_path': path,
+            })
+        config = Configurator(settings=settings)
+        config.include('pyramid_google_login.utility')
+        config.include('pyramid_google_login.tokens')
+
+        manager = config.registry.getUtility(ITokenManager)
+        self.assertIsInstance(manager.lock_backend, FileLockBackend)
+
+    def test_invalid_lock(self):
+        from pyramid.exceptions import ConfigurationError
+        settings = dict(self.settings, **{
+            'security.google_login.token_lock': 'magic',
+            })
+        config = Configurator(settings=settings)
+
+        with self.assertRaises(ConfigurationError):
+            config.include('pyramid_google_login.tokens')
@@ -0,0 +1,669 @@
+import mock
+from pyramid.config import Configurator
+
+from . import Base
+
+
+class TestIncludeme(Base):
+
+    def test_pool_settings(self):
+        from pyramid_google_login.utility import IHttpSessionPool
+
+        settings = dict(self.settings)
+        settings['security.google_login.http_pool_maxsize'] = '42'
+        config = Configurator(settings=settings)
+        config.include('pyramid_google_login.utility')
+
+        http_pool = config.registry.getUtility(IHttpSessionPool)
+        self.assertEqual(http_pool.pool_maxsize, 42)
+        self.assertEqual(http_pool.pool_connections, 10)
+
+    def test_timeout_settings(self):
+        from pyramid_google_login.utility import IHttpSessionPool
+
+        settings = dict(self.settings)
+        settings['security.google_login.http_timeout'] = '2 5'
+        settings['security.google_login.http_timeout_certs'] = '1'
+        settings['security.google_login.circuit_breaker_threshold'] = '0'
+        config = Configurator(settings=settings)
+        config.include('pyramid_google_login.utility')
+
+        http_pool = config.registry.getUtility(IHttpSessionPool)
+        self.assertEqual(http_pool.timeout_for('token'), (2, 5))
+        self.assertEqual(http_pool.timeout_for('certs'), 1)
+        self.assertEqual(http_pool.timeout_for(None), (2, 5))
+        self.assertEqual(http_pool.breaker_threshold, 0)
+
+    def test_rate_limit_settings(self):
+        from pyramid_google_login.ratelimit import IRateLimiter
+        from pyramid_google_login.utility import IHttpSessionPool
+
+        settings = dict(self.settings)
+        settings['security.google_login.ratelimit_directory'] = '10 50'
+        config = Configurator(settings=settings)
+        config.include('pyramid_google_login.utility')
+
+        rate_limiter = config.registry.getUtility(IRateLimiter)
+        self.assertIs(config.registry.getUtility(IHttpSessionPool)
+                      .rate_limiter, rate_limiter)
+        self.assertEqual(list(rate_limiter.buckets), ['directory'])
+
+    def test_single_flight_settings(self):
+        from pyramid_google_login.utility import IHttpSessionPool
+
+        settings = dict(self.settings)
+        settings['security.google_login.http_single_flight'] = 'false'
+        config = Configurator(settings=settings)
+        config.include('pyramid_google_login.utility')
+
+        self.assertIsNone(config.registry.getUtility(IHttpSessionPool).flights)
+
+    def test_invalid_timeout_settings(self):
+        settings = dict(self.settings)
+        settings['security.google_login.http_timeout'] = '1 2 3'
+        config = Configurator(settings=settings)
+
+        with self.assertRaises(ValueError):
+            config.include('pyramid_google_login.utility')
+
+    def test_invalid_pool_settings(self):
+        settings = dict(self.settings)
+        settings['security.google_login.http_pool_maxsize'] = 'many'
+        config = Configurator(settings=settings)
+
+        with self.assertRaises(ValueError):
+            config.include('pyramid_google_login.utility')
+
+
+class TestHttpSessionPool(Base):
+
+    def get_pool(self):
+        from pyramid_google_login.transport import HttpSessionPool
+        return HttpSessionPool(pool_maxsize=3)
+
+    def test_session_is_shared(self):
+        pool = self.get_pool()
+        self.assertIs(pool.session, pool.session)
+
+    def test_adapter_pool_size(self):
+        pool = self.get_pool()
+        adapter = pool.session.get_adapter('https://accounts.google.com')
+        self.assertEqual(adapter._pool_maxsize, 3)
+
+    @mock.patch('pyramid_google_login.transport.os.getpid')
+    def test_session_renewed_after_fork(self, getpid):
+        pool = self.get_pool()
+        getpid.return_value = 1
+        parent_session = pool.session
+
+        getpid.return_value = 2
+        self.assertIsNot(pool.session, parent_session)
+
+    def test_close(self):
+        pool = self.get_pool()
+        session = pool.session
+        pool.close()
+        self.assertIsNot(pool.session, session)
+
+    @mock.patch('requests.Session')
+    def test_get(self, session_class):
+        pool = self.get_pool()
+        pool.get('http://url', params={'a': 1})
+        session_class.return_value.request.assert_called_once_with(
+            'GET', 'http://url', params={'a': 1}, timeout=(3.05, 10))
+
+    def test_connection_reused(self):
+        from pyramid_google_login.tests.benchmarks import StubGoogleServer
+        server = StubGoogleServer().start()
+        self.addCleanup(server.stop)
+        pool = self.get_pool()
+        self.addCleanup(pool.close)
+
+        for _ in range(5):
+            pool.get(server.url + '/certs').raise_for_status()
+
+        self.assertEqual(server.hits['/certs'], 5)
+        self.assertEqual(server.connections, 1)
+
+
+class TestSingleFlight(Base):
+
+    def test_concurrent_calls(self):
+        import threading
+        import time
+        from pyramid_google_login.transport import SingleFlight
+
+        flights = SingleFlight()
+        calls = []
+
+        def func():
+            calls.append(1)
+            time.sleep(0.2)
+            return 'result'
+
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(flights.do('key', func)))
+            for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, ['result'] * 10)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flights.coalesced, 9)
+        self.assertFalse(flights.in_flight('key'))
+
+    def test_exception(self):
+        from pyramid_google_login.transport import SingleFlight
+
+        flights = SingleFlight()
+
+        def func():
+            raise ValueError('oops')
+
+        with self.assertRaises(ValueError):
+            flights.do('key', func)
+        self.assertFalse(flights.in_flight('key'))
+
+    def run_shared(self, error=None, followers=3):
+        """Run a leader and followers, return the outcomes (result or
+        exception) of the followers and of the leader
+        """
+        import threading
+        import time
+        from pyramid_google_login.transport import SingleFlight
+
+        flights = SingleFlight()
+        release = threading.Event()
+
+        def func():
+            release.wait()
+            if error is not None:
+                raise error
+            return {'users': []}
+
+        def call(outcomes):
+            try:
+                outcomes.append(flights.do('key', func))
+            except BaseException as err:
+                outcomes.append(err)
+
+        leader_outcomes, outcomes = [], []
+        leader = threading.Thread(target=call, args=(leader_outcomes,))
+        leader.start()
+        while not flights.in_flight('key'):
+            time.sleep(0.001)
+        threads = [threading.Thread(target=call, args=(outcomes,))
+                   for _ in range(followers)]
+        for thread in threads:
+            thread.start()
+        while flights.coalesced < followers:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads + [leader]:
+            thread.join()
+        return outcomes, leader_outcomes[0]
+
+    def test_result_per_caller(self):
+        outcomes, leader_result = self.run_shared()
+
+        self.assertEqual(outcomes, [{'users': []}] * 3)
+        results = outcomes + [leader_result]
+        self.assertEqual(len(set(id(result) for result in results)), 4)
+
+    def test_exception_per_caller(self):
+        from pyramid_google_login.exceptions import ApiError
+
+        outcomes, leader_error = self.run_shared(ApiError('oops'))
+
+        for error in outcomes:
+            self.assertIsInstance(error, ApiError)
+            self.assertEqual(error.args, ('oops',))
+            self.assertIsNot(error, leader_error)
+            self.assertIs(getattr(error, '__cause__', leader_error),
+                          leader_error)
+
+    def test_interrupted(self):
+        from pyramid_google_login.transport import InterruptedCallError
+
+        outcomes, leader_error = self.run_shared(KeyboardInterrupt())
+
+        self.assertIsInstance(leader_error, KeyboardInterrupt)
+        for error in outcomes:
+            self.assertIsInstance(error, InterruptedCallError)
+
+
+class TestSharedGet(Base):
+
+    def setUp(self):
+        from pyramid_google_login.tests.benchmarks import StubGoogleServer
+
+        self.server = StubGoogleServer(latency=0.2).start()
+        self.addCleanup(self.server.stop)
+        self.server.users = [{'id': '1', 'primaryEmail': 'bob@bob.com'}]
+        self.use_stub_server(self.server)
+
+    def run_threads(self, target, count=10):
+        import threading
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(target()))
+                   for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    @property
+    def http_pool(self):
+        from pyramid_google_login.utility import IHttpSessionPool
+        return self.config.registry.getUtility(IHttpSessionPool)
+
+    def test_identical_calls(self):
+        request = self.get_request()
+        self.http_pool.metrics = metrics = mock.Mock()
+
+        results = self.run_threads(
+            lambda: request.googleapi.get_domain_users('TOKEN'))
+
+        self.assertEqual(results, [{'users': self.server.users}] * 10)
+        self.assertEqual(self.server.hits['/users'], 1)
+        self.assertEqual(self.http_pool.flights.coalesced, 9)
+        metrics.incr.assert_any_call('http.coalesced',
+                                     tags={'endpoint': 'directory'})
+
+    def test_different_params(self):
+        from pyramid_google_login.utility import new_api_client_from_registry
+
+        tokens = iter(['TOKEN%d' % i for i in range(3)])
+        api = new_api_client_from_registry(self.config.registry)
+
+        self.run_threads(lambda: api.get_domain_users(next(tokens)), 3)
+
+        self.assertEqual(self.server.hits['/users'], 3)
+        self.assertEqual(self.http_pool.flights.coalesced, 0)
+
+    def test_errors_shared(self):
+        from pyramid_google_login.exceptions import ApiError
+        from pyramid_google_login.utility import new_api_client_from_registry
+
+        self.server.error_rate = 1
+        self.http_pool.max_retries = 0
+        api = new_api_client_from_registry(self.config.registry)
+
+        def call():
+            try:
+                api.get_domain_users('TOKEN')
+            except ApiError as err:
+                return err
+
+        errors = self.run_threads(call, 5)
+
+        self.assertTrue(all(isinstance(err, ApiError) for err in errors))
+        self.assertEqual(self.server.hits['/users'], 1)
+
+    def test_key(self):
+        http_pool = self.http_pool
+        url = self.server.url + '/users'
+
+        with mock.patch.object(http_pool.flights, 'do_shared',
+                               return_value=(None, False)) as do_shared:
+            http_pool.shared_get(url, headers={'Authorization': 'Bearer A'})
+            http_pool.shared_get(url, headers={'Authorization': 'Bearer B'})
+            http_pool.shared_get(url, endpoint='directory')
+
+        keys = [args[0] for args, _ in do_shared.call_args_list]
+        self.assertEqual(len(set(keys)), 3)
+
+    def test_other_options_not_shared(self):
+        results = self.run_threads(
+            lambda: self.http_pool.shared_get(self.server.url + '/users',
+                                              timeout=5), 3)
+
+        self.assertEqual(len(results), 3)
+        self.assertEqual(self.server.hits['/users'], 3)
+        self.assertEqual(self.http_pool.flights.coalesced, 0)
+
+    def test_disabled(self):
+        from pyramid_google_login.utility import new_api_client_from_registry
+
+        self.http_pool.flights = None
+        api = new_api_client_from_registry(self.config.registry)
+
+        self.run_threads(lambda: api.get_domain_users('TOKEN'), 3)
+
+        self.assertEqual(self.server.hits['/users'], 3)
+
+
+@mock.patch('pyramid_google_login.transport.time.time')
+class TestCircuitBreaker(Base):
+
+    def get_breaker(self):
+        from pyramid_google_login.transport import CircuitBreaker
+        self.metrics = mock.Mock()
+        return CircuitBreaker('accounts.google.com', failure_threshold=2,
+                              reset_timeout=30, metrics=self.metrics)
+
+    def test_open_after_threshold(self, time):
+        time.return_value = 1000
+        breaker = self.get_breaker()
+
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+        self.metrics.gauge.assert_called_with(
+            'circuit_breaker.state', 1, tags={'host': 'accounts.google.com'})
+
+    def test_half_open_success(self, time):
+        time.return_value = 1000
+        breaker = self.get_breaker()
+        breaker.record_failure()
+        breaker.record_failure()
+
+        time.return_value = 1031
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, 'half_open')
+        # A single trial call at a time
+        self.assertFalse(breaker.allow())
+
+        breaker.record_success()
+        self.assertEqual(breaker.state, 'closed')
+        self.assertTrue(breaker.allow())
+        self.metrics.gauge.assert_called_with(
+            'circuit_breaker.state', 0, tags={'host': 'accounts.google.com'})
+
+    def test_half_open_failure(self, time):
+        time.return_value = 1000
+        breaker = self.get_breaker()
+        breaker.record_failure()
+        breaker.record_failure()
+
+        time.return_value = 1031
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+
+    def test_half_open_release(self, time):
+        time.return_value = 1000
+        breaker = self.get_breaker()
+        breaker.record_failure()
+        breaker.record_failure()
+
+        time.return_value = 1031
+        self.assertTrue(breaker.allow())
+        breaker.release()
+
+        self.assertEqual(breaker.state, 'half_open')
+        self.assertTrue(breaker.allow())
+
+    def test_tags(self, time):
+        from pyramid_google_login.transport import CircuitBreaker
+        metrics = mock.Mock()
+        breaker = CircuitBreaker('www.googleapis.com (directory)',
+                                 failure_threshold=1, metrics=metrics,
+                                 tags={'host': 'www.googleapis.com',
+                                       'endpoint': 'directory'})
+
+        breaker.record_failure()
+
+        metrics.gauge.assert_called_with(
+            'circuit_breaker.state', 1,
+            tags={'host': 'www.googleapis.com', 'endpoint': 'directory'})
+
+    def test_disabled(self, time):
+        from pyramid_google_login.transport import CircuitBreaker
+        breaker = CircuitBreaker('accounts.google.com', failure_threshold=0)
+        for _ in range(10):
+            breaker.record_failure()
+        self.assertTrue(breaker.allow())
+
+
+@mock.patch('pyramid_google_login.transport.time.sleep')
+class TestRetries(Base):
+
+    def get_pool(self, statuses, **kwargs):
+        from pyramid_google_login.transport import HttpSessionPool
+
+        pool = HttpSessionPool(timeouts={'userinfo': 1}, **kwargs)
+        responses = []
+        for status in statuses:
+            if isinstance(status, BaseException):
+                responses.append(status)
+            elif isinstance(status, tuple):
+                status, headers = status
+                responses.append(mock.Mock(status_code=status,
+                                           headers=headers))
+            else:
+                responses.append(mock.Mock(status_code=status, headers={}))
+        pool.send = mock.Mock(side_effect=responses)
+        pool.responses = responses
+        return pool
+
+    def test_get_retried(self, sleep):
+        pool = self.get_pool([503, 502, 200])
+
+        response = pool.get('https://www.googleapis.com/userinfo',
+                            endpoint='userinfo')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(pool.send.call_count, 3)
+        pool.send.assert_called_with(
+            'GET', 'https://www.googleapis.com/userinfo', timeout=1)
+        # The connections of the retried responses go back to the pool
+        self.assertEqual([r.close.called for r in pool.responses],
+                         [True, True, False])
+        self.assertEqual(sleep.call_count, 2)
+        for (delay,), _ in sleep.call_args_list:
+            self.assertLessEqual(delay, 0.2)
+
+    def test_retries_exhausted(self, sleep):
+        pool = self.get_pool([503, 503, 503])
+
+        response = pool.get('https://www.googleapis.com/userinfo')
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(pool.send.call_count, 3)
+
+    def test_connection_error_retried(self, sleep):
+        from requests.exceptions import ConnectionError
+        pool = self.get_pool([ConnectionError(), ConnectionError()],
+                             max_retries=1)
+
+        with self.assertRaises(ConnectionError):
+            pool.get('https://www.googleapis.com/userinfo')
+        self.assertEqual(pool.send.call_count, 2)
+
+    def test_client_error_not_retried(self, sleep):
+        pool = self.get_pool([400])
+
+        response = pool.get('https://www.googleapis.com/userinfo')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(sleep.called)
+
+    def test_post_not_retried(self, sleep):
+        pool = self.get_pool([503])
+
+        response = pool.post('https://www.googleapis.com/token')
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(pool.send.call_count, 1)
+        pool.send.assert_called_with(
+            'POST', 'https://www.googleapis.com/token', timeout=(3.05, 10))
+
+    def test_idempotent_post_retried(self, sleep):
+        pool = self.get_pool([503, 200])
+
+        response = pool.post('https://www.googleapis.com/token',
+                             idempotent=True)
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_retry_after(self, sleep):
+        pool = self.get_pool([(429, {'Retry-After': '1'}), 200])
+
+        response = pool.get('https://www.googleapis.com/userinfo')
+
+        self.assertEqual(response.status_code, 200)
+        sleep.assert_called_once_with(1)
+
+    def test_retry_after_too_long(self, sleep):
+        pool = self.get_pool([(503, {'Retry-After': '120'})])
+
+        response = pool.get('https://www.googleapis.com/userinfo')
+
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(sleep.called)
+
+    def test_retry_after_pauses_rate_limiter(self, sleep):
+        from pyramid_google_login.ratelimit import RateLimiter, TokenBucket
+        limiter = RateLimiter({'userinfo': TokenBucket(rate=100, burst=10)})
+        pool = self.get_pool([(429, {'Retry-After': '1'}), 200],
+                             rate_limiter=limiter)
+
+        pool.get('https://www.googleapis.com/userinfo', endpoint='userinfo')
+
+        # The retry waited for the paused bucket (once)
+        (delay,), _ = sleep.call_args
+        self.assertEqual(sleep.call_count, 1)
+        self.assertAlmostEqual(delay, 1, places=1)
+        stats = limiter.stats()['userinfo']
+        self.assertEqual(stats['calls'], 2)
+        self.assertEqual(stats['retry_after'], 1)
+        self.assertEqual(stats['throttled'], 1)
+
+    def test_circuit_open(self, sleep):
+        from pyramid_google_login.transport import CircuitOpenError
+        pool = self.get_pool([503] * 3, breaker_threshold=3)
+
+        pool.get('https://www.googleapis.com/userinfo')
+        with self.assertRaises(CircuitOpenError):
+            pool.get('https://www.googleapis.com/certs')
+        self.assertEqual(pool.send.call_count, 3)
+
+        # Other hosts and endpoints are not affected
+        self.assertEqual(
+            pool.breaker_for('https://accounts.google.com/').state, 'closed')
+        self.assertEqual(
+            pool.breaker_for('https://www.googleapis.com/userinfo',
+                             'userinfo').state, 'closed')
+
+    def test_circuit_per_endpoint(self, sleep):
+        from pyramid_google_login.transport import CircuitOpenError
+        pool = self.get_pool([503] * 3 + [200], breaker_threshold=3)
+
+        pool.get('https://www.googleapis.com/admin/directory/v1/users',
+                 endpoint='directory')
+        with self.assertRaises(CircuitOpenError):
+            pool.get('https://www.googleapis.com/admin/directory/v1/users',
+                     endpoint='directory')
+
+        # The logins still call Google
+        response = pool.get('https://www.googleapis.com/userinfo',
+                            endpoint='userinfo')
+        self.assertEqual(response.status_code, 200)
+
+    def test_broken_response_is_failure(self, sleep):
+        from requests.exceptions import ChunkedEncodingError
+        pool = self.get_pool([ChunkedEncodingError()], breaker_threshold=1)
+
+        with self.assertRaises(ChunkedEncodingError):
+            pool.get('https://www.googleapis.com/userinfo')
+
+        breaker = pool.breaker_for('https://www.googleapis.com/userinfo')
+        self.assertEqual(breaker.state, 'open')
+
+    def test_circuit_open_not_rate_limited(self, sleep):
+        from pyramid_google_login.transport import CircuitOpenError
+        limiter = mock.Mock()
+        pool = self.get_pool([503], breaker_threshold=1, max_retries=0,
+                             rate_limiter=limiter)
+
+        pool.get('https://www.googleapis.com/userinfo', endpoint='userinfo')
+        with self.assertRaises(CircuitOpenError):
+            pool.get('https://www.googleapis.com/userinfo',
+                     endpoint='userinfo')
+
+        self.assertEqual(limiter.acquire.call_count, 1)
+
+    def test_interrupted_trial_released(self, sleep):
+        pool = self.get_pool([503, KeyboardInterrupt(), 200],
+                             breaker_threshold=1, max_retries=0)
+
+        pool.get('https://www.googleapis.com/userinfo')
+        breaker = pool.breaker_for('https://www.googleapis.com/userinfo')
+        breaker.opened_at -= pool.breaker_reset_timeout + 1
+        with self.assertRaises(KeyboardInterrupt):
+            pool.get('https://www.googleapis.com/userinfo')
+
+        # The next call is the trial
+        response = pool.get('https://www.googleapis.com/userinfo')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(breaker.state, 'closed')
+
+
+class TestTimeout(Base):
+
+    def test_read_timeout(self):
+        from requests.exceptions import Timeout
+        from pyramid_google_login.tests.benchmarks import StubGoogleServer
+        from pyramid_google_login.transport import HttpSessionPool
+
+        server = StubGoogleServer(latency=0.5).start()
+        self.addCleanup(server.stop)
+        pool = HttpSessionPool(timeouts={'userinfo': (1, 0.05)},
+                               max_retries=0)
+        self.addCleanup(pool.close)
+
+        with self.assertRaises(Timeout):
+            pool.get(server.url + '/userinfo', endpoint='userinfo')
+
+
+class TestImapBounded(Base):
+
+    def test_results(self):
+        from pyramid_google_login.transport import imap_bounded
+
+        results = imap_bounded(lambda x: x * 2, range(100), concurrency=4)
+
+        self.assertEqual(sorted(results), [x * 2 for x in range(100)])
+
+    def test_bounded(self):
+        from pyramid_google_login.transport import imap_bounded
+
+        consumed = []
+
+        def items():
+            for x in range(1000):
+                consumed.append(x)
+                yield x
+
+        results = imap_bounded(lambda x: x, items(), concurrency=4)
+        next(results)
+        self.assertLessEqual(len(consumed), 9)
+
+        results.close()
+        self.assertLessEqual(len(consumed), 9)
+
+    def test_exception(self):
+        from pyramid_google_login.transport import imap_bounded
+
+        def func(x):
+            if x == 3:
+                raise ValueError(x)
+            return x
+
+        with self.assertRaises(ValueError):
+            list(imap_bounded(func, range(10), concurrency=2))
@@ -27,7 +27,7 @@ class TestUtility(Base):
         return ApiClient(self.get_request(path))
 
 
-@mock.patch('pyramid_google_login.utility.requests.post')
+@mock.patch('pyramid_google_login.transport.HttpSessionPool.post')
 class TestRefreshAccessToken(TestUtility):
 
     def test_nominal(self, post):
@@ -64,7 +64,7 @@ class TestRefreshAccessToken(TestUtility):
             self.googleapi.refresh_access_token('refresh token')
 
 
-@mock.patch('pyramid_google_login.utility.requests.post')
+@mock.patch('pyramid_google_login.transport.HttpSessionPool.post')
 class TestExchangeTokenFromCode(TestUtility):
 
     def test_nominal(self, post):
@@ -88,7 +88,7 @@ class TestExchangeTokenFromCode(TestUtility):
             'grant_type': 'authorization_code',
         }
 
-        post.assert_called_once_with(endpoint, data=params)
+        post.assert_called_once_with(endpoint, data=params, endpoint='token')
 
     def test_error_in_params(self, post):
         from pyramid_google_login.exceptions import AuthFailed
@@ -118,6 +118,18 @@ class TestExchangeTokenFromCode(TestUtility):
 
         self.assertTrue(post.called)
 
+    def test_circuit_open(self, post):
+        from pyramid_google_login.exceptions import AuthFailed
+        from pyramid_google_login.transport import CircuitOpenError
+        post.side_effect = CircuitOpenError('open')
+
+        googleapi = self.get_googleapi('/?code=CODE')
+        with self.assertRaises(AuthFailed) as cm:
+            googleapi.exchange_token_from_code('http://redirect_uri.com')
+
+        self.assertEqual(str(cm.exception),
+                         'Google is unavailable, retry in a moment')
+
     def test_no_token_in_response(self, post):
         from pyramid_google_login.exceptions import AuthFailed
         response = post.return_value
@@ -132,7 +144,7 @@ class TestExchangeTokenFromCode(TestUtility):
         self.assertTrue(post.called)
 
 
-@mock.patch('pyramid_google_login.utility.requests.get')
+@mock.patch('pyramid_google_login.transport.HttpSessionPool.get')
 class TestUserinfoFromToken(TestUtility):
 
     def test_nominal(self, get):
@@ -171,6 +183,40 @@ class TestCheckHostedDomainUser(TestUtility):
             self.googleapi.check_hosted_domain_user({'not_hd': 'whatever'})
 
 
+class TestCheckHostedDomainList(TestUtility):
+
+    settings = dict(Base.settings, **{
+        'security.google_login.hosted_domain': 'bob.com\n*.alice.com',
+        })
+
+    def test_allowed(self):
+        self.assertIsNone(self.googleapi.hosted_domain)
+        self.googleapi.check_hosted_domain_user({'hd': 'bob.com'})
+        self.googleapi.check_hosted_domain_user({'hd': 'eu.alice.com'})
+
+    def test_not_allowed(self):
+        from pyramid_google_login.exceptions import AuthFailed
+        for hd in ('alice.com', 'not_bob.com'):
+            with self.assertRaises(AuthFailed):
+                self.googleapi.check_hosted_domain_user({'hd': hd})
+
+    def test_no_hd_in_userinfo(self):
+        from pyramid_google_login.exceptions import AuthFailed
+        with self.assertRaises(AuthFailed):
+            self.googleapi.check_hosted_domain_user({})
+
+    def test_no_hd_in_authorize_url(self):
+        url = self.googleapi.build_authorize_url('state', 'http://redirect')
+        self.assertNotIn('hd=', url)
+
+    def test_invalid_rule(self):
+        config = Configurator(settings=dict(self.settings, **{
+            'security.google_login.hosted_domain': 'a.*.com',
+            }))
+        with self.assertRaises(ValueError):
+            config.include('pyramid_google_login.utility')
+
+
 class TestGetUserIdFromUserinfo(TestUtility):
 
     def test_nominal(self):
@@ -183,3 +229,273 @@ class TestGetUserIdFromUserinfo(TestUtility):
         from pyramid_google_login.exceptions import AuthFailed
         with self.assertRaises(AuthFailed):
             self.googleapi.get_user_id_from_userinfo({'nope': 'whatever'})
+
+
+class TestUserinfoFromIdToken(TestUtility):
+
+    settings = dict(Base.settings, **{
+        'security.google_login.userinfo_source': 'id_token',
+        })
+
+    def setUp(self):
+        from pyramid_google_login.tests.idtoken_helpers import RsaTestKey
+        self.key = RsaTestKey(seed=1)
+
+    def get_tokens(self, **claims):
+        from pyramid_google_login.tests.idtoken_helpers import (
+            make_claims, make_id_token)
+        claims.setdefault('aud', 'client id')
+        return {'access_token': 'TOKEN',
+                'id_token': make_id_token(self.key, make_claims(**claims))}
+
+    @mock.patch('pyramid_google_login.transport.HttpSessionPool.get')
+    def test_nominal(self, get):
+        get.return_value.headers = {}
+        get.return_value.json.return_value = {'keys': [self.key.jwk('kid1')]}
+
+        userinfo = self.googleapi.get_userinfo_from_token(self.get_tokens())
+
+        self.assertEqual(userinfo['email'], 'bob@bob.com')
+        self.assertEqual(userinfo['hd'], 'bob.com')
+        self.assertEqual(userinfo['id'], '42')
+        get.assert_called_once_with(
+            'https://www.googleapis.com/oauth2/v3/certs', endpoint='certs')
+
+        # Keys are cached
+        self.googleapi.get_userinfo_from_token(self.get_tokens())
+        self.assertEqual(get.call_count, 1)
+
+    @mock.patch('pyramid_google_login.transport.HttpSessionPool.get')
+    def test_certs_error(self, get):
+        from pyramid_google_login.exceptions import AuthFailed
+        get.return_value.raise_for_status.side_effect = RequestException()
+
+        with self.assertRaises(AuthFailed):
+            self.googleapi.get_userinfo_from_token(self.get_tokens())
+
+    @mock.patch('pyramid_google_login.transport.HttpSessionPool.get')
+    def test_bad_audience(self, get):
+        from pyramid_google_login.exceptions import AuthFailed
+        get.return_value.headers = {}
+        get.return_value.json.return_value = {'keys': [self.key.jwk('kid1')]}
+
+        with self.assertRaises(AuthFailed):
+            self.googleapi.get_userinfo_from_token(
+                self.get_tokens(aud='other client id'))
+
+    def test_no_id_token(self):
+        from pyramid_google_login.exceptions import AuthFailed
+        with self.assertRaises(AuthFailed):
+            self.googleapi.get_userinfo_from_token({'access_token': 'TOKEN'})
+
+    def test_openid_scope(self):
+        self.assertIn('openid', self.googleapi.scope_list)
+
+    def test_invalid_userinfo_source(self):
+        from pyramid.exceptions import ConfigurationError
+
+        settings = dict(self.settings)
+        settings['security.google_login.userinfo_source'] = 'magic'
+        config = Configurator(settings=settings)
+
+        with self.assertRaises(ConfigurationError):
+            config.include('pyramid_google_login.utility')
+
+
+class TestDomainUsers(TestUtility):
+
+    def setUp(self):
+        from pyramid_google_login.tests.benchmarks import StubGoogleServer
+        self.server = StubGoogleServer().start()
+        self.addCleanup(self.server.stop)
+        self.server.users = [{'primaryEmail': '%d@bob.com' % i}
+                             for i in range(25)]
+        self.googleapi.domain_users_endpoint = self.server.url + '/users'
+
+    def test_get_domain_users(self):
+        users = self.googleapi.get_domain_users('TOKEN', limit=10)
+        self.assertEqual(users['users'], self.server.users[:10])
+
+        query = self.server.users_queries[0]
+        self.assertEqual(query['domain'], ['bob.com'])
+        self.assertEqual(query['maxResults'], ['10'])
+
+    def test_get_domain_users_no_hosted_domain(self):
+        self.googleapi.hosted_domain = None
+        self.googleapi.get_domain_users('TOKEN')
+
+        query = self.server.users_queries[0]
+        self.assertEqual(query['customer'], ['my_customer'])
+        self.assertNotIn('domain', query)
+
+    def test_iter_domain_users(self):
+        users = list(self.googleapi.iter_domain_users('TOKEN', page_size=10))
+        self.assertEqual(users, self.server.users)
+        self.assertEqual(self.server.hits['/users'], 3)
+
+        page_tokens = [q.get('pageToken') for q in self.server.users_queries]
+        self.assertEqual(page_tokens, [None, ['10'], ['20']])
+
+    def test_iter_domain_users_no_prefetch(self):
+        users = self.googleapi.iter_domain_users('TOKEN', page_size=10,
+                                                 prefetch=False)
+        self.assertEqual(next(users), self.server.users[0])
+        self.assertEqual(self.server.hits['/users'], 1)
+        self.assertEqual(list(users), self.server.users[1:])
+
+    def test_iter_domain_users_fields(self):
+        list(self.googleapi.iter_domain_users('TOKEN', fields='primaryEmail'))
+
+        query = self.server.users_queries[0]
+        self.assertEqual(query['fields'],
+                         ['nextPageToken,users(primaryEmail)'])
+
+    def test_iter_domain_users_error(self):
+        from pyramid_google_login.exceptions import ApiError
+        self.googleapi.domain_users_endpoint = self.server.url + '/nowhere'
+
+        with self.assertRaises(ApiError):
+            list(self.googleapi.iter_domain_users('TOKEN'))
+
+    def test_iter_domain_users_error_on_next_page(self):
+        from pyramid_google_login.exceptions import ApiError
+        users = self.googleapi.iter_domain_users('TOKEN', page_size=10)
+        next(users)
+        self.googleapi.domain_users_endpoint = self.server.url + '/nowhere'
+
+        # The second page was prefetched before the endpoint changed
+        with self.assertRaises(ApiError):
+            for _ in range(19):
+                self.assertIsNotNone(next(users))
+            next(users)
+
+
+class TestRefreshMany(TestUtility):
+
+    def setUp(self):
+        from pyramid_google_login.tests.benchmarks import StubGoogleServer
+        self.server = StubGoogleServer().start()
+        self.addCleanup(self.server.stop)
+        self.googleapi.token_endpoint = self.server.url + '/token'
+
+    def test_refresh_many(self):
+        self.server.revoked_tokens = {'REFRESH 3', 'REFRESH 7'}
+
+        results = list(self.googleapi.refresh_many(
+            ('REFRESH %d' % i for i in range(50)), concurrency=4))
+
+        self.assertEqual(len(results), 50)
+        failed = dict((r.refresh_token, r.error) for r in results if r.error)
+        self.assertEqual(set(failed), {'REFRESH 3', 'REFRESH 7'})
+        self.assertIn('400', str(failed['REFRESH 3']))
+        for result in results:
+            if not result.error:
+                self.assertEqual(result.oauth2_tokens['access_token'],
+                                 'ACCESS TOKEN')
+        self.assertLessEqual(self.server.connections, 4)
+
+    def test_rate(self):
+        import time
+
+        start = time.time()
+        results = list(self.googleapi.refresh_many(
+            ['REFRESH %d' % i for i in range(10)], concurrency=2, rate=40))
+
+        self.assertEqual(len(results), 10)
+        # 2 tokens of burst, then 40 per second
+        self.assertGreaterEqual(time.time() - start, 8 / 40.0 - 0.01)
+
+
+@mock.patch('pyramid_google_login.transport.HttpSessionPool.get')
+class TestUserinfoCache(TestUtility):
+
+    settings = dict(Base.settings, **{
+        'security.google_login.userinfo_cache_maxsize': '2',
+        'security.google_login.userinfo_cache_ttl': '60',
+        })
+
+    @property
+    def cache(self):
+        from pyramid_google_login.utility import IUserinfoCache
+        return self.config.registry.getUtility(IUserinfoCache)
+
+    def test_hit(self, get):
+        get.return_value.json.side_effect = lambda: {'email': 'bob@bob.com'}
+        tokens = {'access_token': 'TOKEN'}
+
+        first = self.googleapi.get_userinfo_from_token(tokens)
+        second = self.googleapi.get_userinfo_from_token(tokens)
+
+        self.assertEqual(first, second)
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_other_token(self, get):
+        self.googleapi.get_userinfo_from_token({'access_token': 'TOKEN1'})
+        self.googleapi.get_userinfo_from_token({'access_token': 'TOKEN2'})
+        self.assertEqual(get.call_count, 2)
+
+    def test_eviction(self, get):
+        for token in ('TOKEN1', 'TOKEN2', 'TOKEN3'):
+            self.googleapi.get_userinfo_from_token({'access_token': token})
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+        self.assertEqual(self.cache.stats()['size'], 2)
+
+    def test_ttl_capped_by_expires_in(self, get):
+        from pyramid_google_login.utility import userinfo_cache_ttl
+        self.assertEqual(
+            userinfo_cache_ttl(self.cache, {'expires_in': 10}), 10)
+        self.assertEqual(
+            userinfo_cache_ttl(self.cache, {'expires_in': 3600}), 60)
+        self.assertEqual(userinfo_cache_ttl(self.cache, {}), 60)
+
+    def test_expired_token_not_cached(self, get):
+        tokens = {'access_token': 'TOKEN', 'expires_at': 0}
+        self.googleapi.get_userinfo_from_token(tokens)
+        self.googleapi.get_userinfo_from_token(tokens)
+        self.assertEqual(get.call_count, 2)
+
+    def test_error_not_cached(self, get):
+        from pyramid_google_login.exceptions import AuthFailed
+        get.side_effect = RequestException()
+        with self.assertRaises(AuthFailed):
+            self.googleapi.get_userinfo_from_token({'access_token': 'TOKEN'})
+        self.assertEqual(self.cache.stats()['size'], 0)
+
+    def test_disabled_by_default(self, get):
+        from pyramid_google_login.utility import IUserinfoCache
+        config = Configurator(settings=Base.settings)
+        config.include('pyramid_google_login.utility')
+        self.assertIsNone(config.registry.queryUtility(IUserinfoCache))
+
+
+class TestBuildAuthorizeUrl(TestUtility):
+
+    settings = dict(Base.settings, **{
+        'security.google_login.scopes': 'profile openid email',
+        })
+
+    def test_nominal(self):
+        from six.moves.urllib import parse
+
+        url = self.googleapi.build_authorize_url('STATE', 'http://cb/')
+        endpoint, query = url.split('?')
+
+        self.assertEqual(endpoint, 'https://accounts.google.com/o/oauth2/auth')
+        self.assertEqual(dict(parse.parse_qsl(query)), {
+            'response_type': 'code',
+            'client_id': 'client id',
+            'redirect_uri': 'http://cb/',
+            'scope': 'email openid profile',
+            'state': 'STATE',
+            'access_type': 'offline',
+            'hd': 'bob.com',
+            })
+
+    def test_prefix_computed_once(self):
+        settings = self.config.registry.settings['googleapi_settings']
+        self.assertEqual(settings.scope_list, ('email', 'openid', 'profile'))
+
+        url = self.googleapi.build_authorize_url('STATE', 'http://cb/')
+        self.assertTrue(url.startswith(settings.authorize_url_prefix + '&'))
@@ -0,0 +1,113 @@
+import base64
+import binascii
+import hashlib
+import json
+import random
+import time
+
+from pyramid_google_login.idtoken import SHA256_DIGEST_INFO, RsaPublicKey
+
+
+def _is_probable_prime(n, rng, rounds=20):
+    if n < 2:
+        return False
+    for p in (2, 3, 5, 7, 11, 13, 17, 19, 23, 29):
+        if n % p == 0:
+            return n == p
+    d, r = n - 1, 0
+    while d % 2 == 0:
+        d //= 2
+        r += 1
+    for _ in range(rounds):
+        x = pow(rng.randrange(2, n - 1), d, n)
+        if x in (1, n - 1):
+            continue
+        for _ in range(r - 1):
+            x = pow(x, 2, n)
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def _prime(bits, rng):
+    while True:
+        n = rng.getrandbits(bits) | (1 << (bits - 1)) | 1
+        if _is_probable_prime(n, rng):
+            return n
+
+
+def _modinv(a, m):
+    x0, x1, a0, m0 = 1, 0, a, m
+    while m0:
+        q = a0 // m0
+        a0, m0 = m0, a0 - q * m0
+        x0, x1 = x1, x0 - q * x1
+    return x0 % m
+
+
+class RsaTestKey(object):
+    """Throw-away RSA key signing test id_tokens (not for real use)"""
+
+    def __init__(self, seed=0, bits=1024, e=65537):
+        rng = random.Random(seed)
+        while True:
+            p, q = _prime(bits // 2, rng), _prime(bits // 2, rng)
+            phi = (p - 1) * (q - 1)
+            if p != q and phi % e:
+                break
+        self.n = p * q
+        self.e = e
+        self.d = _modinv(e, phi)
+        self.size = (self.n.bit_length() + 7) // 8
+
+    @property
+    def public_key(self):
+        return RsaPublicKey(self.n, self.e)
+
+    def sign(self, message):
+        digest_info = SHA256_DIGEST_INFO + hashlib.sha256(message).digest()
+        padding = self.size - len(digest_info) - 3
+        encoded = b'\x00\x01' + b'\xff' * padding + b'\x00' + digest_info
+        s = pow(int(binascii.hexlify(encoded), 16), self.d, self.n)
+        return binascii.unhexlify('%0*x' % (self.size * 2, s))
+
+    def jwk(self, kid):
+        return {'kty': 'RSA', 'alg': 'RS256', 'use': 'sig', 'kid': kid,
+                'n': _int_to_b64url(self.n), 'e': _int_to_b64url(self.e)}
+
+
+def _b64url(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=')
+
+
+def _int_to_b64url(value):
+    hexa = '%x' % value
+    return _b64url(binascii.unhexlify('0' * (len(hexa) % 2) + hexa)).decode()
+
+
+def make_claims(**claims):
+    now = int(time.time())
+    defaults = {
+        'iss': 'https://accounts.google.com',
+        'aud': 'client id',
+        'sub': '42',
+        'email': 'bob@bob.com',
+        'email_verified': True,
+        'hd': 'bob.com',
+        'iat': now,
+        'exp': now + 3600,
+    }
+    defaults.update(claims)
+    return defaults
+
+
+def make_id_token(key, claims, kid='kid1', alg='RS256'):
+    header = {'alg': alg, 'kid': kid, 'typ': 'JWT'}
+    signing_input = b'.'.join([
+        _b64url(json.dumps(header).encode('utf-8')),
+        _b64url(json.dumps(claims).encode('utf-8')),
+        ])
+    signature = _b64url(key.sign(signing_input))
+    return (signing_input + b'.' + signature).decode('ascii')
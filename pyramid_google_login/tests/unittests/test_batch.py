@@ -0,0 +1,156 @@
+import json
+import unittest
+
+RESPONSE = (
+    b'preamble\r\n'
+    b'--batch_abc\r\n'
+    b'Content-Type: application/http\r\n'
+    b'Content-ID: <response-item-0>\r\n'
+    b'\r\n'
+    b'HTTP/1.1 200 OK\r\n'
+    b'Content-Type: application/json; charset=UTF-8\r\n'
+    b'\r\n'
+    b'{"primaryEmail": "bob@bob.com"}\r\n'
+    b'--batch_abc\r\n'
+    b'Content-Type: application/http\r\n'
+    b'Content-ID: <response-item-1>\r\n'
+    b'\r\n'
+    b'HTTP/1.1 404 Not Found\r\n'
+    b'Content-Type: application/json; charset=UTF-8\r\n'
+    b'\r\n'
+    b'{"error": {"code": 404, "message": "Resource Not Found"}}\r\n'
+    b'--batch_abc--\r\n'
+    b'epilogue')
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class TestBuildBatchBody(unittest.TestCase):
+
+    def test_body(self):
+        from pyramid_google_login.batch import BatchCall, build_batch_body
+
+        body = build_batch_body(
+            [BatchCall('https://www.googleapis.com/admin/directory/v1/users'
+                       '/bob@bob.com', {'fields': 'id'}, 'TOKEN'),
+             BatchCall('https://www.googleapis.com/oauth2/v2/userinfo', {},
+                       'TOKEN2')],
+            'batch_abc')
+
+        self.assertEqual(body, (
+            b'--batch_abc\r\n'
+            b'Content-Type: application/http\r\n'
+            b'Content-ID: <item-0>\r\n'
+            b'\r\n'
+            b'GET /admin/directory/v1/users/bob@bob.com?fields=id\r\n'
+            b'Authorization: Bearer TOKEN\r\n'
+            b'\r\n'
+            b'--batch_abc\r\n'
+            b'Content-Type: application/http\r\n'
+            b'Content-ID: <item-1>\r\n'
+            b'\r\n'
+            b'GET /oauth2/v2/userinfo\r\n'
+            b'Authorization: Bearer TOKEN2\r\n'
+            b'\r\n'
+            b'--batch_abc--\r\n'))
+
+
+class TestBoundary(unittest.TestCase):
+
+    def test_boundary(self):
+        from pyramid_google_login.batch import boundary_from_content_type
+
+        self.assertEqual(boundary_from_content_type(
+            'multipart/mixed; boundary=batch_abc'), 'batch_abc')
+        self.assertEqual(boundary_from_content_type(
+            'Multipart/Mixed; charset=utf-8; boundary="batch_abc"'),
+            'batch_abc')
+
+    def test_invalid(self):
+        from pyramid_google_login.batch import boundary_from_content_type
+        from pyramid_google_login.exceptions import ApiError
+
+        for content_type in (None, 'application/json', 'multipart/mixed'):
+            with self.assertRaises(ApiError):
+                boundary_from_content_type(content_type)
+
+
+class TestIterParts(unittest.TestCase):
+
+    def parse(self, chunks):
+        from pyramid_google_login.batch import iter_parts
+        return list(iter_parts(chunks, 'batch_abc'))
+
+    def test_parts(self):
+        parts = self.parse([RESPONSE])
+
+        self.assertEqual([part.content_id for part in parts],
+                         ['response-item-0', 'response-item-1'])
+        self.assertEqual([part.status for part in parts], [200, 404])
+        self.assertEqual(parts[0].headers['content-type'],
+                         'application/json; charset=UTF-8')
+        self.assertEqual(json.loads(parts[0].body.decode('utf-8')),
+                         {'primaryEmail': 'bob@bob.com'})
+
+    def test_any_chunk_size(self):
+        expected = self.parse([RESPONSE])
+        for size in (1, 2, 3, 7, 13, 64):
+            self.assertEqual(self.parse(chunked(RESPONSE, size)), expected)
+
+    def test_streamed(self):
+        from pyramid_google_login.batch import iter_parts
+
+        chunks = iter(chunked(RESPONSE, 10))
+        parts = iter_parts(chunks, 'batch_abc')
+
+        self.assertEqual(next(parts).status, 200)
+        # The second part is not read yet
+        self.assertGreater(len(list(chunks)), 5)
+
+    def test_no_preamble(self):
+        response = RESPONSE[len(b'preamble\r\n'):]
+        self.assertEqual(len(self.parse([response])), 2)
+
+    def test_truncated(self):
+        from pyramid_google_login.exceptions import ApiError
+
+        with self.assertRaises(ApiError):
+            self.parse([RESPONSE[:-len(b'--\r\nepilogue')]])
+
+    def test_invalid_part(self):
+        from pyramid_google_login.exceptions import ApiError
+
+        with self.assertRaises(ApiError):
+            self.parse([b'--batch_abc\r\n\r\nnot http\r\n--batch_abc--'])
+
+
+class TestResultFromPart(unittest.TestCase):
+
+    def get_result(self, status, body):
+        from pyramid_google_login.batch import BatchPart, result_from_part
+        return result_from_part(BatchPart('response-item-0', status, {},
+                                          body))
+
+    def test_ok(self):
+        self.assertEqual(self.get_result(200, b'{"id": "42"}'),
+                         ({'id': '42'}, None))
+
+    def test_error(self):
+        from pyramid_google_login.exceptions import ApiError
+
+        result, error = self.get_result(
+            404, b'{"error": {"code": 404, "message": "Not Found"}}')
+
+        self.assertIsNone(result)
+        self.assertIsInstance(error, ApiError)
+        self.assertIn('404 (Not Found)', str(error))
+
+    def test_invalid_json(self):
+        from pyramid_google_login.exceptions import ApiError
+
+        result, error = self.get_result(200, b'<html>')
+
+        self.assertIsNone(result)
+        self.assertIsInstance(error, ApiError)
@@ -0,0 +1,60 @@
+import unittest
+
+import mock
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def get_cache(self, **kwargs):
+        from pyramid_google_login.cache import LRUCache
+        return LRUCache(**kwargs)
+
+    def test_get_set(self):
+        cache = self.get_cache()
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('b', 2), 2)
+
+    def test_evict_least_recently_used(self):
+        cache = self.get_cache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+
+    @mock.patch('pyramid_google_login.cache.time.time')
+    def test_ttl(self, time):
+        cache = self.get_cache(ttl=10)
+        time.return_value = 1000
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=100)
+
+        time.return_value = 1010
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 2)
+
+    def test_delete(self):
+        cache = self.get_cache()
+        cache.set('a', 1)
+        cache.delete('a')
+        cache.delete('a')
+        self.assertIsNone(cache.get('a'))
+
+    @mock.patch('pyramid_google_login.cache.time.time')
+    def test_stats(self, time):
+        time.return_value = 1000
+        cache = self.get_cache(maxsize=1, ttl=10)
+        cache.set('a', 1)
+        cache.get('a')
+        cache.get('b')
+        cache.set('b', 2)
+        time.return_value = 1010
+        cache.get('b')
+
+        self.assertEqual(cache.stats(), {'size': 0, 'hits': 1, 'misses': 2,
+                                         'evictions': 1, 'expirations': 1})
@@ -0,0 +1,173 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from pyramid_google_login import SETTINGS_PREFIX as PREFIX
+
+
+class TestDomainMatcher(unittest.TestCase):
+
+    def get_matcher(self, rules):
+        from pyramid_google_login.domains import DomainMatcher
+        return DomainMatcher(rules)
+
+    def test_exact(self):
+        matcher = self.get_matcher(['example.com', 'Example.NET'])
+
+        self.assertIn('example.com', matcher)
+        self.assertIn('EXAMPLE.com', matcher)
+        self.assertIn('example.net', matcher)
+        self.assertNotIn('sub.example.com', matcher)
+        self.assertNotIn('example.org', matcher)
+        self.assertEqual(len(matcher), 2)
+
+    def test_wildcard(self):
+        matcher = self.get_matcher(['*.partners.example.org'])
+
+        self.assertIn('acme.partners.example.org', matcher)
+        self.assertIn('a.b.partners.example.org', matcher)
+        self.assertNotIn('partners.example.org', matcher)
+        self.assertNotIn('example.org', matcher)
+        self.assertNotIn('acme.example.org', matcher)
+        self.assertNotIn('acmepartners.example.org', matcher)
+
+    def test_nested_wildcards(self):
+        matcher = self.get_matcher(['*.example.org', '*.a.example.org'])
+
+        self.assertIn('a.example.org', matcher)
+        self.assertIn('b.a.example.org', matcher)
+        self.assertEqual(len(matcher), 2)
+
+    def test_invalid(self):
+        for rule in ('', '*', '*.', 'a.*.example.org', '*.example..org'):
+            with self.assertRaises(ValueError):
+                self.get_matcher([rule])
+
+    def test_large(self):
+        matcher = self.get_matcher(
+            ['domain%d.example.com' % i for i in range(5000)] +
+            ['*.sub%d.example.net' % i for i in range(5000)])
+
+        self.assertEqual(len(matcher), 10000)
+        self.assertIn('domain4999.example.com', matcher)
+        self.assertIn('a.sub4999.example.net', matcher)
+        self.assertNotIn('domain5000.example.com', matcher)
+        self.assertNotIn('sub4999.example.net', matcher)
+
+
+class TestFileDomainMatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'domains.txt')
+        self.write('# Customers\nacme.com\n*.globex.com  # all of them\n')
+
+    def write(self, text, mtime=None):
+        with open(self.path, 'w') as fd:
+            fd.write(text)
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    def get_matcher(self, **kwargs):
+        from pyramid_google_login.domains import FileDomainMatcher
+        return FileDomainMatcher(self.path, **kwargs)
+
+    def test_load(self):
+        matcher = self.get_matcher(rules=['example.com'])
+
+        self.assertIn('example.com', matcher)
+        self.assertIn('acme.com', matcher)
+        self.assertIn('eu.globex.com', matcher)
+        self.assertNotIn('globex.com', matcher)
+        self.assertEqual(len(matcher), 3)
+
+    def test_missing_file(self):
+        os.remove(self.path)
+
+        with self.assertRaises((OSError, IOError)):
+            self.get_matcher()
+
+    def test_reload(self):
+        matcher = self.get_matcher()
+        self.write('initech.com\n', mtime=matcher.mtime + 10)
+
+        # Not checked before the reload interval
+        self.assertIn('acme.com', matcher)
+
+        matcher.checked_at = 0
+        self.assertIn('initech.com', matcher)
+        self.assertNotIn('acme.com', matcher)
+
+    def test_not_modified(self):
+        matcher = self.get_matcher()
+        matcher.checked_at = 0
+
+        with mock.patch.object(matcher, 'reload') as reload:
+            self.assertIn('acme.com', matcher)
+
+        self.assertFalse(reload.called)
+        self.assertNotEqual(matcher.checked_at, 0)
+
+    def test_keep_rules_on_error(self):
+        matcher = self.get_matcher()
+        self.write('a.*.com\n', mtime=matcher.mtime + 10)
+        matcher.checked_at = 0
+
+        self.assertIn('acme.com', matcher)
+
+        os.remove(self.path)
+        matcher.checked_at = 0
+        self.assertIn('acme.com', matcher)
+
+
+class TestHostedDomainsFromSettings(unittest.TestCase):
+
+    def get_domains(self, **settings):
+        from pyramid_google_login.domains import hosted_domains_from_settings
+        settings = dict((PREFIX + key, value)
+                        for key, value in settings.items())
+        return hosted_domains_from_settings(settings, PREFIX)
+
+    def test_none(self):
+        self.assertEqual(self.get_domains(), (None, None))
+
+    def test_single(self):
+        self.assertEqual(self.get_domains(hosted_domain='example.com'),
+                         ('example.com', None))
+
+    def test_list(self):
+        hosted_domain, matcher = self.get_domains(
+            hosted_domain='example.com\nexample.net')
+
+        self.assertIsNone(hosted_domain)
+        self.assertIn('example.net', matcher)
+
+    def test_wildcard(self):
+        hosted_domain, matcher = self.get_domains(
+            hosted_domain='*.example.com')
+
+        self.assertIsNone(hosted_domain)
+        self.assertIn('eu.example.com', matcher)
+
+    def test_file(self):
+        from pyramid_google_login.domains import FileDomainMatcher
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'domains.txt')
+        with open(path, 'w') as fd:
+            fd.write('acme.com\n')
+
+        hosted_domain, matcher = self.get_domains(
+            hosted_domain='example.com', hosted_domain_file=path,
+            hosted_domain_reload_interval='60')
+
+        self.assertIsNone(hosted_domain)
+        self.assertIsInstance(matcher, FileDomainMatcher)
+        self.assertEqual(matcher.reload_interval, 60)
+        self.assertIn('example.com', matcher)
+        self.assertIn('acme.com', matcher)
@@ -0,0 +1,133 @@
+import time
+import unittest
+
+from pyramid_google_login.tests.idtoken_helpers import (
+    RsaTestKey, make_claims, make_id_token)
+
+try:
+    import cryptography
+except ImportError:
+    cryptography = None
+
+KEY = RsaTestKey(seed=1)
+OTHER_KEY = RsaTestKey(seed=2)
+
+
+def get_key(kid):
+    return {'kid1': KEY.public_key}.get(kid)
+
+
+class TestRsaPublicKey(unittest.TestCase):
+
+    use_cryptography = True
+
+    @property
+    def public_key(self):
+        from pyramid_google_login.idtoken import RsaPublicKey
+        return RsaPublicKey(KEY.n, KEY.e,
+                            use_cryptography=self.use_cryptography)
+
+    def test_verify(self):
+        self.assertTrue(self.public_key.verify(b'hello', KEY.sign(b'hello')))
+
+    def test_verify_other_message(self):
+        self.assertFalse(self.public_key.verify(b'hell0', KEY.sign(b'hello')))
+
+    def test_verify_other_key(self):
+        self.assertFalse(
+            self.public_key.verify(b'hello', OTHER_KEY.sign(b'hello')))
+
+    def test_verify_bad_length(self):
+        self.assertFalse(self.public_key.verify(b'hello', b'\x01' * 12))
+
+    def test_verify_too_large(self):
+        signature = b'\xff' * KEY.size
+        self.assertFalse(self.public_key.verify(b'hello', signature))
+
+    def test_from_jwk(self):
+        from pyramid_google_login.idtoken import RsaPublicKey
+
+        key = RsaPublicKey.from_jwk(KEY.jwk('kid1'))
+        self.assertEqual((key.n, key.e), (KEY.n, KEY.e))
+
+    @unittest.skipIf(cryptography is None, 'requires cryptography')
+    def test_cryptography_used(self):
+        self.assertIsNotNone(KEY.public_key.crypto_key)
+
+
+class TestRsaPublicKeyPython(TestRsaPublicKey):
+
+    use_cryptography = False
+
+    def test_cryptography_used(self):
+        self.assertIsNone(self.public_key.crypto_key)
+
+
+class TestDecodeIdToken(unittest.TestCase):
+
+    def decode(self, id_token, **kwargs):
+        from pyramid_google_login.idtoken import decode_id_token
+        return decode_id_token(id_token, get_key, 'client id', **kwargs)
+
+    def assertAuthFailed(self, id_token, **kwargs):
+        from pyramid_google_login.exceptions import AuthFailed
+        with self.assertRaises(AuthFailed):
+            self.decode(id_token, **kwargs)
+
+    def test_nominal(self):
+        claims = make_claims()
+        self.assertEqual(self.decode(make_id_token(KEY, claims)), claims)
+
+    def test_malformed(self):
+        self.assertAuthFailed('not a jwt')
+        self.assertAuthFailed('a.b.c')
+
+    def test_claims_not_an_object(self):
+        for claims in (['aud', 'client id'], 'claims', 42, None):
+            self.assertAuthFailed(make_id_token(KEY, claims))
+
+    def test_unsupported_algorithm(self):
+        self.assertAuthFailed(make_id_token(KEY, make_claims(), alg='none'))
+
+    def test_unknown_key(self):
+        self.assertAuthFailed(make_id_token(KEY, make_claims(), kid='kid2'))
+
+    def test_bad_signature(self):
+        self.assertAuthFailed(make_id_token(OTHER_KEY, make_claims()))
+
+    def test_tampered_payload(self):
+        header, _, signature = make_id_token(KEY, make_claims()).split('.')
+        payload = make_id_token(KEY, make_claims(hd='evil.com')).split('.')[1]
+        self.assertAuthFailed('.'.join([header, payload, signature]))
+
+    def test_bad_issuer(self):
+        self.assertAuthFailed(
+            make_id_token(KEY, make_claims(iss='https://evil.com')))
+
+    def test_bad_audience(self):
+        self.assertAuthFailed(make_id_token(KEY, make_claims(aud='other')))
+
+    def test_expired(self):
+        claims = make_claims(exp=int(time.time()) - 120)
+        self.assertAuthFailed(make_id_token(KEY, claims))
+
+    def test_expired_within_leeway(self):
+        claims = make_claims(exp=int(time.time()) - 10)
+        self.assertEqual(self.decode(make_id_token(KEY, claims)), claims)
+
+    def test_issued_in_the_future(self):
+        claims = make_claims(iat=int(time.time()) + 3600)
+        self.assertAuthFailed(make_id_token(KEY, claims))
+
+
+class TestUserinfoFromClaims(unittest.TestCase):
+
+    def test_nominal(self):
+        from pyramid_google_login.idtoken import userinfo_from_claims
+
+        userinfo = userinfo_from_claims(make_claims(name='Bob'))
+        self.assertEqual(userinfo, {'id': '42',
+                                    'email': 'bob@bob.com',
+                                    'verified_email': True,
+                                    'hd': 'bob.com',
+                                    'name': 'Bob'})
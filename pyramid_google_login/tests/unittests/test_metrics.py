@@ -0,0 +1,132 @@
+import socket
+import unittest
+
+import mock
+
+
+class TestStatsdSink(unittest.TestCase):
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.settimeout(5)
+        self.addCleanup(self.server.close)
+
+    def make_sink(self):
+        from pyramid_google_login.metrics import StatsdSink
+        host, port = self.server.getsockname()
+        return StatsdSink(host=host, port=port)
+
+    def receive(self):
+        return self.server.recv(1024).decode('utf-8')
+
+    def test_incr(self):
+        self.make_sink().incr('callback.auth_failed',
+                              tags={'phase': 'state'})
+        self.assertEqual(self.receive(),
+                         'google_login.callback.auth_failed:1|c|#phase:state')
+
+    def test_gauge(self):
+        self.make_sink().gauge('queue', 3)
+        self.assertEqual(self.receive(), 'google_login.queue:3|g')
+
+    def test_timing(self):
+        self.make_sink().timing('callback.phase', 0.0421,
+                                tags={'phase': 'userinfo'})
+        self.assertEqual(self.receive(),
+                         'google_login.callback.phase:42|ms|#phase:userinfo')
+
+    def test_send_error(self):
+        sink = self.make_sink()
+        sink._socket = mock.Mock()
+        sink._socket.sendto.side_effect = socket.error('unreachable')
+
+        sink.incr('callback.logins')
+
+
+class TestPrometheusSink(unittest.TestCase):
+
+    def make_sink(self):
+        from pyramid_google_login.metrics import PrometheusSink
+        return PrometheusSink(buckets=(0.1, 1))
+
+    def test_counter(self):
+        sink = self.make_sink()
+        sink.incr('http.responses', tags={'status': 200})
+        sink.incr('http.responses', tags={'status': 200})
+        sink.incr('http.responses', tags={'status': 503})
+
+        self.assertEqual(sink.render(), (
+            '# TYPE google_login_http_responses_total counter\n'
+            'google_login_http_responses_total{status="200"} 2\n'
+            'google_login_http_responses_total{status="503"} 1\n'))
+
+    def test_gauge(self):
+        sink = self.make_sink()
+        sink.gauge('queue', 3)
+        sink.gauge('queue', 1)
+
+        self.assertEqual(sink.render(), (
+            '# TYPE google_login_queue gauge\n'
+            'google_login_queue 1\n'))
+
+    def test_histogram(self):
+        sink = self.make_sink()
+        sink.timing('callback.phase', 0.05, tags={'phase': 'state'})
+        sink.timing('callback.phase', 0.5, tags={'phase': 'state'})
+
+        self.assertEqual(sink.render(), (
+            '# TYPE google_login_callback_phase_seconds histogram\n'
+            'google_login_callback_phase_seconds_bucket'
+            '{phase="state",le="0.1"} 1\n'
+            'google_login_callback_phase_seconds_bucket'
+            '{phase="state",le="1"} 2\n'
+            'google_login_callback_phase_seconds_bucket'
+            '{phase="state",le="+Inf"} 2\n'
+            'google_login_callback_phase_seconds_sum{phase="state"} 0.55\n'
+            'google_login_callback_phase_seconds_count{phase="state"} 2\n'))
+
+    def test_escape_labels(self):
+        sink = self.make_sink()
+        sink.incr('errors', tags={'cause': 'say "hi"'})
+        self.assertIn('{cause="say \\"hi\\""}', sink.render())
+
+
+class TestPhaseTimer(unittest.TestCase):
+
+    def test_phases(self):
+        from pyramid_google_login.metrics import MetricsSink, PhaseTimer
+
+        sink = MetricsSink()
+        sink.timing = mock.Mock()
+        phases = PhaseTimer(sink, 'callback.phase')
+
+        with phases('state'):
+            pass
+        with self.assertRaises(ValueError):
+            with phases('userinfo'):
+                raise ValueError()
+
+        self.assertEqual(phases.phase, 'userinfo')
+        self.assertEqual(
+            [c[0][:1] + c[0][2:] for c in sink.timing.call_args_list],
+            [('callback.phase', {'phase': 'state'}),
+             ('callback.phase', {'phase': 'userinfo'})])
+
+
+class TestRecordHttpCall(unittest.TestCase):
+
+    def test_record(self):
+        from pyramid_google_login.metrics import record_http_call
+
+        sink = mock.Mock()
+        record_http_call(sink, 'GET',
+                         'https://www.googleapis.com/oauth2/v2/userinfo'
+                         '?access_token=secret', 200, 0.1)
+
+        endpoint = 'www.googleapis.com/oauth2/v2/userinfo'
+        sink.timing.assert_called_once_with(
+            'http.duration', 0.1, {'method': 'GET', 'endpoint': endpoint})
+        sink.incr.assert_called_once_with(
+            'http.responses',
+            tags={'method': 'GET', 'endpoint': endpoint, 'status': 200})
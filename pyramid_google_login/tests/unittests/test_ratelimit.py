@@ -0,0 +1,191 @@
+import unittest
+
+import mock
+
+
+@mock.patch('pyramid_google_login.ratelimit.time')
+class TestTokenBucket(unittest.TestCase):
+
+    def test_burst(self, time):
+        from pyramid_google_login.ratelimit import TokenBucket
+        time.time.return_value = 1000
+        bucket = TokenBucket(rate=10, burst=3)
+
+        self.assertEqual([bucket.reserve() for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket.reserve(), 0.1)
+        self.assertAlmostEqual(bucket.reserve(), 0.2)
+
+    def test_refill(self, time):
+        from pyramid_google_login.ratelimit import TokenBucket
+        time.time.return_value = 1000
+        bucket = TokenBucket(rate=10, burst=2)
+        bucket.reserve()
+        bucket.reserve()
+
+        time.time.return_value = 1000.1
+        self.assertEqual(bucket.reserve(), 0)
+        # Never more than the burst
+        time.time.return_value = 2000
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertGreater(bucket.reserve(), 0)
+
+    def test_acquire(self, time):
+        from pyramid_google_login.ratelimit import TokenBucket
+        time.time.return_value = 1000
+        bucket = TokenBucket(rate=4)
+
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertEqual(bucket.acquire(), 0.25)
+        time.sleep.assert_called_once_with(0.25)
+
+    def test_invalid_rate(self, time):
+        from pyramid_google_login.ratelimit import TokenBucket
+        with self.assertRaises(ValueError):
+            TokenBucket(rate=0)
+
+
+@mock.patch('pyramid_google_login.ratelimit.time')
+class TestPause(unittest.TestCase):
+
+    def test_pause(self, time):
+        from pyramid_google_login.ratelimit import TokenBucket
+        time.time.return_value = 1000
+        bucket = TokenBucket(rate=10, burst=5)
+
+        bucket.pause(2)
+
+        self.assertAlmostEqual(bucket.reserve(), 2)
+        self.assertAlmostEqual(bucket.reserve(), 2.1)
+
+        time.time.return_value = 1002.2
+        self.assertEqual(bucket.reserve(), 0)
+
+    def test_release(self, time):
+        from pyramid_google_login.ratelimit import TokenBucket
+        time.time.return_value = 1000
+        bucket = TokenBucket(rate=10)
+
+        bucket.reserve()
+        self.assertAlmostEqual(bucket.reserve(), 0.1)
+        bucket.release()
+        self.assertAlmostEqual(bucket.reserve(), 0.1)
+
+
+class TestFileTokenBucket(unittest.TestCase):
+
+    def test_shared(self):
+        import shutil
+        import tempfile
+        from pyramid_google_login.ratelimit import FileTokenBucket
+
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+
+        # As in two processes
+        bucket1 = FileTokenBucket(path + '/token.bucket', rate=1, burst=2)
+        bucket2 = FileTokenBucket(path + '/token.bucket', rate=1, burst=2)
+
+        self.assertEqual(bucket1.reserve(), 0)
+        self.assertEqual(bucket2.reserve(), 0)
+        self.assertGreater(bucket1.reserve(), 0.9)
+        self.assertGreater(bucket2.reserve(), 1.9)
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def get_limiter(self, max_wait=10):
+        from pyramid_google_login.ratelimit import RateLimiter, TokenBucket
+        self.metrics = mock.Mock()
+        return RateLimiter({'token': TokenBucket(rate=10, burst=1)},
+                           max_wait=max_wait, metrics=self.metrics)
+
+    def test_unlimited_endpoint(self):
+        limiter = self.get_limiter()
+        self.assertEqual(limiter.reserve('userinfo'), 0)
+        self.assertEqual(limiter.reserve(None), 0)
+
+    def test_counters(self):
+        limiter = self.get_limiter()
+
+        self.assertEqual(limiter.reserve('token'), 0)
+        self.assertGreater(limiter.reserve('token'), 0)
+
+        stats = limiter.stats()['token']
+        self.assertEqual(stats['calls'], 2)
+        self.assertEqual(stats['throttled'], 1)
+        self.assertGreater(stats['waited'], 0)
+        self.metrics.incr.assert_called_with('quota.calls',
+                                             tags={'endpoint': 'token'})
+
+    def test_max_wait(self):
+        from pyramid_google_login.ratelimit import RateLimitedError
+        limiter = self.get_limiter(max_wait=0.15)
+
+        limiter.reserve('token')
+        limiter.reserve('token')
+        with self.assertRaises(RateLimitedError):
+            limiter.reserve('token')
+        self.assertEqual(limiter.stats()['token']['rejected'], 1)
+        # The rejected call gave its token back
+        self.assertAlmostEqual(limiter.buckets['token'].tokens, -1,
+                               delta=0.1)
+
+    def test_retry_after(self):
+        limiter = self.get_limiter()
+        self.assertTrue(limiter.retry_after('token', 5))
+        self.assertFalse(limiter.retry_after('userinfo', 5))
+        self.assertGreater(limiter.reserve('token'), 4.9)
+
+
+class TestParseRetryAfter(unittest.TestCase):
+
+    def test_seconds(self):
+        from pyramid_google_login.ratelimit import parse_retry_after
+        self.assertEqual(parse_retry_after({'Retry-After': '30'}), 30)
+
+    def test_http_date(self):
+        import email.utils
+        import time
+        from pyramid_google_login.ratelimit import parse_retry_after
+        date = email.utils.formatdate(time.time() + 60, usegmt=True)
+        self.assertAlmostEqual(parse_retry_after({'Retry-After': date}), 60,
+                               delta=2)
+
+    def test_missing_or_invalid(self):
+        from pyramid_google_login.ratelimit import parse_retry_after
+        self.assertIsNone(parse_retry_after({}))
+        self.assertIsNone(parse_retry_after({'Retry-After': 'soon'}))
+
+
+class TestFromSettings(unittest.TestCase):
+
+    prefix = 'security.google_login.'
+
+    def test_settings(self):
+        from pyramid_google_login.ratelimit import (
+            FileTokenBucket, TokenBucket, rate_limiter_from_settings)
+
+        limiter = rate_limiter_from_settings(
+            {self.prefix + 'ratelimit_token': '5 20',
+             self.prefix + 'ratelimit_max_wait': '3'},
+            self.prefix, ('token', 'userinfo'))
+
+        self.assertEqual(list(limiter.buckets), ['token'])
+        bucket = limiter.buckets['token']
+        self.assertIs(type(bucket), TokenBucket)
+        self.assertNotIsInstance(bucket, FileTokenBucket)
+        self.assertEqual((bucket.rate, bucket.burst), (5, 20))
+        self.assertEqual(limiter.max_wait, 3)
+
+    def test_disabled(self):
+        from pyramid_google_login.ratelimit import rate_limiter_from_settings
+        self.assertIsNone(
+            rate_limiter_from_settings({}, self.prefix, ('token',)))
+
+    def test_invalid(self):
+        from pyramid_google_login.ratelimit import rate_limiter_from_settings
+        with self.assertRaises(ValueError):
+            rate_limiter_from_settings(
+                {self.prefix + 'ratelimit_token': '1 2 3'},
+                self.prefix, ('token',))
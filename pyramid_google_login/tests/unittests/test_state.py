@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+
+class TestStateSerializer(unittest.TestCase):
+
+    def get_serializer(self, secrets=('secret',), **kwargs):
+        from pyramid_google_login.state import StateSerializer
+        return StateSerializer(list(secrets), **kwargs)
+
+    def assertInvalid(self, serializer, state, **kwargs):
+        from pyramid_google_login.exceptions import AuthFailed
+        with self.assertRaises(AuthFailed):
+            serializer.loads(state, **kwargs)
+
+    def test_roundtrip(self):
+        serializer = self.get_serializer()
+        state, nonce = serializer.dumps(u'/next/pagé?a=1&b=2')
+        self.assertEqual(serializer.loads(state),
+                         (u'/next/pagé?a=1&b=2', nonce))
+
+    def test_no_url(self):
+        serializer = self.get_serializer()
+        state, nonce = serializer.dumps()
+        self.assertEqual(serializer.loads(state), (None, nonce))
+
+    def test_compact(self):
+        state, nonce = self.get_serializer().dumps()
+        self.assertEqual(len(state), 40)
+        self.assertEqual(len(nonce), 11)
+
+    def test_random_nonce(self):
+        serializer = self.get_serializer()
+        self.assertNotEqual(serializer.dumps()[1], serializer.dumps()[1])
+
+    def test_purpose(self):
+        state, _ = self.get_serializer().dumps('bob@bob.com')
+        other = self.get_serializer(purpose='returning_user')
+        self.assertInvalid(other, state)
+
+    def test_key_rotation(self):
+        old = self.get_serializer(['old'])
+        rotated = self.get_serializer(['new', 'old'])
+        state, _ = old.dumps('/next')
+
+        self.assertEqual(rotated.loads(state)[0], '/next')
+        self.assertInvalid(self.get_serializer(['new']), state)
+
+    def test_tampered(self):
+        serializer = self.get_serializer()
+        state, _ = serializer.dumps('/next')
+        other, _ = serializer.dumps('/evil')
+        # Swap the url, keep the mac
+        self.assertInvalid(serializer, other[:-22] + state[-22:])
+
+    def test_expired(self):
+        serializer = self.get_serializer(max_age=600)
+        state, _ = serializer.dumps(now=1000000)
+        serializer.loads(state, now=1000000 + 600)
+        self.assertInvalid(serializer, state, now=1000000 + 601)
+        self.assertInvalid(serializer, state, now=1000000 - 120)
+
+    def test_garbage(self):
+        serializer = self.get_serializer()
+        self.assertInvalid(serializer, '')
+        self.assertInvalid(serializer, 'url=%2Fnext')
+        self.assertInvalid(serializer, u'é' * 40)
+        self.assertInvalid(serializer, 'A' * 41)
+
+    def test_no_secret(self):
+        with self.assertRaises(ValueError):
+            self.get_serializer([])
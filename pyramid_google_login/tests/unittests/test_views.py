@@ -22,8 +22,20 @@ class TestIncludeme(unittest.TestCase):
         config.add_static_view.assert_called_once_with(
             'static/pyramid_google_login',
             'pyramid_google_login:static',
-            cache_max_age=300)
-        config.scan.assert_called_once_with('pyramid_google_login.views')
+            cache_max_age=31536000)
+        config.add_cache_buster.assert_called_once_with(
+            'pyramid_google_login:static/', mock.ANY)
+        self.assertFalse(config.scan.called)
+
+        views = dict((kwargs['route_name'], (args[0], kwargs))
+                     for args, kwargs in config.add_view.call_args_list)
+        self.assertEqual(sorted(views), ['auth_callback', 'auth_logout',
+                                         'auth_signin',
+                                         'auth_signin_redirect'])
+        view, kwargs = views['auth_signin']
+        self.assertEqual(view.__name__, 'signin')
+        self.assertEqual(kwargs['renderer'],
+                         'pyramid_google_login:templates/signin.mako')
 
 
 @mock.patch('pyramid_google_login.views.find_landing_path')
@@ -39,10 +51,20 @@ class TestSignin(unittest.TestCase):
             'googleapi_settings': mock.Mock(),
         }
         self.request.registry.settings = self.settings
+        self.request.registry.queryUtility.return_value = None
 
         self.request.authenticated_userid = None
         self.request.route_url.return_value = '/test/url'
 
+    def set_page_cache(self):
+        from pyramid_google_login.templating import ISigninPageCache
+
+        page_cache = mock.Mock()
+        utilities = {ISigninPageCache: page_cache}
+        self.request.registry.queryUtility.side_effect = (
+            lambda iface, *args, **kwargs: utilities.get(iface))
+        return page_cache
+
     def test_nominal(self, m_find_landing_path):
         from pyramid_google_login.views import signin
 
@@ -60,6 +82,41 @@ class TestSignin(unittest.TestCase):
 
         self.assertEqual(resp, expected)
 
+    def test_page_cache(self, m_find_landing_path):
+        from pyramid_google_login.views import signin
+
+        page_cache = self.set_page_cache()
+
+        resp = signin(self.request)
+
+        self.assertEqual(resp, page_cache.response.return_value)
+        key, values = page_cache.response.call_args[0][1:]
+        self.assertEqual(key, (self.settings['googleapi_settings'].id,
+                               self.request.application_url))
+        self.assertEqual(values['signin_redirect_url'], '/test/url')
+
+    def test_page_cache_url(self, m_find_landing_path):
+        from pyramid_google_login.views import signin
+
+        page_cache = self.set_page_cache()
+        self.request.params['url'] = '/go/there'
+
+        resp = signin(self.request)
+
+        self.assertEqual(resp['signin_redirect_url'], '/test/url')
+        self.assertFalse(page_cache.response.called)
+
+    def test_page_cache_message(self, m_find_landing_path):
+        from pyramid_google_login.views import signin
+
+        page_cache = self.set_page_cache()
+        self.request.params['message'] = 'Logged out'
+
+        resp = signin(self.request)
+
+        self.assertEqual(resp['message'], 'Logged out')
+        self.assertFalse(page_cache.response.called)
+
     def test_authenticated(self, m_find_landing_path):
         from pyramid_google_login.views import signin
         from pyramid.httpexceptions import HTTPFound
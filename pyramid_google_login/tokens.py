@@ -0,0 +1,255 @@
+"""OAuth2 tokens of the users, refreshed on demand
+
+Store the tokens received at login (e.g. in a ``UserLoggedIn`` subscriber)::
+
+    request.google_tokens.save(event.userid, event.oauth2_token)
+
+Then get a valid access token for this user at any time::
+
+    access_token = request.google_tokens.get_access_token(userid)
+
+With tenants, the tokens belong to the OAuth2 client of a tenant: pass its
+name (``tenant=get_tenant_name(request)``) to save and get them. The tokens
+are stored by tenant and userid, and refreshed with the client of their
+tenant.
+"""
+from contextlib import contextmanager
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from pyramid.exceptions import ConfigurationError
+from zope.interface import Interface
+
+from pyramid_google_login import SETTINGS_PREFIX
+from pyramid_google_login.stores import ITokenStore, MemoryTokenStore
+from pyramid_google_login.transport import SingleFlight
+from pyramid_google_login.utility import new_api_client_from_registry
+
+log = logging.getLogger(__name__)
+
+
+class ITokenManager(Interface):
+    pass
+
+
+class ThreadLockBackend(object):
+    """Serialize the refreshes within a process
+
+    A fixed array of ``stripes`` locks is shared by all the keys: the memory
+    used does not grow with the number of users.
+    """
+
+    def __init__(self, stripes=64):
+        self._locks = [threading.Lock() for _ in range(stripes)]
+
+    @contextmanager
+    def lock(self, key):
+        with self._locks[hash(key) % len(self._locks)]:
+            yield
+
+
+class FileLockBackend(object):
+    """Serialize the refreshes across the processes of a host (flock)
+
+    The lock file of a key is removed on release. A process waiting on a
+    removed file locks the new one instead.
+    """
+
+    def __init__(self, path):
+        import fcntl
+        self._fcntl = fcntl
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    @contextmanager
+    def lock(self, key):
+        path = os.path.join(self.path, key + '.lock')
+        while True:
+            fd = open(path, 'a')
+            self._fcntl.flock(fd, self._fcntl.LOCK_EX)
+            try:
+                locked = os.fstat(fd.fileno()).st_ino == os.stat(path).st_ino
+            except OSError:
+                # Removed by the previous holder
+                locked = False
+            if locked:
+                break
+            fd.close()
+
+        try:
+            yield
+        finally:
+            # Removed while locked: the waiters retry on a new file
+            os.unlink(path)
+            fd.close()
+
+
+class TokenManager(object):
+    """Access tokens of the users, refreshed before they expire
+
+    Within ``refresh_margin`` seconds of the expiration, the current access
+    token is returned and refreshed in background. The concurrent refreshes
+    of a refresh_token are collapsed into a single call to Google. After a
+    failed background refresh, the next one of the user waits
+    ``refresh_backoff`` seconds.
+    """
+
+    def __init__(self, registry, store, lock_backend, refresh_margin=300,
+                 refresh_backoff=60):
+        self.registry = registry
+        self.store = store
+        self.lock_backend = lock_backend
+        self.refresh_margin = refresh_margin
+        self.refresh_backoff = refresh_backoff
+        self.flights = SingleFlight()
+        # token_key -> time of the last failed background refresh
+        self.failed_at = {}
+
+    def get(self, userid, tenant=None):
+        """Stored tokens of the user, or None"""
+        return self.store.get(token_key(userid, tenant))
+
+    def save(self, userid, oauth2_tokens, tenant=None):
+        key = token_key(userid, tenant)
+        previous = self.store.get(key) or {}
+        tokens = {
+            'access_token': oauth2_tokens['access_token'],
+            'refresh_token': oauth2_tokens.get(
+                'refresh_token', previous.get('refresh_token')),
+            'expires_at': time.time() + int(
+                oauth2_tokens.get('expires_in', 3600)),
+            'tenant': tenant,
+        }
+        self.store.set(key, tokens)
+        return tokens
+
+    def forget(self, userid, tenant=None):
+        self.store.delete(token_key(userid, tenant))
+
+    def get_access_token(self, userid, tenant=None):
+        """Return a valid access token, or None if the user has no tokens or
+        no refresh_token
+
+        Raise :class:`AuthFailed` if Google refuses the refresh (e.g. the
+        refresh_token was revoked).
+        """
+        tokens = self.get(userid, tenant)
+        if tokens is None:
+            return None
+
+        now = time.time()
+        if now < tokens['expires_at'] - self.refresh_margin:
+            return tokens['access_token']
+
+        if not tokens.get('refresh_token'):
+            if now < tokens['expires_at']:
+                return tokens['access_token']
+            return None
+
+        if now < tokens['expires_at']:
+            self.refresh_in_background(userid, tokens['refresh_token'],
+                                       tenant)
+            return tokens['access_token']
+
+        return self.refresh(userid, tokens['refresh_token'],
+                            tenant)['access_token']
+
+    def refresh(self, userid, refresh_token, tenant=None):
+        key = self.flight_key(refresh_token, tenant)
+        return self.flights.do(key, self._refresh, userid, refresh_token,
+                               tenant, key)
+
+    def refresh_in_background(self, userid, refresh_token, tenant=None):
+        if self.flights.in_flight(self.flight_key(refresh_token, tenant)):
+            return
+        failed_at = self.failed_at.get(token_key(userid, tenant))
+        if (failed_at is not None and
+                time.time() < failed_at + self.refresh_backoff):
+            return
+        thread = threading.Thread(target=self._background_refresh,
+                                  args=(userid, refresh_token, tenant))
+        thread.daemon = True
+        thread.start()
+
+    def _background_refresh(self, userid, refresh_token, tenant):
+        key = token_key(userid, tenant)
+        try:
+            self.refresh(userid, refresh_token, tenant)
+        except Exception:
+            self.failed_at[key] = time.time()
+            log.warning('Failed to refresh the access token of %s', userid,
+                        exc_info=True)
+        else:
+            self.failed_at.pop(key, None)
+
+    def _refresh(self, userid, refresh_token, tenant, key):
+        with self.lock_backend.lock(key):
+            # Another process may have refreshed while waiting for the lock
+            tokens = self.get(userid, tenant)
+            if (tokens is not None and
+                    tokens.get('refresh_token') == refresh_token and
+                    time.time() < tokens['expires_at'] - self.refresh_margin):
+                return tokens
+
+            # Refresh tokens are bound to the OAuth2 client of the tenant
+            api = new_api_client_from_registry(self.registry, tenant)
+            oauth2_tokens = api.refresh_access_token(refresh_token)
+            oauth2_tokens.setdefault('refresh_token', refresh_token)
+            tokens = self.save(userid, oauth2_tokens, tenant)
+            # Visible to the other processes before releasing the lock
+            self.store.flush()
+            return tokens
+
+    @staticmethod
+    def flight_key(refresh_token, tenant=None):
+        scoped = '%s\n%s' % (tenant or '', refresh_token)
+        return hashlib.sha256(scoped.encode('utf-8')).hexdigest()
+
+
+def token_key(userid, tenant=None):
+    """Key of the tokens of a user in the store, scoped by tenant"""
+    if tenant is None:
+        return userid
+    return 'tenant:%s:%s' % (tenant, userid)
+
+
+def includeme(config):
+    settings = config.registry.settings
+    prefix = SETTINGS_PREFIX
+
+    lock = settings.get(prefix + 'token_lock', 'thread')
+    if lock == 'thread':
+        lock_backend = ThreadLockBackend()
+    elif lock == 'file':
+        try:
+            lock_path = settings[prefix + 'token_lock_path']
+        except KeyError as err:
+            log.error('Missing configuration setting: %s', err)
+            raise
+        lock_backend = FileLockBackend(lock_path)
+    else:
+        raise ConfigurationError('Invalid %stoken_lock: %s' % (prefix, lock))
+
+    store = config.registry.queryUtility(ITokenStore)
+    if store is None:
+        store = MemoryTokenStore()
+
+    manager = TokenManager(
+        config.registry,
+        store,
+        lock_backend,
+        refresh_margin=int(settings.get(prefix + 'token_refresh_margin', 300)),
+        refresh_backoff=int(settings.get(prefix + 'token_refresh_backoff',
+                                         60)),
+        )
+
+    config.registry.registerUtility(manager, provided=ITokenManager)
+    config.add_request_method(get_token_manager, 'google_tokens', reify=True)
+
+
+def get_token_manager(request):
+    return request.registry.getUtility(ITokenManager)
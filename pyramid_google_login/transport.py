@@ -0,0 +1,482 @@
+import copy
+import logging
+import os
+import random
+import threading
+import time
+
+import six
+from six.moves import queue
+from six.moves.urllib import parse
+
+from pyramid_google_login.exceptions import TransportError
+from pyramid_google_login.metrics import NULL_SINK, record_http_call
+from pyramid_google_login.ratelimit import parse_retry_after
+
+log = logging.getLogger(__name__)
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Google is failing: counted by the circuit breaker, retried
+FAILURE_STATUSES = (500, 502, 503, 504)
+RETRY_STATUSES = FAILURE_STATUSES + (429,)
+
+
+class CircuitOpenError(TransportError):
+    """The circuit breaker of the host is open: the call was not made"""
+
+
+def request_errors(*others):
+    """Exceptions of a failed call to Google, plus ``others``
+
+    ``requests`` is imported on the first call rather than at startup.
+    """
+    from requests.exceptions import RequestException
+    return others + (RequestException, TransportError)
+
+
+class CircuitBreaker(object):
+    """Stop calling an endpoint of a host after ``failure_threshold``
+    consecutive failures
+
+    Open, the breaker rejects the calls for ``reset_timeout`` seconds. Then
+    a single trial call is let through (half-open): its success closes the
+    breaker, its failure opens it again. A threshold of 0 disables it.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    # Value of the state gauge
+    STATE_VALUES = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30,
+                 metrics=None, tags=None):
+        self.name = name
+        self.tags = tags or {'host': name}
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.metrics = metrics or NULL_SINK
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        if state != self.state:
+            log.warning('Circuit breaker of %s is %s', self.name, state)
+            self.state = state
+        self.metrics.gauge('circuit_breaker.state', self.STATE_VALUES[state],
+                           tags=self.tags)
+
+    def allow(self):
+        if not self.failure_threshold:
+            return True
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.time() - self.opened_at < self.reset_timeout:
+                    return False
+                self._set_state(self.HALF_OPEN)
+            if self._trial:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._trial = False
+            self.failures = 0
+            if self.state != self.CLOSED:
+                self._set_state(self.CLOSED)
+
+    def release(self):
+        """End a call interrupted before its outcome (e.g. a gevent Timeout):
+        let another trial call through
+        """
+        with self._lock:
+            self._trial = False
+
+    def record_failure(self):
+        if not self.failure_threshold:
+            return
+        with self._lock:
+            self._trial = False
+            self.failures += 1
+            if (self.state == self.HALF_OPEN or
+                    self.failures >= self.failure_threshold):
+                self.opened_at = time.time()
+                self._set_state(self.OPEN)
+
+
+class HttpSessionPool(object):
+    """Process-wide keep-alive connections to the Google endpoints.
+
+    A single ``requests.Session`` is shared by all the threads of a process
+    (urllib3 connection pools are thread-safe). It is created lazily and
+    re-created after a fork so that a pre-forking server never shares a
+    socket between processes.
+
+    The calls are bounded by ``timeout`` (``(connect, read)`` seconds),
+    overridden per endpoint name by ``timeouts``. The idempotent calls are
+    retried ``max_retries`` times on connection errors and 5xx responses
+    with a jittered exponential backoff, or after the ``Retry-After`` delay
+    of Google. A circuit breaker per host fast-fails the calls while Google
+    is down. The calls of an endpoint wait for the ``rate_limiter`` if any.
+    The status and the duration of every call are sent to ``metrics``.
+    With ``single_flight``, the identical GET calls in flight at the same
+    time share a single call (see :meth:`shared_get`).
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, metrics=None,
+                 timeout=(3.05, 10), timeouts=None, max_retries=2,
+                 backoff_base=0.1, backoff_max=2, breaker_threshold=5,
+                 breaker_reset_timeout=30, rate_limiter=None,
+                 single_flight=True):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.metrics = metrics or NULL_SINK
+        self.timeout = timeout
+        self.timeouts = dict(timeouts or {})
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset_timeout = breaker_reset_timeout
+        self.rate_limiter = rate_limiter
+        self.flights = SingleFlight() if single_flight else None
+        self.breakers = {}
+        self._breakers_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+
+    @property
+    def session(self):
+        session, pid = self._session, os.getpid()
+        if session is not None and self._pid == pid:
+            return session
+
+        if self._pid != pid:
+            # Forked: the lock may have been held by a thread of the parent
+            self._lock = threading.Lock()
+
+        with self._lock:
+            if self._session is None or self._pid != pid:
+                log.debug('Create HTTP session (pid=%s)', pid)
+                self._session = self.new_session()
+                self._pid = pid
+            return self._session
+
+    def new_session(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        adapter = HTTPAdapter(pool_connections=self.pool_connections,
+                              pool_maxsize=self.pool_maxsize)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def close(self):
+        with self._lock:
+            if self._session is not None and self._pid == os.getpid():
+                self._session.close()
+            self._session = None
+            self._pid = None
+
+    def timeout_for(self, endpoint):
+        return self.timeouts.get(endpoint, self.timeout)
+
+    def breaker_for(self, url, endpoint=None):
+        """Circuit breaker of the endpoint of the host: the failures of an
+        endpoint (e.g. the directory) don't block the others (the logins)
+        """
+        host = parse.urlsplit(url).netloc
+        key = (host, endpoint)
+        breaker = self.breakers.get(key)
+        if breaker is None:
+            with self._breakers_lock:
+                breaker = self.breakers.get(key)
+                if breaker is None:
+                    name = host if endpoint is None else '%s (%s)' % (
+                        host, endpoint)
+                    breaker = self.breakers[key] = CircuitBreaker(
+                        name,
+                        failure_threshold=self.breaker_threshold,
+                        reset_timeout=self.breaker_reset_timeout,
+                        metrics=self.metrics,
+                        tags={'host': host,
+                              'endpoint': endpoint or 'other'})
+        return breaker
+
+    def backoff(self, attempt):
+        """Full jitter: spread the retries of the concurrent clients"""
+        return random.uniform(
+            0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def request(self, method, url, endpoint=None, idempotent=None,
+                **kwargs):
+        """Call Google through the circuit breaker, with retries if
+        ``idempotent`` (default: according to the method)
+        """
+        from requests import exceptions
+
+        kwargs.setdefault('timeout', self.timeout_for(endpoint))
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        retries = self.max_retries if idempotent else 0
+        breaker = self.breaker_for(url, endpoint)
+
+        attempt = 0
+        while True:
+            # Rejected without waiting for (nor using) the rate limit
+            if not breaker.allow():
+                self.metrics.incr('circuit_breaker.rejected',
+                                  tags=breaker.tags)
+                raise CircuitOpenError(
+                    'Circuit breaker open for %s' % breaker.name)
+
+            try:
+                if self.rate_limiter is not None:
+                    self.rate_limiter.acquire(endpoint)
+                response = self.send(method, url, **kwargs)
+            except (exceptions.ConnectionError, exceptions.Timeout):
+                breaker.record_failure()
+                if attempt >= retries:
+                    raise
+                delay = self.backoff(attempt)
+            except exceptions.RequestException:
+                # e.g. a truncated or corrupted response body
+                breaker.record_failure()
+                raise
+            except BaseException:
+                # No outcome (an error of the call itself, or interrupted),
+                # but the trial call is over
+                breaker.release()
+                raise
+            else:
+                if response.status_code in FAILURE_STATUSES:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+                delay = self.retry_delay(endpoint, response, attempt)
+                if delay is None or attempt >= retries:
+                    return response
+                # Back to the pool, even if the body was not read (stream)
+                response.close()
+
+            self.metrics.incr('http.retries', tags=breaker.tags)
+            if delay > 0:
+                time.sleep(delay)
+            attempt += 1
+
+    def retry_delay(self, endpoint, response, attempt):
+        """Seconds to wait before retrying, None if too long"""
+        retry_after = parse_retry_after(response.headers)
+        if retry_after is None:
+            return self.backoff(attempt)
+        if (self.rate_limiter is not None and
+                self.rate_limiter.retry_after(endpoint, retry_after)):
+            # The rate limiter holds the next call of the endpoint
+            delay = 0
+        else:
+            delay = retry_after
+        return delay if retry_after <= self.backoff_max else None
+
+    def send(self, method, url, **kwargs):
+        """Make a single call"""
+        start = time.time()
+        status = 'error'
+        try:
+            response = self.session.request(method, url, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            record_http_call(self.metrics, method, url, status,
+                             time.time() - start)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def shared_get(self, url, params=None, endpoint=None, headers=None,
+                   **kwargs):
+        """GET, sharing the response with the identical calls (same url,
+        params, endpoint and headers) in flight in the other threads of the
+        process
+
+        The calls with other options (``timeout``, ``stream``...) are not
+        shared.
+        """
+        if headers:
+            kwargs['headers'] = headers
+        if self.flights is None or set(kwargs) - set(['headers']):
+            return self.get(url, params=params, endpoint=endpoint, **kwargs)
+
+        key = (url, tuple(sorted((params or {}).items())), endpoint,
+               tuple(sorted((headers or {}).items())))
+        response, shared = self.flights.do_shared(
+            key, self.get, url, params=params, endpoint=endpoint, **kwargs)
+        if shared:
+            self.metrics.incr('http.coalesced',
+                              tags={'endpoint': endpoint or 'other'})
+        return response
+
+
+class InterruptedCallError(TransportError):
+    """The shared call was interrupted in the thread making it (e.g. a
+    gevent Timeout or a KeyboardInterrupt of this thread)
+    """
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Collapse the concurrent calls sharing a key into a single call
+
+    The first caller runs the function, the others wait for its result (or
+    its exception). Each of the others gets its own shallow copy of the
+    result, or of the exception (chained to the original one).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def in_flight(self, key):
+        return key in self._calls
+
+    def do(self, key, func, *args, **kwargs):
+        return self.do_shared(key, func, *args, **kwargs)[0]
+
+    def do_shared(self, key, func, *args, **kwargs):
+        """Return the result and whether it was shared with another caller
+        (the call was made by another thread)
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                error = follower_error(call.error)
+                if error is call.error:
+                    raise error
+                six.raise_from(error, call.error)
+            return copy.copy(call.result), True
+
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result, False
+        except BaseException as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+
+def follower_error(error):
+    """New exception raised in a waiting thread for the error of the shared
+    call: an exception object is not raised in several threads at once
+    """
+    if not isinstance(error, Exception):
+        # Meant for the interrupted thread only
+        return InterruptedCallError('Shared call interrupted (%r)' % error)
+    try:
+        return copy.copy(error)
+    except Exception:
+        # Not rebuilt from its args: shared
+        return error
+
+
+_STOP = object()
+
+
+class _Error(object):
+
+    def __init__(self, error):
+        self.error = error
+
+
+def imap_bounded(func, iterable, concurrency=8):
+    """Yield ``func(item)`` for the items, computed by ``concurrency``
+    threads, in completion order
+
+    The iterable is consumed lazily: no more than ``2 * concurrency`` items
+    are in flight, whatever the length of the iterable. An exception raised
+    by ``func`` is raised by the iteration. Closing the iterator stops the
+    threads once their current item is done.
+    """
+    work = queue.Queue()
+    results = queue.Queue()
+    items = iter(iterable)
+
+    def worker():
+        while True:
+            item = work.get()
+            if item is _STOP:
+                return
+            try:
+                results.put(func(item))
+            except Exception as err:
+                results.put(_Error(err))
+
+    threads = []
+    for _ in range(concurrency):
+        thread = threading.Thread(target=worker, name='google-imap-bounded')
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    def submit():
+        for item in items:
+            work.put(item)
+            return True
+        return False
+
+    try:
+        pending = 0
+        for _ in range(2 * concurrency):
+            if not submit():
+                break
+            pending += 1
+
+        while pending:
+            result = results.get()
+            pending -= 1
+            if submit():
+                pending += 1
+            if isinstance(result, _Error):
+                raise result.error
+            yield result
+    finally:
+        # Drop the items not started yet
+        while True:
+            try:
+                work.get_nowait()
+            except queue.Empty:
+                break
+        for _ in threads:
+            work.put(_STOP)
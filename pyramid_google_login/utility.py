@@ -1,13 +1,35 @@
 from collections import namedtuple
+import hashlib
+import itertools
 import logging
+import os
+import re
+import threading
+import time
 
 from six.moves.urllib import parse
-from pyramid.settings import aslist
-from requests.exceptions import RequestException
-import requests
+from pyramid.exceptions import ConfigurationError
+from pyramid.request import Request
+from pyramid.settings import asbool, aslist
 
 from pyramid_google_login import SETTINGS_PREFIX
+from pyramid_google_login.batch import (
+    MAX_BATCH_SIZE, BatchCall, BatchResult, boundary_from_content_type,
+    build_batch_body, iter_parts, new_boundary, result_from_part)
+from pyramid_google_login.cache import LRUCache
+from pyramid_google_login.domains import hosted_domains_from_settings
 from pyramid_google_login.exceptions import AuthFailed, ApiError
+from pyramid_google_login.idtoken import (RsaPublicKey, decode_id_token,
+                                          userinfo_from_claims)
+from pyramid_google_login.metrics import get_metrics_sink
+from pyramid_google_login.stores import ITokenStore, token_store_from_settings
+from pyramid_google_login.ratelimit import (IRateLimiter, TokenBucket,
+                                            rate_limiter_from_settings)
+from pyramid_google_login.tenants import (TENANT_ENVIRON_KEY, Tenant,
+                                          TenantRegistry, get_tenant,
+                                          tenant_names, tenant_settings)
+from pyramid_google_login.transport import (CircuitOpenError, HttpSessionPool,
+                                            imap_bounded, request_errors)
 
 from zope.interface import Interface
 
@@ -17,7 +39,9 @@ ApiSettings = namedtuple(
     'ApiSettings',
     """
         access_type
+        authorize_url_prefix
         hosted_domain
+        hosted_domains
         id
         landing_route
         landing_url
@@ -26,14 +50,200 @@ ApiSettings = namedtuple(
         signin_advice
         signin_banner
         user_id_field
+        userinfo_source
     """
     )
 
+USERINFO_SOURCES = ('userinfo', 'id_token')
+
+# Endpoint names of the per-endpoint settings (``http_timeout_<name>`` and
+# ``ratelimit_<name>``)
+ENDPOINTS = ('token', 'userinfo', 'certs', 'directory')
+
+GOOGLE_UNAVAILABLE = 'Google is unavailable, retry in a moment'
+
+# Outcome of a refresh of ``refresh_many``: oauth2_tokens or error is None
+RefreshResult = namedtuple('RefreshResult',
+                           'refresh_token oauth2_tokens error')
+
+# Bytes read at a time from a batch response
+BATCH_CHUNK_SIZE = 16 * 1024
+
+MAX_AGE_RE = re.compile(r'max-age=(\d+)')
+
 
 class IApiClientFactory(Interface):
     pass
 
 
+class IHttpSessionPool(Interface):
+    pass
+
+
+class ISigningKeys(Interface):
+    pass
+
+
+class IUserinfoCache(Interface):
+    pass
+
+
+class SigningKeys(object):
+    """Google public keys used to verify the id_token signatures
+
+    Shared by all the requests of a process. The keys are kept for the
+    ``max-age`` of the certs response and refreshed by a background thread
+    ``refresh_ahead`` seconds before they expire. When Google can't be
+    reached, the stale keys are kept in use.
+    """
+    certs_endpoint = 'https://www.googleapis.com/oauth2/v3/certs'
+
+    # Used when the certs response has no usable Cache-Control header
+    default_max_age = 3600
+
+    # Do not hammer the certs endpoint with tokens signed by unknown keys
+    min_fetch_interval = 60
+
+    def __init__(self, http, refresh_ahead=300):
+        self.http = http
+        self.refresh_ahead = refresh_ahead
+        self.keys = {}
+        self.fetched_at = None
+        self.expires_at = None
+        self.fetch_count = 0
+        self._lock = threading.Lock()
+        self._refresh_thread = None
+
+    def get_key(self, kid):
+        now = time.time()
+        expires_at = self.expires_at
+
+        if expires_at is not None and now < expires_at:
+            if now >= expires_at - self.refresh_ahead:
+                self.refresh_in_background()
+            key = self.keys.get(kid)
+            if key is not None:
+                return key
+
+        # Expired, empty or unknown key: refresh in the request thread
+        with self._lock:
+            if self._needs_refresh(kid, now) and self._can_fetch(now):
+                self.refresh()
+
+        return self.keys.get(kid)
+
+    def _needs_refresh(self, kid, now):
+        return (kid not in self.keys or
+                self.expires_at is None or
+                now >= self.expires_at)
+
+    def _can_fetch(self, now):
+        return (self.fetched_at is None or
+                now - self.fetched_at > self.min_fetch_interval)
+
+    def refresh(self):
+        """Fetch the keys now (with the lock held)"""
+        self.fetched_at = time.time()
+        self.fetch_count += 1
+        try:
+            keys, max_age = self.fetch()
+        except AuthFailed:
+            if not self.keys:
+                raise
+            log.warning('Keep using stale signing keys from Google')
+            return
+
+        self.keys = keys
+        self.expires_at = self.fetched_at + max_age
+
+    def refresh_in_background(self):
+        with self._lock:
+            thread = self._refresh_thread
+            if thread is not None and thread.is_alive():
+                return
+            now = time.time()
+            if not self._can_fetch(now):
+                # Also when the previous background refresh failed
+                return
+            self.fetched_at = now
+            self.fetch_count += 1
+            thread = threading.Thread(target=self._background_refresh,
+                                      args=(now,),
+                                      name='google-signing-keys-refresh')
+            thread.daemon = True
+            self._refresh_thread = thread
+        thread.start()
+
+    def _background_refresh(self, fetched_at):
+        try:
+            keys, max_age = self.fetch()
+        except AuthFailed:
+            return
+        with self._lock:
+            self.keys = keys
+            self.expires_at = fetched_at + max_age
+
+    def fetch(self):
+        try:
+            response = self.http.get(self.certs_endpoint, endpoint='certs')
+            response.raise_for_status()
+            jwks = response.json()
+            keys = dict((jwk['kid'], RsaPublicKey.from_jwk(jwk))
+                        for jwk in jwks['keys'] if jwk.get('kty') == 'RSA')
+        except Exception:
+            log.warning('Unkown error calling certs endpoint', exc_info=True)
+            raise AuthFailed('Failed to get signing keys from Google')
+
+        return keys, self.parse_max_age(response.headers)
+
+    def parse_max_age(self, headers):
+        match = MAX_AGE_RE.search(headers.get('Cache-Control') or '')
+        if match is None:
+            return self.default_max_age
+        try:
+            age = int(headers.get('Age') or 0)
+        except ValueError:
+            age = 0
+        return max(int(match.group(1)) - age, 0)
+
+
+class PrefetchThread(object):
+    """Run a function in a background thread until its result is needed"""
+
+    def __init__(self, func, *args):
+        self._result = self._error = None
+        self._thread = threading.Thread(target=self._run, args=(func, args))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, func, args):
+        try:
+            self._result = func(*args)
+        except Exception as err:
+            self._error = err
+
+    def result(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+def userinfo_cache_key(access_token):
+    return hashlib.sha256(access_token.encode('utf-8')).hexdigest()
+
+
+def userinfo_cache_ttl(cache, oauth2_tokens):
+    """ Cache the userinfo no longer than the access token is valid """
+    if 'expires_at' in oauth2_tokens:
+        expires_in = oauth2_tokens['expires_at'] - time.time()
+    elif 'expires_in' in oauth2_tokens:
+        expires_in = int(oauth2_tokens['expires_in'])
+    else:
+        return cache.ttl
+    return min(cache.ttl, expires_in)
+
+
 class ApiClient(object):
     """-> https://developers.google.com/accounts/docs/OAuth2WebServer"""
     authorize_endpoint = 'https://accounts.google.com/o/oauth2/auth'
@@ -41,48 +251,72 @@ class ApiClient(object):
     userinfo_endpoint = 'https://www.googleapis.com/oauth2/v2/userinfo'
     domain_users_endpoint = ('https://www.googleapis.com'
                              '/admin/directory/v1/users')
+    groups_endpoint = 'https://www.googleapis.com/admin/directory/v1/groups'
+    directory_batch_endpoint = ('https://www.googleapis.com'
+                                '/batch/admin/directory_v1')
+    userinfo_batch_endpoint = 'https://www.googleapis.com/batch/oauth2/v2'
 
     def __init__(self, request):
         self.request = request
+        self.tenant = get_tenant(request)
+        if self.tenant is None:
+            self.http = request.registry.getUtility(IHttpSessionPool)
+            settings = request.registry.settings['googleapi_settings']
+        else:
+            self.http = self.tenant.http
+            settings = self.tenant.api_settings
 
-        settings = self.request.registry.settings['googleapi_settings']
         self.id = settings.id
         self.secret = settings.secret
         self.hosted_domain = settings.hosted_domain
+        self.hosted_domains = settings.hosted_domains
         self.access_type = settings.access_type
         self.scope_list = settings.scope_list
+        self.authorize_url_prefix = settings.authorize_url_prefix
         self.user_id_field = settings.user_id_field
-
-    def build_authorize_url(self, state, redirect_uri):
-        params = {
-            'response_type': 'code',
-            'client_id': self.id,
-            'redirect_uri': redirect_uri,
-            'scope': ' '.join(self.scope_list),
-            'state': state,
-            'access_type': self.access_type,
-        }
-
-        if self.hosted_domain:
-            params['hd'] = self.hosted_domain
-
-        authorize_url = '%s?%s' % (
-            self.authorize_endpoint,
-            parse.urlencode(params)
-        )
-
-        return authorize_url
-
-    def exchange_token_from_code(self, redirect_uri):
+        self.userinfo_source = settings.userinfo_source
+
+    def http_get(self, url, params=None, endpoint=None):
+        """GET a Google API: the identical calls made at the same time by
+        the threads of the process (e.g. the same page of the directory with
+        the same access token) share a single call and its response
+        """
+        return self.http.shared_get(url, params=params, endpoint=endpoint)
+
+    @classmethod
+    def build_authorize_url_prefix(cls, settings):
+        """ Encode once the authorize params that don't vary per request """
+        params = [
+            ('response_type', 'code'),
+            ('client_id', settings.id),
+            ('scope', ' '.join(settings.scope_list)),
+            ('access_type', settings.access_type),
+        ]
+
+        if settings.hosted_domain:
+            params.append(('hd', settings.hosted_domain))
+
+        return '%s?%s' % (cls.authorize_endpoint, parse.urlencode(params))
+
+    def build_authorize_url(self, state, redirect_uri, extra_params=()):
+        """``extra_params``: pairs of params varying per request (e.g.
+        ``prompt``)
+        """
+        params = (('redirect_uri', redirect_uri),
+                  ('state', state)) + tuple(extra_params)
+        return '%s&%s' % (self.authorize_url_prefix, parse.urlencode(params))
+
+    def get_authorization_code(self):
         if 'error' in self.request.params:
             raise AuthFailed(
                 'Error from Google (%s)' % self.request.params['error'])
         try:
-            code = self.request.params['code']
+            return self.request.params['code']
         except KeyError:
             raise AuthFailed('No authorization code from Google')
 
-        params = {
+    def token_params(self, code, redirect_uri):
+        return {
             'code': code,
             'client_id': self.id,
             'client_secret': self.secret,
@@ -90,12 +324,32 @@ class ApiClient(object):
             'grant_type': 'authorization_code',
         }
 
+    def refresh_token_params(self, refresh_token):
+        return {
+            'client_id': self.id,
+            'client_secret': self.secret,
+            'refresh_token': refresh_token,
+            'grant_type': 'refresh_token',
+        }
+
+    def check_oauth2_tokens(self, oauth2_tokens):
+        if 'access_token' not in oauth2_tokens:
+            raise AuthFailed('No access_token in response from Google')
+
+    def exchange_token_from_code(self, redirect_uri):
+        code = self.get_authorization_code()
+        params = self.token_params(code, redirect_uri)
+
         try:
-            response = requests.post(self.token_endpoint, data=params)
+            response = self.http.post(self.token_endpoint, data=params,
+                                      endpoint='token')
             response.raise_for_status()
             oauth2_tokens = response.json()
 
-        except RequestException as err:
+        except CircuitOpenError:
+            raise AuthFailed(GOOGLE_UNAVAILABLE)
+
+        except request_errors() as err:
             raise AuthFailed('Failed to get token from Google (%s)' % err)
 
         except Exception:
@@ -103,24 +357,61 @@ class ApiClient(object):
                         exc_info=True)
             raise AuthFailed('Failed to get token from Google (unkown error)')
 
-        if 'access_token' not in oauth2_tokens:
-            raise AuthFailed('No access_token in response from Google')
-
+        self.check_oauth2_tokens(oauth2_tokens)
         return oauth2_tokens
 
     def get_userinfo_from_token(self, oauth2_tokens):
+        if self.userinfo_source == 'id_token':
+            return self.get_userinfo_from_id_token(oauth2_tokens)
+
+        cache, cache_key = self.userinfo_cache(oauth2_tokens)
+        if cache is not None:
+            userinfo = cache.get(cache_key)
+            if userinfo is not None:
+                return userinfo
+
         try:
             params = {'access_token': oauth2_tokens['access_token']}
-            response = requests.get(self.userinfo_endpoint, params=params)
+            response = self.http_get(self.userinfo_endpoint, params=params,
+                                     endpoint='userinfo')
             response.raise_for_status()
-            return response.json()
+            userinfo = response.json()
+        except CircuitOpenError:
+            raise AuthFailed(GOOGLE_UNAVAILABLE)
         except Exception:
             log.warning('Unkown error calling userinfo endpoint',
                         exc_info=True)
             raise AuthFailed('Failed to get userinfo from Google')
 
+        if cache is not None:
+            self.cache_userinfo(cache, cache_key, oauth2_tokens, userinfo)
+        return userinfo
+
+    def userinfo_cache(self, oauth2_tokens):
+        """The userinfo cache and the key of the tokens, or (None, None)"""
+        cache = self.request.registry.queryUtility(IUserinfoCache)
+        if cache is None or 'access_token' not in oauth2_tokens:
+            return None, None
+        return cache, userinfo_cache_key(oauth2_tokens['access_token'])
+
+    def cache_userinfo(self, cache, cache_key, oauth2_tokens, userinfo):
+        ttl = userinfo_cache_ttl(cache, oauth2_tokens)
+        if ttl > 0:
+            cache.set(cache_key, userinfo, ttl=ttl)
+
+    def get_userinfo_from_id_token(self, oauth2_tokens):
+        try:
+            id_token = oauth2_tokens['id_token']
+        except KeyError:
+            raise AuthFailed('No id_token in response from Google')
+
+        signing_keys = self.request.registry.getUtility(ISigningKeys)
+        claims = decode_id_token(id_token, signing_keys.get_key,
+                                 audience=self.id)
+        return userinfo_from_claims(claims)
+
     def check_hosted_domain_user(self, userinfo):
-        if not self.hosted_domain:
+        if not self.hosted_domain and self.hosted_domains is None:
             return
 
         try:
@@ -128,7 +419,11 @@ class ApiClient(object):
         except KeyError:
             raise AuthFailed('Missing hd field from Google userinfo')
 
-        if self.hosted_domain != user_hosted_domain:
+        if self.hosted_domains is not None:
+            if user_hosted_domain not in self.hosted_domains:
+                raise AuthFailed('You logged in with an unkown domain '
+                                 '(%s)' % user_hosted_domain)
+        elif self.hosted_domain != user_hosted_domain:
             raise AuthFailed('You logged in with an unkown domain '
                              '(%s rather than %s)' % (user_hosted_domain,
                                                       self.hosted_domain))
@@ -142,18 +437,17 @@ class ApiClient(object):
         return user_id
 
     def refresh_access_token(self, refresh_token):
-        params = {
-            'client_id': self.id,
-            'client_secret': self.secret,
-            'refresh_token': refresh_token,
-            'grant_type': 'refresh_token',
-        }
+        params = self.refresh_token_params(refresh_token)
 
         try:
-            response = requests.post(self.token_endpoint, params=params)
+            # The same refresh_token can be exchanged again: safe to retry
+            response = self.http.post(self.token_endpoint, params=params,
+                                      endpoint='token', idempotent=True)
             response.raise_for_status()
             oauth2_tokens = response.json()
-        except RequestException as err:
+        except CircuitOpenError as err:
+            raise AuthFailed(err, GOOGLE_UNAVAILABLE)
+        except request_errors() as err:
             raise AuthFailed(err, 'Failed to get token from Google (%s)' % err)
         except Exception as err:
             log.warning('Unkown error while calling token endpoint',
@@ -161,54 +455,436 @@ class ApiClient(object):
             raise AuthFailed(err,
                              'Failed to get token from Google (unknown error)')
 
-        if 'access_token' not in oauth2_tokens:
-            raise AuthFailed('No access_token in response from Google')
-
+        self.check_oauth2_tokens(oauth2_tokens)
         return oauth2_tokens
 
-    def get_domain_users(self, access_token, limit=500):
+    def refresh_many(self, refresh_tokens, concurrency=8, rate=None):
+        """Refresh many tokens in parallel, yield a :class:`RefreshResult`
+        for each of them (in completion order)
+
+        The refresh tokens can be a generator: they are read as the
+        refreshes progress, keeping the memory bounded. ``rate`` limits the
+        number of refreshes per second (None: unlimited). The connections
+        to Google are shared with the requests (``http_pool_maxsize`` should
+        be at least ``concurrency``).
+        """
+        limiter = TokenBucket(rate, burst=concurrency) if rate else None
+
+        def refresh(refresh_token):
+            if limiter is not None:
+                limiter.acquire()
+            try:
+                oauth2_tokens = self.refresh_access_token(refresh_token)
+            except Exception as err:
+                return RefreshResult(refresh_token, None, err)
+            return RefreshResult(refresh_token, oauth2_tokens, None)
+
+        return imap_bounded(refresh, refresh_tokens, concurrency)
+
+    def domain_users_params(self, access_token, limit, fields=None):
         params = {
             'maxResults': limit,
-            'domain': 'ludia.com',
             'viewType': 'domain_public',
             'access_token': access_token
         }
+        if self.hosted_domain:
+            params['domain'] = self.hosted_domain
+        else:
+            params['customer'] = 'my_customer'
+        if fields:
+            params['fields'] = 'nextPageToken,users(%s)' % fields
+        return params
+
+    def get_domain_users(self, access_token, limit=500):
+        params = self.domain_users_params(access_token, limit)
         try:
-            response = requests.get(self.domain_users_endpoint, params=params)
+            response = self.http_get(self.domain_users_endpoint,
+                                     params=params, endpoint='directory')
             response.raise_for_status()
             return response.json()
-        except (ValueError, RequestException) as err:
+        except request_errors(ValueError) as err:
             raise ApiError(err, 'Failed to get domain users (%s)' % err)
 
+    def iter_domain_users(self, access_token, page_size=500, fields=None,
+                          prefetch=True):
+        """Yield all the users of the domain, following the pagination
+
+        Only one page is held in memory (plus the next one, fetched in a
+        background thread while the current page is consumed when
+        ``prefetch`` is true). ``fields`` restricts the user fields returned
+        by Google (e.g. ``primaryEmail,name/fullName``).
+        """
+        params = self.domain_users_params(access_token, page_size, fields)
+
+        def fetch_page(page_token):
+            page_params = dict(params, pageToken=page_token)
+            try:
+                response = self.http_get(self.domain_users_endpoint,
+                                         params=page_params,
+                                         endpoint='directory')
+                response.raise_for_status()
+                return response.json()
+            except request_errors(ValueError) as err:
+                raise ApiError(err, 'Failed to get domain users (%s)' % err)
+
+        page = fetch_page(None)
+        while True:
+            page_token = page.get('nextPageToken')
+            next_page = None
+            if page_token and prefetch:
+                next_page = PrefetchThread(fetch_page, page_token)
+
+            for user in page.get('users', ()):
+                yield user
+
+            if not page_token:
+                return
+            if next_page is not None:
+                page = next_page.result()
+            else:
+                page = fetch_page(page_token)
+
+    def get_user_groups(self, access_token, user_key, page_size=200,
+                        page_token=None):
+        """Return the emails of the groups of a user (email or id), from
+        the page ``page_token`` (default: the first one)
+        """
+        params = {
+            'userKey': user_key,
+            'maxResults': page_size,
+            'fields': 'nextPageToken,groups(email)',
+            'access_token': access_token,
+        }
+        if page_token:
+            params['pageToken'] = page_token
+        groups = []
+        while True:
+            try:
+                response = self.http_get(self.groups_endpoint, params=params,
+                                         endpoint='directory')
+                response.raise_for_status()
+                page = response.json()
+            except request_errors(ValueError) as err:
+                raise ApiError(err, 'Failed to get groups of %s (%s)'
+                               % (user_key, err))
+
+            groups.extend(group['email'] for group in page.get('groups', ()))
+            if not page.get('nextPageToken'):
+                return groups
+            params['pageToken'] = page['nextPageToken']
+
+    def batch_get(self, batch_endpoint, keyed_calls, endpoint=None,
+                  batch_size=MAX_BATCH_SIZE):
+        """Make GET calls by batches, yield a :class:`BatchResult` per call
+        (in the order of the response)
+
+        ``keyed_calls`` are ``(key, BatchCall)`` pairs, read one batch at a
+        time. The failure of a call is the ``error`` of its result
+        (:class:`ApiError`), the failure of a whole batch raises ApiError.
+        """
+        keyed_calls = iter(keyed_calls)
+        batch_size = min(batch_size, MAX_BATCH_SIZE)
+        while True:
+            batch = list(itertools.islice(keyed_calls, batch_size))
+            if not batch:
+                return
+            keys = [key for key, _ in batch]
+            answered = set()
+            for index, result, error in self.send_batch(
+                    batch_endpoint, [call for _, call in batch], endpoint):
+                answered.add(index)
+                yield BatchResult(keys[index], result, error)
+
+            for index in set(range(len(keys))).difference(answered):
+                yield BatchResult(keys[index], None,
+                                  ApiError('No response in the batch'))
+
+    def send_batch(self, batch_endpoint, calls, endpoint=None):
+        """Make one batch call, yield ``(index, result, error)`` per part
+        of the response as it is read
+        """
+        boundary = new_boundary()
+        headers = {'Content-Type': 'multipart/mixed; boundary=%s' % boundary}
+        try:
+            # The calls of the batch are GET: safe to retry
+            response = self.http.post(batch_endpoint,
+                                      data=build_batch_body(calls, boundary),
+                                      headers=headers, endpoint=endpoint,
+                                      idempotent=True, stream=True)
+        except request_errors() as err:
+            raise ApiError(err, 'Failed to send batch (%s)' % err)
 
-def includeme(config):
-    settings = config.registry.settings
-    prefix = SETTINGS_PREFIX
+        try:
+            response.raise_for_status()
+            parts = iter_parts(
+                response.iter_content(BATCH_CHUNK_SIZE),
+                boundary_from_content_type(response.headers.get(
+                    'Content-Type')))
+            for part in parts:
+                try:
+                    index = int(part.content_id.rsplit('-', 1)[-1])
+                except ValueError:
+                    index = None
+                if index is None or not 0 <= index < len(calls):
+                    log.warning('Unexpected batch response part %r',
+                                part.content_id)
+                    continue
+                result, error = result_from_part(part)
+                yield index, result, error
+        except request_errors() as err:
+            raise ApiError(err, 'Failed to read batch (%s)' % err)
+        finally:
+            response.close()
+
+    def get_users(self, access_token, user_keys, fields=None,
+                  batch_size=MAX_BATCH_SIZE):
+        """Get the directory users (email or id) by batches, yield a
+        :class:`BatchResult` keyed by user key per user
+        """
+        params = {'fields': fields} if fields else {}
+        keyed_calls = (
+            (user_key,
+             BatchCall('%s/%s' % (self.domain_users_endpoint,
+                                  parse.quote(user_key, safe='@')),
+                       params, access_token))
+            for user_key in user_keys)
+        return self.batch_get(self.directory_batch_endpoint, keyed_calls,
+                              endpoint='directory', batch_size=batch_size)
+
+    def get_users_groups(self, access_token, user_keys, page_size=200,
+                         batch_size=MAX_BATCH_SIZE):
+        """Get the groups of many users (email or id) by batches, yield a
+        :class:`BatchResult` keyed by user key with the emails of the
+        groups
+
+        The first page of each user is read in the batch, the next ones (if
+        any) by :meth:`get_user_groups`.
+        """
+        params = {'maxResults': page_size,
+                  'fields': 'nextPageToken,groups(email)'}
+        keyed_calls = (
+            (user_key, BatchCall(self.groups_endpoint,
+                                 dict(params, userKey=user_key),
+                                 access_token))
+            for user_key in user_keys)
+        for result in self.batch_get(self.directory_batch_endpoint,
+                                     keyed_calls, endpoint='directory',
+                                     batch_size=batch_size):
+            if result.error is not None:
+                yield result
+                continue
+            groups = [group['email']
+                      for group in result.result.get('groups', ())]
+            next_page = result.result.get('nextPageToken')
+            if next_page:
+                try:
+                    groups.extend(self.get_user_groups(
+                        access_token, result.key, page_size, next_page))
+                except ApiError as err:
+                    yield BatchResult(result.key, None, err)
+                    continue
+            yield BatchResult(result.key, groups, None)
+
+    def get_userinfos(self, access_tokens, batch_size=MAX_BATCH_SIZE):
+        """Get the userinfo of many access tokens by batches, yield a
+        :class:`BatchResult` keyed by access token per token
+        """
+        keyed_calls = (
+            (access_token, BatchCall(self.userinfo_endpoint, {},
+                                     access_token))
+            for access_token in access_tokens)
+        return self.batch_get(self.userinfo_batch_endpoint, keyed_calls,
+                              endpoint='userinfo', batch_size=batch_size)
+
+
+def api_settings_from_settings(settings, prefix):
+    """Build the :class:`ApiSettings`, with the authorize url prefix"""
+    scopes = set(aslist(settings.get(prefix + 'scopes', '')))
+    scopes.add('email')
+
+    userinfo_source = settings.get(prefix + 'userinfo_source', 'userinfo')
+    if userinfo_source not in USERINFO_SOURCES:
+        raise ConfigurationError(
+            'Invalid %suserinfo_source: %s' % (prefix, userinfo_source))
+    if userinfo_source == 'id_token':
+        scopes.add('openid')
+
+    try:
+        hosted_domain, hosted_domains = hosted_domains_from_settings(
+            settings, prefix)
+    except (OSError, IOError, ValueError) as err:
+        log.error('Invalid hosted domain setting: %s', err)
+        raise
 
-    scope_list = set(aslist(settings.get(prefix + 'scopes', '')))
-    scope_list.add('email')
     try:
         api_settings = ApiSettings(
             access_type=settings.get(prefix + 'access_type', 'online'),
-            hosted_domain=settings.get(prefix + 'hosted_domain'),
+            authorize_url_prefix=None,
+            hosted_domain=hosted_domain,
+            hosted_domains=hosted_domains,
             id=settings[prefix + 'client_id'],
             landing_route=settings.get(prefix + 'landing_route'),
             landing_url=settings.get(prefix + 'landing_url'),
-            scope_list=scope_list,
+            scope_list=tuple(sorted(scopes)),
             secret=settings[prefix + 'client_secret'],
             signin_advice=settings.get(prefix + 'signin_advice'),
             signin_banner=settings.get(prefix + 'signin_banner'),
             user_id_field=settings.get(prefix + 'user_id_field', 'email'),
+            userinfo_source=userinfo_source,
             )
     except KeyError as err:
         log.error('Missing configuration setting: %s', err)
         raise
 
+    authorize_url_prefix = ApiClient.build_authorize_url_prefix(api_settings)
+    return api_settings._replace(authorize_url_prefix=authorize_url_prefix)
+
+
+def http_pool_from_settings(settings, prefix, metrics, rate_limiter=None):
+    try:
+        timeout = parse_timeout(settings.get(prefix + 'http_timeout'),
+                                (3.05, 10))
+        timeouts = dict(
+            (name, parse_timeout(settings.get(prefix + 'http_timeout_' + name),
+                                 timeout))
+            for name in ENDPOINTS)
+        return HttpSessionPool(
+            pool_connections=int(
+                settings.get(prefix + 'http_pool_connections', 10)),
+            pool_maxsize=int(settings.get(prefix + 'http_pool_maxsize', 10)),
+            metrics=metrics,
+            timeout=timeout,
+            timeouts=timeouts,
+            max_retries=int(settings.get(prefix + 'http_max_retries', 2)),
+            backoff_base=float(
+                settings.get(prefix + 'http_backoff_base', 0.1)),
+            backoff_max=float(settings.get(prefix + 'http_backoff_max', 2)),
+            breaker_threshold=int(
+                settings.get(prefix + 'circuit_breaker_threshold', 5)),
+            breaker_reset_timeout=float(
+                settings.get(prefix + 'circuit_breaker_reset_timeout', 30)),
+            rate_limiter=rate_limiter,
+            single_flight=asbool(
+                settings.get(prefix + 'http_single_flight', True)),
+            )
+    except ValueError as err:
+        log.error('Invalid HTTP pool setting: %s', err)
+        raise
+
+
+def build_rate_limiter(settings, prefix, metrics):
+    try:
+        return rate_limiter_from_settings(settings, prefix, ENDPOINTS,
+                                          metrics=metrics)
+    except ValueError as err:
+        log.error('Invalid rate limit setting: %s', err)
+        raise
+
+
+def tenants_from_settings(settings, prefix, metrics):
+    """Build the :class:`TenantRegistry` of the ``tenants`` (or None)"""
+    names = tenant_names(settings, prefix)
+    if not names:
+        return None
+
+    tenants = TenantRegistry()
+    for name in names:
+        merged = tenant_settings(settings, prefix, name)
+        tenant_prefix = '%stenant.%s.' % (prefix, name)
+        if (merged.get(prefix + 'ratelimit_path') and
+                tenant_prefix + 'ratelimit_path' not in settings):
+            # The quotas are per client: a bucket file per tenant
+            merged[prefix + 'ratelimit_path'] = os.path.join(
+                merged[prefix + 'ratelimit_path'], name)
+        rate_limiter = build_rate_limiter(merged, prefix, metrics)
+        tenant = Tenant(
+            name=name,
+            api_settings=api_settings_from_settings(merged, prefix),
+            http=http_pool_from_settings(merged, prefix, metrics,
+                                         rate_limiter),
+            )
+        try:
+            tenants.add(tenant,
+                        hosts=aslist(settings.get(tenant_prefix + 'hosts',
+                                                  '')),
+                        paths=aslist(settings.get(tenant_prefix + 'paths',
+                                                  '')))
+        except ValueError as err:
+            log.error('Invalid tenant setting: %s', err)
+            raise
+    return tenants
+
+
+def includeme(config):
+    settings = config.registry.settings
+    prefix = SETTINGS_PREFIX
+
+    api_settings = api_settings_from_settings(settings, prefix)
     config.add_settings(googleapi_settings=api_settings)
 
+    metrics = get_metrics_sink(config.registry)
+
+    rate_limiter = build_rate_limiter(settings, prefix, metrics)
+    if rate_limiter is not None:
+        config.registry.registerUtility(rate_limiter, provided=IRateLimiter)
+
+    http_pool = http_pool_from_settings(settings, prefix, metrics,
+                                        rate_limiter)
+    config.registry.registerUtility(http_pool, provided=IHttpSessionPool)
+    config.registry.registerUtility(SigningKeys(http_pool),
+                                    provided=ISigningKeys)
+
+    tenants = tenants_from_settings(settings, prefix, metrics)
+    if tenants is not None:
+        config.add_settings(googleapi_tenants=tenants)
+
+    try:
+        token_store = token_store_from_settings(settings, prefix)
+    except (KeyError, ValueError) as err:
+        log.error('Invalid token store setting: %s', err)
+        raise
+    if token_store is not None:
+        config.registry.registerUtility(token_store, provided=ITokenStore)
+
+    try:
+        userinfo_cache_maxsize = int(
+            settings.get(prefix + 'userinfo_cache_maxsize', 0))
+        userinfo_cache_ttl = int(
+            settings.get(prefix + 'userinfo_cache_ttl', 300))
+    except ValueError as err:
+        log.error('Invalid userinfo cache setting: %s', err)
+        raise
+    if userinfo_cache_maxsize:
+        config.registry.registerUtility(
+            LRUCache(maxsize=userinfo_cache_maxsize, ttl=userinfo_cache_ttl),
+            provided=IUserinfoCache)
     config.registry.registerUtility(ApiClient, provided=IApiClientFactory)
     config.add_request_method(new_api_client, 'googleapi', reify=True)
 
 
+def parse_timeout(value, default):
+    """``"3 10"`` -> ``(3.0, 10.0)`` (connect, read), ``"5"`` -> ``5.0``"""
+    values = [float(v) for v in aslist(value or '')]
+    if not values:
+        return default
+    if len(values) == 1:
+        return values[0]
+    if len(values) == 2:
+        return tuple(values)
+    raise ValueError('Invalid timeout: %s' % value)
+
+
 def new_api_client(request):
     return request.registry.getUtility(IApiClientFactory)(request)
+
+
+def new_api_client_from_registry(registry, tenant=None):
+    """ Sync :class:`ApiClient` for code running outside of a request (e.g.
+    a thread), with the settings of the ``tenant`` (name) if any. Not the
+    ``IApiClientFactory`` of the application: the background services need
+    the sync client """
+    request = Request.blank('/')
+    request.registry = registry
+    if tenant is not None:
+        request.environ[TENANT_ENVIRON_KEY] = tenant
+    return ApiClient(request)
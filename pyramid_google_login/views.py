@@ -1,13 +1,21 @@
 import logging
 
-from six.moves.urllib import parse
-from pyramid.view import view_config
 from pyramid.security import (remember, forget, NO_PERMISSION_REQUIRED)
 from pyramid.httpexceptions import HTTPFound
 
 from pyramid_google_login import redirect_to_signin, find_landing_path
+from pyramid_google_login.dispatch import IDeferredDispatcher
 from pyramid_google_login.events import UserLoggedIn, UserLoggedOut
 from pyramid_google_login.exceptions import AuthFailed
+from pyramid_google_login.metrics import PhaseTimer, get_metrics_sink
+from pyramid_google_login.reauth import ISilentReauth, SILENT_ERRORS
+from pyramid_google_login.state import (IStateSerializer, check_state,
+                                        delete_state_cookie, set_state_cookie)
+from pyramid_google_login.stores import ITokenStore
+from pyramid_google_login.tenants import get_api_settings, get_tenant_name
+from pyramid_google_login.templating import (ISigninPageCache,
+                                             ContentCacheBuster,
+                                             SIGNIN_TEMPLATE, STATIC_MAX_AGE)
 
 log = logging.getLogger(__name__)
 
@@ -20,24 +28,23 @@ def includeme(config):
 
     config.add_static_view('static/pyramid_google_login',
                            'pyramid_google_login:static',
-                           cache_max_age=300)
+                           cache_max_age=STATIC_MAX_AGE)
+    config.add_cache_buster('pyramid_google_login:static/',
+                            ContentCacheBuster())
 
-    config.scan(__name__)
+    # Registered explicitly rather than scanned: faster at startup
+    config.add_view(signin, route_name='auth_signin',
+                    permission=NO_PERMISSION_REQUIRED,
+                    renderer=SIGNIN_TEMPLATE)
+    config.add_view(signin_redirect, route_name='auth_signin_redirect',
+                    permission=NO_PERMISSION_REQUIRED)
+    config.add_view(callback, route_name='auth_callback',
+                    permission=NO_PERMISSION_REQUIRED)
+    config.add_view(logout, route_name='auth_logout')
 
 
-def encode_state(params):
-    return parse.urlencode(params)
-
-
-def decode_state(state):
-    return parse.parse_qs(state)
-
-
-@view_config(route_name='auth_signin',
-             permission=NO_PERMISSION_REQUIRED,
-             renderer='pyramid_google_login:templates/signin.mako')
 def signin(request):
-    googleapi_settings = request.registry.settings['googleapi_settings']
+    googleapi_settings = get_api_settings(request)
     message = request.params.get('message')
     url = request.params.get('url')
 
@@ -47,90 +54,204 @@ def signin(request):
         else:
             return HTTPFound(location=find_landing_path(request))
 
+    # A message follows a failure or a logout: no silent attempt (loop)
+    reauth = request.registry.queryUtility(ISilentReauth)
+    if message is None and reauth is not None:
+        userid = reauth.returning_userid(request)
+        if userid is not None:
+            response = silent_reauth(request, reauth, userid, url)
+            if response is not None:
+                return response
+            request.add_response_callback(reauth.forget_user)
+
     if url:
         redirect_url = request.route_url('auth_signin_redirect',
                                          _query={'url': url})
     else:
         redirect_url = request.route_url('auth_signin_redirect')
 
-    return {'signin_redirect_url': redirect_url,
-            'message': message,
-            'signin_banner': googleapi_settings.signin_banner,
-            'signin_advice': googleapi_settings.signin_advice,
-            'hosted_domain': googleapi_settings.hosted_domain,
-            }
+    values = {'signin_redirect_url': redirect_url,
+              'message': message,
+              'signin_banner': googleapi_settings.signin_banner,
+              'signin_advice': googleapi_settings.signin_advice,
+              'hosted_domain': googleapi_settings.hosted_domain,
+              }
+
+    # Without message nor url (set by anyone), the page is the same for all
+    # the users of a host: rendered once
+    page_cache = request.registry.queryUtility(ISigninPageCache)
+    if message is None and not url and page_cache is not None:
+        key = (googleapi_settings.id, request.application_url)
+        return page_cache.response(request, key, values)
+    return values
 
 
-@view_config(route_name='auth_signin_redirect',
-             permission=NO_PERMISSION_REQUIRED,)
 def signin_redirect(request):
+    return authorize_redirect(request, request.params.get('url'))
+
+
+def authorize_redirect(request, url, extra_params=()):
+    """Send the user to Google, back to ``url`` once logged in"""
     googleapi = request.googleapi
     redirect_uri = request.route_url('auth_callback')
 
-    state_params = {}
-    if 'url' in request.params:
-        state_params['url'] = request.params['url']
-    state = encode_state(state_params)
+    state_serializer = request.registry.getUtility(IStateSerializer)
+    state, nonce = state_serializer.dumps(url)
 
     try:
-        authorize_url = googleapi.build_authorize_url(state, redirect_uri)
+        authorize_url = googleapi.build_authorize_url(state, redirect_uri,
+                                                      extra_params)
     except AuthFailed as err:
         log.warning('Google Login failed (%s)', err)
         return redirect_to_signin(request, 'Google Login failed (%s)' % err)
 
-    return HTTPFound(location=authorize_url)
+    response = HTTPFound(location=authorize_url)
+    set_state_cookie(request, response, nonce)
+    return response
 
 
-@view_config(route_name='auth_callback',
-             permission=NO_PERMISSION_REQUIRED)
 def callback(request):
     api = request.googleapi
     redirect_uri = request.route_url('auth_callback')
+    metrics = get_metrics_sink(request.registry)
+    phases = PhaseTimer(metrics, 'callback.phase')
+    url = None
     try:
-        oauth2_token = api.exchange_token_from_code(redirect_uri)
-        userinfo = api.get_userinfo_from_token(oauth2_token)
-        api.check_hosted_domain_user(userinfo)
-        userid = api.get_user_id_from_userinfo(userinfo)
+        with phases('state'):
+            url = check_state(request)
+        with phases('token_exchange'):
+            oauth2_token = api.exchange_token_from_code(redirect_uri)
+        with phases('userinfo'):
+            userinfo = api.get_userinfo_from_token(oauth2_token)
+        with phases('hosted_domain'):
+            api.check_hosted_domain_user(userinfo)
+        with phases('user_id'):
+            userid = api.get_user_id_from_userinfo(userinfo)
 
     except AuthFailed as err:
+        metrics.incr('callback.auth_failed', tags={'phase': phases.phase})
+        if request.params.get('error') in SILENT_ERRORS:
+            return silent_reauth_failed(request, url, err)
         log.warning('Google Login failed (%s)', err)
         return redirect_to_signin(request, 'Google Login failed (%s)' % err)
 
     except Exception as err:
+        metrics.incr('callback.errors', tags={'phase': phases.phase})
         log.warning('Google Login failed (%s)', err)
         # Protect against leaking critical information like client_secret
         return redirect_to_signin(request, 'Google Login failed (unkown)')
 
-    # Find the redirect url (fail-safe, the authentication is more important)
+    if url is None:
+        url = find_landing_path(request)
+
+    response = login(request, userid, oauth2_token, userinfo, url, phases,
+                     'callback')
+    delete_state_cookie(request, response)
+    return response
+
+
+def silent_reauth(request, reauth, userid, url):
+    """Log the returning user in without the sign in page, return None if
+    not possible
+    """
+    metrics = get_metrics_sink(request.registry)
+    if reauth.mode == 'prompt_none':
+        metrics.incr('silent_reauth.redirects')
+        return authorize_redirect(request, url, (('prompt', 'none'),
+                                                 ('login_hint', userid)))
+
+    phases = PhaseTimer(metrics, 'silent_reauth.phase')
     try:
-        state_params = decode_state(request.params['state'])
-        url = state_params['url'][0]
+        with phases('token_refresh'):
+            oauth2_token, userinfo = reauth.refresh(request, userid)
+    except AuthFailed as err:
+        metrics.incr('silent_reauth.auth_failed', tags={'phase': phases.phase})
+        log.info('Silent re-authentication of %s failed (%s)', userid, err)
+        return None
     except Exception:
+        metrics.incr('silent_reauth.errors', tags={'phase': phases.phase})
+        log.warning('Silent re-authentication of %s failed', userid,
+                    exc_info=True)
+        return None
+
+    if url is None:
         url = find_landing_path(request)
+    return login(request, userid, oauth2_token, userinfo, url, phases,
+                 'silent_reauth')
+
+
+def silent_reauth_failed(request, url, err):
+    """Google can't log the user in without interaction: show the sign in
+    page, without attempting a silent re-authentication again
+    """
+    log.info('Silent re-authentication failed (%s)', err)
+    response = redirect_to_signin(request, url=url)
+    reauth = request.registry.queryUtility(ISilentReauth)
+    if reauth is not None:
+        reauth.forget_user(request, response)
+    return response
+
+
+def login(request, userid, oauth2_token, userinfo, url, phases, flow):
+    """Notify the application and remember the authenticated user
 
+    ``flow`` prefixes the metrics (``callback``, ``silent_reauth``).
+    """
+    metrics = phases.sink
     user_logged_in = UserLoggedIn(request, userid, oauth2_token, userinfo)
     try:
-        request.registry.notify(user_logged_in)
+        with phases('event_dispatch'):
+            request.registry.notify(user_logged_in)
     except Exception:
+        metrics.incr(flow + '.errors', tags={'phase': phases.phase})
         log.exception('Application crashed processing UserLoggedIn event'
                       '\nuserinfo=%s oauth2_token=%s',
                       userinfo, oauth2_token)
         return redirect_to_signin(request,
                                   'Google Login failed (application error)')
+    defer_event(request, user_logged_in)
 
-    if user_logged_in.headers:
-        headers = user_logged_in.headers
-    else:
-        headers = remember(request, userid)
-    return HTTPFound(location=url, headers=headers)
+    if request.registry.queryUtility(ITokenStore) is not None:
+        # Fail-safe, the tokens are not needed to authenticate the user
+        try:
+            with phases('token_store'):
+                request.google_tokens.save(userid, oauth2_token,
+                                           tenant=get_tenant_name(request))
+        except Exception:
+            log.exception('Failed to store the tokens of %s', userid)
+
+    with phases('remember'):
+        if user_logged_in.headers:
+            headers = user_logged_in.headers
+        else:
+            headers = remember(request, userid)
+    response = HTTPFound(location=url, headers=headers)
+
+    reauth = request.registry.queryUtility(ISilentReauth)
+    if reauth is not None and flow != 'silent_reauth':
+        # A silent login keeps the expiration of the cookie
+        reauth.remember_user(request, response, userid)
+    metrics.incr(flow + '.logins')
+    return response
 
 
-@view_config(route_name='auth_logout')
 def logout(request):
     userid = request.unauthenticated_userid
     if userid is not None:
-        event = UserLoggedOut(userid)
+        event = UserLoggedOut(userid, request)
         request.registry.notify(event)
+        defer_event(request, event)
 
     headers = forget(request)
-    return redirect_to_signin(request, 'You are logged out!', headers=headers)
+    response = redirect_to_signin(request, 'You are logged out!',
+                                  headers=headers)
+    reauth = request.registry.queryUtility(ISilentReauth)
+    if reauth is not None:
+        reauth.forget_user(request, response)
+    return response
+
+
+def defer_event(request, event):
+    dispatcher = request.registry.queryUtility(IDeferredDispatcher)
+    if dispatcher is not None:
+        dispatcher.defer(request, event)
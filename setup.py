@@ -32,4 +32,9 @@ setup(
     package_data={'pyramid_google_login': ['static/*.*', 'templates/*.*']},
 
     install_requires=['pyramid_mako', 'requests', 'six'],
+    extras_require={
+        'aio': ['aiohttp'],
+        'crypto': ['cryptography'],
+        'redis': ['redis'],
+    },
 )